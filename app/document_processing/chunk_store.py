@@ -0,0 +1,268 @@
+import json
+import mmap
+import os
+import sys
+from array import array
+from typing import Dict, List, Optional
+
+import numpy as np
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+CHUNK_DATA_FILENAME = "chunks.bin"
+CHUNK_OFFSETS_FILENAME = "chunk_offsets.npy"
+CHUNK_FILES_FILENAME = "chunk_files.json"
+
+# the arena is compacted once removed chunks take more than this ratio of it
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 1 << 20
+
+
+class ChunkStore:
+    """texts of all chunks, (filename, chunk id) -> text
+
+    Chunks are utf-8 encoded back to back in one arena, with one offset per chunk.
+    Chunks of a file are stored in consecutive rows, filenames are interned into
+    file ids, and each file id holds its first row and number of chunks, so a
+    chunk is found in O(1) without a python object per chunk.
+
+    Removed chunks stay in the arena until they take more than COMPACT_RATIO of
+    it, or until the store is saved. Loaded stores are memory-mapped from data
+    directory: chunks.bin holds the arena, chunk_offsets.npy holds the offsets and
+    chunk_files.json holds the row range of each file. They are copied into memory
+    on the first change and stay there, saving does not map them again.
+    """
+
+    def __init__(self):
+        # arena and offsets, row i spans arena[offsets[i] : offsets[i + 1]]
+        self.arena = bytearray()
+        self.offsets = array("q", [0])
+        # file table, indexed by file id, removed files are None
+        self.files: List[Optional[str]] = []
+        self.file_ids: Dict[str, int] = {}
+        self.file_start = array("q")
+        self.file_count = array("q")
+        self.dead_bytes = 0
+        # path of data directory, if arena and offsets are memory-mapped from it
+        self.mmap_dir = None
+        self._file = None
+
+    @staticmethod
+    def exists(data_dir: str) -> bool:
+        return os.path.exists(os.path.join(data_dir, CHUNK_FILES_FILENAME))
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.file_ids
+
+    def __len__(self) -> int:
+        return len(self.file_ids)
+
+    def filenames(self) -> List[str]:
+        return list(self.file_ids)
+
+    def num_chunks(self, filename: str) -> int:
+        """number of chunks of a file, 0 if it is not stored"""
+        file_id = self.file_ids.get(filename)
+        return 0 if file_id is None else self.file_count[file_id]
+
+    def get(self, filename: str, chunk_id: int) -> str:
+        """get a chunk
+
+        Args:
+            filename (str): filename
+            chunk_id (int): chunk id
+
+        Raises:
+            KeyError: file or chunk is not stored
+
+        Returns:
+            str: chunk text
+        """
+        file_id = self.file_ids[filename]
+        if not 0 <= chunk_id < self.file_count[file_id]:
+            raise KeyError(chunk_id)
+        row = self.file_start[file_id] + chunk_id
+        return self.arena[self.offsets[row] : self.offsets[row + 1]].decode("utf-8")
+
+    def get_chunks(self, filename: str) -> List[str]:
+        """get all chunks of a file, in chunk id order"""
+        return [self.get(filename, i) for i in range(self.num_chunks(filename))]
+
+    def _ensure_writable(self):
+        """copy memory-mapped arena and offsets into memory before changing them"""
+        if self.mmap_dir is None:
+            return
+        logger.info(f"Load chunks of {self.mmap_dir} into memory")
+        arena = bytearray(self.arena)
+        offsets = array("q")
+        offsets.frombytes(np.ascontiguousarray(self.offsets, dtype=np.int64).tobytes())
+        self.close()
+        self.arena, self.offsets = arena, offsets
+
+    def add(self, filename: str, chunks: List[str]):
+        """add chunks of a file, chunks already stored for it are replaced
+
+        Args:
+            filename (str): filename
+            chunks (List[str]): chunks, in chunk id order
+        """
+        if filename in self.file_ids:
+            self.remove(filename)
+        self._ensure_writable()
+        self.file_ids[filename] = len(self.files)
+        self.files.append(filename)
+        self.file_start.append(len(self.offsets) - 1)
+        self.file_count.append(len(chunks))
+        for chunk in chunks:
+            self.arena += chunk.encode("utf-8")
+            self.offsets.append(len(self.arena))
+
+    def remove(self, filename: str):
+        """remove chunks of a file, the arena is compacted lazily
+
+        Args:
+            filename (str): filename
+
+        Raises:
+            KeyError: file is not stored
+        """
+        file_id = self.file_ids.pop(filename)
+        self.files[file_id] = None
+        start = self.file_start[file_id]
+        self.dead_bytes += int(
+            self.offsets[start + self.file_count[file_id]] - self.offsets[start]
+        )
+        if self.mmap_dir is None and self.dead_bytes > max(
+            COMPACT_MIN_BYTES, COMPACT_RATIO * len(self.arena)
+        ):
+            self.compact()
+
+    def _iter_live(self):
+        """yield (filename, first row, number of rows) of stored files"""
+        for file_id, filename in enumerate(self.files):
+            if filename is not None:
+                yield filename, self.file_start[file_id], self.file_count[file_id]
+
+    def compact(self):
+        """drop removed chunks from the arena and the file table"""
+        self._ensure_writable()
+        arena = bytearray()
+        offsets = array("q", [0])
+        files = []
+        file_start = array("q")
+        file_count = array("q")
+        old_offsets = np.frombuffer(self.offsets, dtype=np.int64)
+        for filename, start, count in self._iter_live():
+            begin, end = old_offsets[start], old_offsets[start + count]
+            shift = len(arena) - begin
+            arena += self.arena[begin:end]
+            files.append(filename)
+            file_start.append(len(offsets) - 1)
+            file_count.append(count)
+            offsets.extend((old_offsets[start + 1 : start + count + 1] + shift).tolist())
+        logger.info(f"Compact chunk store, drop {self.dead_bytes} bytes")
+        self.arena, self.offsets = arena, offsets
+        self.files, self.file_start, self.file_count = files, file_start, file_count
+        self.file_ids = {filename: i for i, filename in enumerate(files)}
+        self.dead_bytes = 0
+
+    def prepare_save(self):
+        """drop removed chunks, so that save only reads the store. Also copies
+        memory-mapped chunks into memory, memory-mapped files can not be replaced
+        on windows"""
+        if self.dead_bytes:
+            self.compact()
+        else:
+            self._ensure_writable()
+
+    def save(self, data_dir: str):
+        """write stored chunks to data directory, removed chunks are dropped first
+
+        Args:
+            data_dir (str): data directory
+        """
+        data_path = os.path.join(data_dir, CHUNK_DATA_FILENAME)
+        offsets_path = os.path.join(data_dir, CHUNK_OFFSETS_FILENAME)
+        files_path = os.path.join(data_dir, CHUNK_FILES_FILENAME)
+
+        self.prepare_save()
+        file_ranges = {
+            filename: [start, count] for filename, start, count in self._iter_live()
+        }
+        with open(data_path + ".tmp", "wb") as f:
+            f.write(self.arena)
+        with open(offsets_path + ".tmp", "wb") as f:
+            np.save(f, np.frombuffer(self.offsets, dtype=np.int64))
+        with open(files_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(file_ranges, f, ensure_ascii=False)
+        for path in [data_path, offsets_path, files_path]:
+            os.replace(path + ".tmp", path)
+        logger.info(f"Save {len(self.offsets) - 1} chunks of {len(file_ranges)} files")
+
+    def load(self, data_dir: str):
+        """memory-map chunks saved in data directory
+
+        Args:
+            data_dir (str): data directory
+        """
+        self.close()
+        with open(
+            os.path.join(data_dir, CHUNK_FILES_FILENAME), "r", encoding="utf-8"
+        ) as f:
+            file_ranges: Dict[str, list] = json.load(f)
+        self.files = list(file_ranges)
+        self.file_ids = {filename: i for i, filename in enumerate(self.files)}
+        self.file_start = array("q", [start for start, _ in file_ranges.values()])
+        self.file_count = array("q", [count for _, count in file_ranges.values()])
+        self.dead_bytes = 0
+        self.offsets = np.load(
+            os.path.join(data_dir, CHUNK_OFFSETS_FILENAME), mmap_mode="r"
+        )
+        self._file = open(os.path.join(data_dir, CHUNK_DATA_FILENAME), "rb")
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self.arena = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # empty file can not be memory-mapped
+            self.arena = b""
+        self.mmap_dir = data_dir
+
+    def close(self):
+        """close memory-mapped files"""
+        if self.mmap_dir is None:
+            return
+        if isinstance(self.arena, mmap.mmap):
+            self.arena.close()
+        self._file.close()
+        self.arena = bytearray()
+        self.offsets = array("q", [0])
+        self._file = None
+        self.mmap_dir = None
+
+    def get_memory_usage(self) -> Dict[str, int]:
+        """report memory footprint, memory-mapped arena and offsets are paged in by
+        the os on demand and not counted in `total_bytes`
+
+        Returns:
+            Dict[str, int]: sizes in bytes and counters
+        """
+        arena_bytes = len(self.arena)
+        offsets_bytes = len(self.offsets) * 8
+        file_table_bytes = (
+            sys.getsizeof(self.files)
+            + sys.getsizeof(self.file_ids)
+            + sum(sys.getsizeof(filename) for filename in self.file_ids)
+            + (len(self.file_start) + len(self.file_count)) * 8
+        )
+        mapped = self.mmap_dir is not None
+        return {
+            "files": len(self.file_ids),
+            "chunks": sum(count for _, _, count in self._iter_live()),
+            "arena_bytes": arena_bytes,
+            "offsets_bytes": offsets_bytes,
+            "file_table_bytes": file_table_bytes,
+            "dead_bytes": self.dead_bytes,
+            "mapped": int(mapped),
+            "total_bytes": file_table_bytes
+            + (0 if mapped else arena_bytes + offsets_bytes),
+        }
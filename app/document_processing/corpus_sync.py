@@ -0,0 +1,299 @@
+import hashlib
+import importlib.util
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from app.document_processing.doc_processor import (DocProcessor,
+                                                   check_if_support_docx)
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# number of bytes read at a time while hashing files
+HASH_BLOCK_SIZE = 1 << 20
+# seconds without file system events before a watched corpus is synced
+WATCH_DEBOUNCE = 1.0
+# watchdog events meaning that a file may have changed, "opened" and
+# "closed_no_write" are also raised when files are read while syncing
+WATCH_EVENT_TYPES = {"created", "modified", "deleted", "moved", "closed"}
+
+
+def hash_file(path: str) -> str:
+    """sha256 of file content
+
+    Args:
+        path (str): file path
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class SyncResult:
+    """changes made by one sync"""
+
+    added: List[str] = field(default_factory=list)
+    updated: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    unchanged: int = 0
+    # Dict[file path, error]
+    failed: Dict[str, str] = field(default_factory=dict)
+
+
+class CorpusSync:
+    """keep documents of a directory tree in sync with the doc processor
+
+    Each sync scans the tree and compares mtime and size of each file with a
+    manifest, files whose mtime or size changed are hashed to tell real changes.
+    New files are added, changed files are updated, where only changed chunks are
+    embedded, and files gone from the tree are removed. Files which fail are
+    recorded with their mtime and size, and retried only once they change.
+
+    `start` keeps syncing in a background thread, on file system events if
+    watchdog (inotify on linux) is installed, otherwise every `poll_interval`
+    seconds.
+    """
+
+    def __init__(
+        self,
+        doc_processor: DocProcessor,
+        root: str,
+        workers: int = 4,
+        poll_interval: float = 5.0,
+        manifest_path: Optional[str] = None,
+    ):
+        self.doc_processor = doc_processor
+        self.root = os.path.abspath(root)
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.suffixes = {".pdf", ".txt", ".md"}
+        if check_if_support_docx():
+            self.suffixes.add(".docx")
+        if manifest_path is None and doc_processor.data_dir:
+            # one manifest for each root, next to the saved index
+            root_id = hashlib.sha1(self.root.encode("utf-8")).hexdigest()[:16]
+            manifest_path = os.path.join(
+                doc_processor.data_dir, f"corpus_manifest_{root_id}.json"
+            )
+        self.manifest_path = manifest_path
+        # Dict[file path, [mtime in ns, size, content hash]], hash is None if failed
+        self.manifest: Dict[str, list] = self._load_manifest()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._changed = threading.Event()
+        self._thread = None
+
+    def _load_manifest(self) -> Dict[str, list]:
+        if not self.manifest_path or not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_manifest(self):
+        if not self.manifest_path:
+            return
+        manifest_dir = os.path.dirname(os.path.abspath(self.manifest_path))
+        os.makedirs(manifest_dir, exist_ok=True)
+        with open(self.manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        """list supported files under root, hidden files and directories are skipped
+
+        Returns:
+            Dict[str, Tuple[int, int]]: Dict[file path, (mtime in ns, size)]
+        """
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                if os.path.splitext(filename)[1] not in self.suffixes:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # removed after listing
+                    continue
+                files[path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def _hash(self, path: str) -> Optional[str]:
+        try:
+            return hash_file(path)
+        except OSError as e:
+            logger.warning(f"Failed to read {path}: {e}")
+            return None
+
+    def _update(self, path: str) -> Optional[str]:
+        """update a document, returns error if failed"""
+        try:
+            self.doc_processor.update_document(path, save=False)
+            return None
+        except Exception as e:
+            return repr(e)
+
+    def sync(self) -> SyncResult:
+        """sync once, add, update or remove documents which changed since last sync
+
+        Returns:
+            SyncResult: changes made
+        """
+        with self._lock:
+            result = SyncResult()
+            files = self.scan()
+            indexed = set(self.doc_processor.get_doc_list(self.root))
+
+            # files whose mtime or size changed, or which are not indexed yet
+            candidates = []
+            for path, (mtime, size) in files.items():
+                entry = self.manifest.get(path)
+                if (
+                    entry is not None
+                    and entry[:2] == [mtime, size]
+                    and (path in indexed or entry[2] is None)
+                ):
+                    result.unchanged += 1
+                else:
+                    candidates.append(path)
+            with ThreadPoolExecutor(self.workers) as executor:
+                hashes = dict(zip(candidates, executor.map(self._hash, candidates)))
+
+            to_add, to_update = [], []
+            for path in candidates:
+                entry = self.manifest.get(path)
+                if hashes[path] is None:
+                    result.failed[path] = "unreadable"
+                elif path not in indexed:
+                    to_add.append(path)
+                elif entry is not None and entry[2] == hashes[path]:
+                    # touched but not changed
+                    self.manifest[path] = [*files[path], hashes[path]]
+                    result.unchanged += 1
+                else:
+                    to_update.append(path)
+            to_remove = sorted(path for path in indexed if path not in files)
+
+            for path in to_remove:
+                try:
+                    self.doc_processor.remove_document(path, save=False)
+                    result.removed.append(path)
+                except Exception as e:
+                    result.failed[path] = repr(e)
+            with ThreadPoolExecutor(self.workers) as executor:
+                errors = list(executor.map(self._update, to_update))
+            for path, error in zip(to_update, errors):
+                if error is None:
+                    result.updated.append(path)
+                    self.manifest[path] = [*files[path], hashes[path]]
+                else:
+                    result.failed[path] = error
+                    self.manifest[path] = [*files[path], None]
+            ingest_results = []
+            if to_add:
+                ingest_results = self.doc_processor.process_documents(to_add, save=False)
+            if to_add or result.updated or result.removed:
+                # once for all changes of this sync, before the manifest refers to them
+                self.doc_processor.save()
+            for path, ingest_result in zip(to_add, ingest_results):
+                if ingest_result.success:
+                    result.added.append(path)
+                    self.manifest[path] = [*files[path], hashes[path]]
+                else:
+                    result.failed[path] = ingest_result.error
+                    self.manifest[path] = [*files[path], None]
+
+            prefix = os.path.join(self.root, "")
+            for path in list(self.manifest):
+                if path.startswith(prefix) and path not in files:
+                    self.manifest.pop(path)
+            self._save_manifest()
+
+            logger.info(
+                f"Sync {self.root}: {len(result.added)} added, "
+                f"{len(result.updated)} updated, {len(result.removed)} removed, "
+                f"{result.unchanged} unchanged, {len(result.failed)} failed"
+            )
+            for path, error in result.failed.items():
+                logger.error(f"Failed to sync {path}: {error}")
+            return result
+
+    def _start_observer(self):
+        """watch root with watchdog if it is installed
+
+        Returns:
+            watchdog observer, None if watchdog is unavailable
+        """
+        if importlib.util.find_spec("watchdog") is None:
+            logger.info(
+                f"watchdog is unavailable, poll {self.root} every {self.poll_interval}s"
+            )
+            return None
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+
+        changed = self._changed
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type in WATCH_EVENT_TYPES:
+                    changed.set()
+
+        observer = Observer()
+        observer.schedule(Handler(), self.root, recursive=True)
+        observer.start()
+        logger.info(f"Watch {self.root} for changes")
+        return observer
+
+    def watch(self):
+        """sync and keep syncing on changes until stop is called, blocking"""
+        observer = self._start_observer()
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.sync()
+                except Exception as e:
+                    logger.error(f"Failed to sync {self.root}: {e}")
+                if observer is None:
+                    self._stop.wait(self.poll_interval)
+                    continue
+                self._changed.wait()
+                # files are often written in several steps, wait until events settle
+                while self._changed.is_set() and not self._stop.is_set():
+                    self._changed.clear()
+                    self._stop.wait(WATCH_DEBOUNCE)
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+    def start(self):
+        """run watch in a background thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.watch, name="corpus_sync", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """stop watching, waits for the running sync to finish"""
+        self._stop.set()
+        self._changed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -2,7 +2,7 @@ import importlib
 import os
 import sys
 from abc import ABC, abstractmethod
-from typing import Dict, List, Tuple, Type
+from typing import Collection, Dict, List, Optional, Tuple, Type
 
 import numpy as np
 from app.engine.config import DocConfig
@@ -12,17 +12,115 @@ DATABASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(DATABASE_DIR)
 
 DATABASE_CONFIG_MODULENAME_CLASSNAME_MAP = {
-    "faiss": ("database_faiss", "DatabaseFaiss")
+    "faiss": ("database_faiss", "DatabaseFaiss"),
+    "faiss_ivfpq": ("database_faiss_ivfpq", "DatabaseFaissIVFPQ"),
+    "faiss_hnsw": ("database_faiss_hnsw", "DatabaseFaissHNSW"),
 }
 
+# similarity returned by search for each metric:
+# "l2": 1 - squared l2 distance / 2, equal to cosine similarity for normalised vectors
+# "ip": inner product
+# "cosine": cosine similarity, vectors are normalised when added and searched
+METRICS = ("l2", "ip", "cosine")
+
 logger = get_logger(__name__)
 
 
+def _normalize(vectors: np.array) -> np.array:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def maximal_marginal_relevance(
+    query: np.array,
+    candidates: np.array,
+    topk: int,
+    lambda_mult: float,
+    groups: Optional[np.array] = None,
+    max_per_group: int = 0,
+) -> List[int]:
+    """select candidates one by one, each time the one maximizing
+    `lambda_mult * sim(query, candidate) - (1 - lambda_mult) * max sim(candidate, selected)`
+    with cosine similarity
+
+    Args:
+        query (np.array): query vector, shape like [dimension] or [1, dimension]
+        candidates (np.array): candidate vectors, shape like [num of candidates, dimension]
+        topk (int): max number of selected candidates
+        lambda_mult (float): weight of relevance, 1 - lambda_mult is weight of diversity
+        groups (Optional[np.array], optional): group of each candidate, such as file.
+            Defaults to None.
+        max_per_group (int, optional): at most this many candidates of a group are
+            selected. Defaults to 0, no limit.
+
+    Returns:
+        List[int]: positions of selected candidates, in selection order
+    """
+    candidates = _normalize(np.asarray(candidates, dtype=np.float32))
+    relevance = candidates @ _normalize(np.asarray(query, dtype=np.float32).ravel())
+    # similarity between candidates, computed once
+    similarity = candidates @ candidates.T
+    # max similarity to selected candidates, 0 before the first selection
+    redundancy = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    selected = []
+    while len(selected) < topk and available.any():
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        i = int(np.argmax(np.where(available, scores, -np.inf)))
+        selected.append(i)
+        available[i] = False
+        if len(selected) == 1:
+            redundancy = similarity[i]
+        else:
+            redundancy = np.maximum(redundancy, similarity[i])
+        if max_per_group > 0 and groups is not None:
+            if np.count_nonzero(groups[selected] == groups[i]) >= max_per_group:
+                available &= groups != groups[i]
+    return selected
+
+
+def limit_per_group(groups: np.array, topk: int, max_per_group: int) -> List[int]:
+    """select candidates in order, skipping those whose group is full
+
+    Args:
+        groups (np.array): group of each candidate, such as file
+        topk (int): max number of selected candidates
+        max_per_group (int): at most this many candidates of a group are selected,
+            0 for no limit
+
+    Returns:
+        List[int]: positions of selected candidates, in order
+    """
+    if max_per_group <= 0:
+        return list(range(min(topk, len(groups))))
+    selected = []
+    counts: Dict[int, int] = {}
+    for i, group in enumerate(groups.tolist()):
+        if counts.get(group, 0) >= max_per_group:
+            continue
+        counts[group] = counts.get(group, 0) + 1
+        selected.append(i)
+        if len(selected) == topk:
+            break
+    return selected
+
+
 class Database(ABC):
 
     def __init__(self, config: DocConfig):
         self.dimension = config.dimension
         self.topk = config.topk
+        self.metric = config.metric.lower()
+        if self.metric not in METRICS:
+            logger.error(f"Invalid metric: {config.metric}, should be one of {METRICS}")
+            raise ValueError()
+        self.min_similarity = config.min_similarity
+        self.mmr_lambda = config.mmr_lambda
+        if self.mmr_lambda is not None and not 0 <= self.mmr_lambda <= 1:
+            logger.error(f"mmr_lambda should be within [0, 1], got {self.mmr_lambda}")
+            raise ValueError()
+        self.max_chunks_per_file = config.max_chunks_per_file
+        self.search_candidates = config.search_candidates
         self.index_map = {}
 
     @abstractmethod
@@ -38,18 +136,85 @@ class Database(ABC):
         """
         raise NotImplementedError("add_vector must be implemented in subclasses.")
 
+    def add_vectors(self, items: List[Tuple[str, np.array]]):
+        """add vectors of several files at once
+
+        Args:
+            items (List[Tuple[str, np.array]]): list of (filename, vectors)
+        """
+        for filename, vectors in items:
+            self.add_vector(filename, vectors)
+
     @abstractmethod
-    def search(self, query: np.array, k: int = 5) -> List[Tuple[str, int, float]]:
+    def search(
+        self,
+        query: np.array,
+        files: Optional[Collection[str]] = None,
+        topk: Optional[int] = None,
+        select: bool = True,
+    ) -> List[Tuple[str, int, float]]:
         """search for top k vectors with max similarity
 
+        Results less similar than `min_similarity` are dropped. If `mmr_lambda` or
+        `max_chunks_per_file` is set, `search_candidates` vectors are searched and
+        top k of them are selected by maximal marginal relevance or by similarity,
+        with at most `max_chunks_per_file` results from one file.
+
         Args:
             query_vector: query vector
+            files (Optional[Collection[str]], optional): only vectors of these files
+                are searched. Defaults to None, all files.
+            topk (Optional[int], optional): max number of results. Defaults to None, self.topk.
+            select (bool, optional): apply min_similarity, mmr and max_chunks_per_file,
+                otherwise the top k vectors are returned. Defaults to True.
 
         Returns:
             List[Tuple[str, int, float]]: a list of (filename, chunk id, similarity)
         """
         raise NotImplementedError("search must be implemented in subclasses.")
 
+    def search_batch(
+        self,
+        query_vectors: np.array,
+        files: Optional[Collection[str]] = None,
+        topk: Optional[int] = None,
+        select: bool = True,
+    ) -> List[List[Tuple[str, int, float]]]:
+        """search for top k vectors of each query
+
+        Args:
+            query_vectors (np.array): query vectors, shape like [num of queries, dimension]
+            files (Optional[Collection[str]], optional): only vectors of these files
+                are searched. Defaults to None, all files.
+            topk (Optional[int], optional): number of results. Defaults to None, self.topk.
+            select (bool, optional): see search. Defaults to True.
+
+        Returns:
+            List[List[Tuple[str, int, float]]]: results of each query, in input order
+        """
+        return [
+            self.search(query_vectors[i : i + 1], files, topk, select)
+            for i in range(len(query_vectors))
+        ]
+
+    def select(
+        self, query: np.array, candidates: List[Tuple[str, int, float]], topk: int
+    ) -> List[Tuple[str, int, float]]:
+        """apply min_similarity, mmr and max_chunks_per_file to candidates found by
+        any retriever, such as results fused with keyword search
+
+        Args:
+            query (np.array): query vector, shape like [1, dimension]
+            candidates (List[Tuple[str, int, float]]): (filename, chunk id, score),
+                best first, scores are ignored
+            topk (int): max number of results
+
+        Returns:
+            List[Tuple[str, int, float]]: a list of (filename, chunk id, similarity),
+                in candidate order or mmr order
+        """
+        raise NotImplementedError("select must be implemented in subclasses.")
+
     @classmethod
     def from_config(cls, config: DocConfig):
         """create subclass instance from config
@@ -77,6 +242,30 @@ class Database(ABC):
             )
         return derived_class(config)
 
+    def prepare_save(self):
+        """make in-place changes needed by save, so that save only reads the
+        database and can run alongside searches"""
+        pass
+
+    def save(self, data_dir: str):
+        """save database to data directory, after prepare_save
+
+        Args:
+            data_dir (str): data directory
+        """
+        raise NotImplementedError("save must be implemented in subclasses.")
+
+    def load(self, data_dir: str) -> bool:
+        """load database saved in data directory
+
+        Args:
+            data_dir (str): data directory
+
+        Returns:
+            bool: False if nothing is saved in data_dir
+        """
+        raise NotImplementedError("load must be implemented in subclasses.")
+
     def remove_vectors(self, filename: str):
         """remove vectors by filename
 
@@ -85,6 +274,31 @@ class Database(ABC):
         """
         self.index_map.pop(filename)
 
+    def update_vectors(self, filename: str, sources: np.array, vectors: np.array):
+        """replace vectors of a file, reusing the vectors of unchanged chunks
+
+        Args:
+            filename (str): filename
+            sources (np.array): for each new chunk, id of the old chunk whose vector
+                is reused, or -1 if it is new
+            vectors (np.array): embeddings of new chunks, in order, shape like
+                [number of -1 in sources, dimension]
+        """
+        raise NotImplementedError("update_vectors must be implemented in subclasses.")
+
+    def candidate_num(self, topk: int) -> int:
+        """number of candidates searched for topk results
+
+        Args:
+            topk (int): number of results
+
+        Returns:
+            int: candidate num
+        """
+        if self.mmr_lambda is None and self.max_chunks_per_file <= 0:
+            return topk
+        return max(topk, self.search_candidates)
+
     def update_topk(self, topk: int):
         """update topk param while retrieval
 
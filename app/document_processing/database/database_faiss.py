@@ -1,39 +1,591 @@
-from typing import List, Tuple
+import json
+import os
+from abc import abstractmethod
+from typing import Any, Collection, Dict, List, Optional, Tuple
 
 import faiss
 import numpy as np
-from app.document_processing.database.database import Database
+from app.document_processing.database.database import (
+    Database, limit_per_group, maximal_marginal_relevance)
 from app.engine.config import DocConfig
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+INDEX_FILENAME = "index.faiss"
+ID_TABLE_FILENAME = "id_table.npy"
+DATABASE_META_FILENAME = "database.json"
+
+FAISS_METRIC_MAP = {
+    "l2": faiss.METRIC_L2,
+    "ip": faiss.METRIC_INNER_PRODUCT,
+    "cosine": faiss.METRIC_INNER_PRODUCT,
+}
+# bytes per vector component of each storage: float32 4, float16 2, sq8 1
+SCALAR_QUANTIZER_TYPE_MAP = {
+    "float16": faiss.ScalarQuantizer.QT_fp16,
+    "sq8": faiss.ScalarQuantizer.QT_8bit,
+}
+VECTOR_STORAGES = ("float32", *SCALAR_QUANTIZER_TYPE_MAP)
+# sq8 ranges of each component are trained once this many vectors have arrived
+SQ8_TRAIN_THRESHOLD = 1000
+
 
 class DatabaseFaiss(Database):
+    """faiss database searching all vectors exactly
+
+    Vectors of all files share one global index. With sq8 storage, vectors are kept
+    in float32 until `train_threshold` vectors have arrived, then the ranges of
+    components are trained with them and the index is replaced by an 8 bit one.
+    """
+
     def __init__(self, config: DocConfig):
         super().__init__(config)
+        self.faiss_metric = FAISS_METRIC_MAP[self.metric]
+        self.vector_storage = config.vector_storage.lower()
+        if self.vector_storage not in VECTOR_STORAGES:
+            logger.error(
+                f"Invalid vector storage: {config.vector_storage}, should be one of {VECTOR_STORAGES}"
+            )
+            raise ValueError()
+        self.index = self._create_index()
+        self.train_threshold = config.train_threshold or self._default_train_threshold()
+        self.trained = False
+        # id table, indexed by vector id: position of filename in self.files and chunk id
+        # removed vectors are marked with file position -1
+        self.id_file = np.empty(0, dtype=np.int32)
+        self.id_chunk = np.empty(0, dtype=np.int32)
+        self.files: List[str] = []
+        self.file_pos: Dict[str, int] = {}
+        self.next_id = 0
+        # path of the index file, if index and id table are memory-mapped from it
+        self.mmap_path = None
+
+    def _create_index(self) -> faiss.Index:
+        """create the global index shared by all files
+
+        Returns:
+            faiss.Index: index supporting add_with_ids and remove_ids
+        """
+        return faiss.IndexIDMap2(self._create_flat_index())
+
+    def _create_flat_index(self) -> faiss.Index:
+        """create an exact index which needs no training, float16 storage is kept,
+        sq8 storage is float32 until trained
+
+        Returns:
+            faiss.Index: flat or float16 scalar quantizer index
+        """
+        if self.vector_storage != "float16":
+            return faiss.IndexFlat(self.dimension, self.faiss_metric)
+        return faiss.IndexScalarQuantizer(
+            self.dimension, faiss.ScalarQuantizer.QT_fp16, self.faiss_metric
+        )
+
+    def _create_trained_index(self) -> Optional[faiss.Index]:
+        """create an empty index which is trained and replaces the flat index once
+        `train_threshold` vectors have arrived
+
+        Returns:
+            Optional[faiss.Index]: index supporting add_with_ids, None if no
+                training is needed
+        """
+        if self.vector_storage != "sq8":
+            return None
+        return faiss.IndexIDMap2(
+            faiss.IndexScalarQuantizer(
+                self.dimension, faiss.ScalarQuantizer.QT_8bit, self.faiss_metric
+            )
+        )
+
+    def _default_train_threshold(self) -> int:
+        """number of vectors needed before building the trained index
+
+        Returns:
+            int: threshold
+        """
+        return SQ8_TRAIN_THRESHOLD
+
+    def _get_all_vectors(self) -> Tuple[np.array, np.array]:
+        """get all vectors stored in the current IndexIDMap2
+
+        Returns:
+            Tuple[np.array, np.array]: (vectors, vector ids)
+        """
+        ids = faiss.vector_to_array(self.index.id_map).astype(np.int64)
+        vectors = self.index.index.reconstruct_n(0, self.index.ntotal)
+        return vectors, ids
+
+    def _train_if_ready(self):
+        """train the index with all vectors and replace the flat index, once
+        `train_threshold` vectors have arrived"""
+        if self.trained or self.index.ntotal < self.train_threshold:
+            return
+        index = self._create_trained_index()
+        if index is None:
+            return
+        vectors, ids = self._get_all_vectors()
+        logger.info(f"Build {self.__class__.__name__} index with {len(ids)} vectors")
+        index.train(vectors)
+        index.add_with_ids(vectors, ids)
+        self.index = index
+        self.trained = True
+
+    def _prepare_vectors(self, vectors: np.array) -> np.array:
+        """convert vectors to contiguous float32, normalised for cosine metric
+
+        Args:
+            vectors (np.array): vectors, shape like [num of vectors, dimension]
+
+        Returns:
+            np.array: vectors passed to faiss, input is never modified
+        """
+        if self.metric != "cosine":
+            return np.ascontiguousarray(vectors, dtype=np.float32)
+        vectors = np.array(vectors, dtype=np.float32, order="C")
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def _to_similarity(self, distances: np.array) -> np.array:
+        """translate faiss distances into similarities, larger is more similar
+
+        Args:
+            distances (np.array): distances returned by faiss
+
+        Returns:
+            np.array: similarities
+        """
+        if self.faiss_metric == faiss.METRIC_L2:
+            return 1 - distances / 2
+        return distances
+
+    def _reserve_ids(self, size: int):
+        """grow id table so that it can hold `size` ids
+
+        Args:
+            size (int): required size
+        """
+        capacity = len(self.id_file)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 1024)
+        grow = capacity - len(self.id_file)
+        self.id_file = np.concatenate([self.id_file, np.full(grow, -1, dtype=np.int32)])
+        self.id_chunk = np.concatenate(
+            [self.id_chunk, np.full(grow, -1, dtype=np.int32)]
+        )
+
+    def _get_file_pos(self, filename: str) -> int:
+        """intern filename into self.files
+
+        Args:
+            filename (str): filename
+
+        Returns:
+            int: position of filename in self.files
+        """
+        if filename not in self.file_pos:
+            self.file_pos[filename] = len(self.files)
+            self.files.append(filename)
+        return self.file_pos[filename]
+
+    def _ensure_writable(self):
+        """replace memory-mapped index and id table with in-memory copies before
+        modifying them, memory-mapped faiss indexes may be read-only"""
+        if self.mmap_path is None:
+            return
+        logger.info(f"Load index {self.mmap_path} into memory")
+        self.index = faiss.read_index(self.mmap_path)
+        self.id_file = np.array(self.id_file)
+        self.id_chunk = np.array(self.id_chunk)
+        self.mmap_path = None
 
     def add_vector(self, filename: str, vectors: np.array):
-        if self.dimension != vectors.shape[1]:
+        self.add_vectors([(filename, vectors)])
+
+    def _add_to_index(self, vectors: List[np.array]) -> np.array:
+        """add vectors to faiss index with new ids
+
+        Args:
+            vectors (List[np.array]): embeddings, each shape like [num of vectors, dimension]
+
+        Raises:
+            ValueError: dimension mismatch
+
+        Returns:
+            np.array: ids of the added vectors
+        """
+        for v in vectors:
+            if self.dimension != v.shape[1]:
+                logger.error(
+                    f"Dimension mismatch! Database dimension is {self.dimension} and embeddings dimension is {v.shape[1]}"
+                )
+                raise ValueError()
+        num = sum(v.shape[0] for v in vectors)
+        ids = np.arange(self.next_id, self.next_id + num, dtype=np.int64)
+        if num:
+            self.index.add_with_ids(self._prepare_vectors(np.concatenate(vectors)), ids)
+        self.next_id += num
+        self._reserve_ids(self.next_id)
+        return ids
+
+    def add_vectors(self, items: List[Tuple[str, np.array]]):
+        if not items:
+            return
+        self._ensure_writable()
+        ids = self._add_to_index([vectors for _, vectors in items])
+        start = 0
+        for filename, vectors in items:
+            file_ids = ids[start : start + vectors.shape[0]]
+            self.id_file[file_ids] = self._get_file_pos(filename)
+            self.id_chunk[file_ids] = np.arange(len(file_ids), dtype=np.int32)
+            self.index_map[filename] = file_ids
+            start += len(file_ids)
+        self._train_if_ready()
+
+    def update_vectors(self, filename: str, sources: np.array, vectors: np.array):
+        self._ensure_writable()
+        old_ids = self.index_map.get(filename, np.empty(0, dtype=np.int64))
+        reused = sources >= 0
+        ids = np.empty(len(sources), dtype=np.int64)
+        ids[reused] = old_ids[sources[reused]]
+        ids[~reused] = self._add_to_index([vectors])
+        self.id_file[ids] = self._get_file_pos(filename)
+        self.id_chunk[ids] = np.arange(len(ids), dtype=np.int32)
+        self.index_map[filename] = ids
+
+        removed = np.setdiff1d(old_ids, ids[reused])
+        if len(removed):
+            self.id_file[removed] = -1
+            self.id_chunk[removed] = -1
+            self._remove_ids(removed)
+        self._train_if_ready()
+
+    def remove_vectors(self, filename: str):
+        self._ensure_writable()
+        ids = self.index_map.pop(filename)
+        self.id_file[ids] = -1
+        self.id_chunk[ids] = -1
+        self._remove_ids(ids)
+
+    def _remove_ids(self, ids: np.array):
+        """remove vectors from faiss index
+
+        Args:
+            ids (np.array): vector ids
+        """
+        self.index.remove_ids(ids)
+
+    def _search_num(self, topk: int) -> int:
+        """number of neighbours requested from faiss for each query
+
+        Args:
+            topk (int): number of results
+
+        Returns:
+            int: search num
+        """
+        return min(topk, self.index.ntotal)
+
+    def _get_state(self) -> Dict[str, Any]:
+        """state saved beside index and id table
+
+        Returns:
+            Dict[str, Any]: json serializable state
+        """
+        return {
+            "files": self.files,
+            "next_id": self.next_id,
+            "metric": self.metric,
+            "vector_storage": self.vector_storage,
+            "trained": self.trained,
+        }
+
+    def _set_state(self, state: Dict[str, Any]):
+        """restore state returned by _get_state
+
+        Args:
+            state (Dict[str, Any]): state
+        """
+        # indexes saved before metric and storage were configurable are l2 float32
+        saved = (state.get("metric", "l2"), state.get("vector_storage", "float32"))
+        if saved != (self.metric, self.vector_storage):
             logger.error(
-                f"Dimension mismatch! Database dimension is {self.dimension} and embeddings dimension is {len[vectors[0]]}"
+                f"Saved index uses metric {saved[0]} and storage {saved[1]}, "
+                f"but {self.metric} and {self.vector_storage} are configured"
             )
             raise ValueError()
-        self.index_map[filename] = faiss.IndexFlatL2(self.dimension)
-        self.index_map[filename].add(vectors)
+        self.files = state["files"]
+        self.file_pos = {filename: pos for pos, filename in enumerate(self.files)}
+        self.next_id = state["next_id"]
+        self.trained = state.get("trained", False)
+
+    def prepare_save(self):
+        # memory-mapped files can not be replaced on windows
+        self._ensure_writable()
+
+    def save(self, data_dir: str):
+        self.prepare_save()
+        index_path = os.path.join(data_dir, INDEX_FILENAME)
+        id_table_path = os.path.join(data_dir, ID_TABLE_FILENAME)
+        meta_path = os.path.join(data_dir, DATABASE_META_FILENAME)
+
+        faiss.write_index(self.index, index_path + ".tmp")
+        with open(id_table_path + ".tmp", "wb") as f:
+            np.save(f, np.stack([self.id_file, self.id_chunk])[:, : self.next_id])
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self._get_state(), f, ensure_ascii=False)
+        for path in [index_path, id_table_path, meta_path]:
+            os.replace(path + ".tmp", path)
+
+    def load(self, data_dir: str) -> bool:
+        index_path = os.path.join(data_dir, INDEX_FILENAME)
+        if not os.path.exists(index_path):
+            return False
+        # pages of index and id table are read on demand. IO_FLAG_MMAP only maps
+        # inverted lists, IO_FLAG_MMAP_IFC also maps codes of flat, sq and hnsw indexes
+        self.index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC)
+        self.mmap_path = index_path
+        id_table = np.load(os.path.join(data_dir, ID_TABLE_FILENAME), mmap_mode="r")
+        self.id_file, self.id_chunk = id_table[0], id_table[1]
+        with open(
+            os.path.join(data_dir, DATABASE_META_FILENAME), "r", encoding="utf-8"
+        ) as f:
+            self._set_state(json.load(f))
+
+        # group alive ids by file, ids of a file are in chunk order
+        alive = np.flatnonzero(self.id_file >= 0).astype(np.int64)
+        file_of = self.id_file[alive]
+        order = np.lexsort((self.id_chunk[alive], file_of))
+        alive, file_of = alive[order], file_of[order]
+        self.index_map = {}
+        for ids in np.split(alive, np.flatnonzero(np.diff(file_of)) + 1):
+            if len(ids):
+                self.index_map[self.files[self.id_file[ids[0]]]] = ids
+        logger.info(
+            f"Load {len(alive)} vectors of {len(self.index_map)} files from {data_dir}"
+        )
+        return True
+
+    def _select_results(
+        self,
+        query: np.array,
+        ids: np.array,
+        similarities: np.array,
+        topk: int,
+        vectors: Optional[np.array] = None,
+    ) -> List[Tuple[str, int, float]]:
+        """apply min_similarity, mmr and max_chunks_per_file to candidates and
+        translate them into (filename, chunk id, similarity)
+
+        Args:
+            query (np.array): query vector passed to faiss, shape like [dimension]
+            ids (np.array): vector ids of alive candidates, best first
+            similarities (np.array): similarity of each candidate
+            topk (int): max number of results
+            vectors (Optional[np.array], optional): vectors of candidates,
+                reconstructed from index if needed. Defaults to None.
+
+        Returns:
+            List[Tuple[str, int, float]]: a list of (filename, chunk id, similarity)
+        """
+        if self.min_similarity is not None:
+            keep = similarities >= self.min_similarity
+            ids, similarities = ids[keep], similarities[keep]
+            if vectors is not None:
+                vectors = vectors[keep]
+        file_of = self.id_file[ids]
+        if self.mmr_lambda is not None and len(ids) > 1:
+            if vectors is None:
+                vectors = self._reconstruct(ids)
+            selected = maximal_marginal_relevance(
+                query,
+                vectors,
+                topk,
+                self.mmr_lambda,
+                file_of,
+                self.max_chunks_per_file,
+            )
+        else:
+            selected = limit_per_group(file_of, topk, self.max_chunks_per_file)
+        return [
+            (
+                self.files[file_of[i]],
+                int(self.id_chunk[ids[i]]),
+                float(similarities[i]),
+            )
+            for i in selected
+        ]
+
+    def _make_results(
+        self,
+        query: np.array,
+        distances: np.array,
+        ids: np.array,
+        topk: int,
+        select: bool,
+    ) -> List[Tuple[str, int, float]]:
+        """translate faiss search result of one query into (filename, chunk id, similarity)
+
+        Args:
+            query (np.array): query vector passed to faiss
+            distances (np.array): distances of one query
+            ids (np.array): vector ids of one query, -1 for empty slots
+            topk (int): max number of results
+            select (bool): apply min_similarity, mmr and max_chunks_per_file
+
+        Returns:
+            List[Tuple[str, int, float]]: a list of (filename, chunk id, similarity)
+        """
+        similarities = self._to_similarity(distances)
+        keep = ids >= 0
+        keep[keep] = self.id_file[ids[keep]] >= 0
+        ids, similarities = ids[keep], similarities[keep]
+        if select:
+            return self._select_results(query, ids, similarities, topk)
+        return [
+            (self.files[self.id_file[idx]], int(self.id_chunk[idx]), similarity)
+            for idx, similarity in zip(ids[:topk], similarities[:topk].tolist())
+        ]
 
-    def search(self, query_vector: np.array) -> List[Tuple[str, int, float]]:
+    def select(
+        self, query: np.array, candidates: List[Tuple[str, int, float]], topk: int
+    ) -> List[Tuple[str, int, float]]:
+        ids = np.array(
+            [
+                self.index_map[filename][chunk_id]
+                for filename, chunk_id, _ in candidates
+                if filename in self.index_map
+                and chunk_id < len(self.index_map[filename])
+            ],
+            dtype=np.int64,
+        )
+        if not len(ids):
+            return []
+        query = self._prepare_vectors(query)[0]
+        vectors = self._reconstruct(ids)
+        if self.faiss_metric == faiss.METRIC_L2:
+            similarities = 1 - ((vectors - query) ** 2).sum(axis=1) / 2
+        else:
+            similarities = vectors @ query
+        return self._select_results(query, ids, similarities, topk, vectors)
+
+    def _reconstruct(self, ids: np.array) -> np.array:
+        """get stored vectors by id
+
+        Args:
+            ids (np.array): vector ids
+
+        Returns:
+            np.array: vectors, shape like [num of ids, dimension]
+        """
+        return self.index.reconstruct_batch(ids)
+
+    def _search_index(
+        self,
+        query_vectors: np.array,
+        search_num: int,
+        params: Optional[faiss.SearchParameters],
+    ) -> Tuple[np.array, np.array]:
+        """search faiss index
+
+        Args:
+            query_vectors (np.array): prepared queries
+            search_num (int): number of neighbours of each query
+            params (Optional[faiss.SearchParameters]): search parameters
+
+        Returns:
+            Tuple[np.array, np.array]: (distances, ids), -1 for empty slots
+        """
+        return self.index.search(query_vectors, search_num, params=params)
+
+    def _make_search_params(self, selector: faiss.IDSelector) -> faiss.SearchParameters:
+        """make search parameters of the current index restricted to selector
+
+        Args:
+            selector (faiss.IDSelector): selected vector ids
+
+        Returns:
+            faiss.SearchParameters: search parameters
+        """
+        return faiss.SearchParameters(sel=selector)
+
+    def _default_search_params(self) -> Optional[faiss.SearchParameters]:
+        """search parameters of searches over all files
+
+        Returns:
+            Optional[faiss.SearchParameters]: None to search with index defaults
+        """
+        return None
+
+    def search(
+        self,
+        query_vector: np.array,
+        files: Optional[Collection[str]] = None,
+        topk: Optional[int] = None,
+        select: bool = True,
+    ) -> List[Tuple[str, int, float]]:
+        return self.search_batch(query_vector, files, topk, select)[0]
+
+    def search_batch(
+        self,
+        query_vectors: np.array,
+        files: Optional[Collection[str]] = None,
+        topk: Optional[int] = None,
+        select: bool = True,
+    ) -> List[List[Tuple[str, int, float]]]:
         if not self.index_map:
             logger.warning("No vectors in the database to search.")
-            return {}
+            return [[] for _ in range(len(query_vectors))]
+
+        topk = self.topk if topk is None else topk
+        search_num = self._search_num(self.candidate_num(topk) if select else topk)
+        params = self._default_search_params()
+        if files is not None:
+            ids = [self.index_map[f] for f in files if f in self.index_map]
+            if not ids:
+                return [[] for _ in range(len(query_vectors))]
+            ids = np.concatenate(ids).astype(np.int64)
+            selector = faiss.IDSelectorBatch(ids)
+            params = self._make_search_params(selector)
+            search_num = min(search_num, len(ids))
+
+        query_vectors = self._prepare_vectors(query_vectors)
+        distances, indices = self._search_index(query_vectors, search_num, params)
+        return [
+            self._make_results(query_vectors[i], distances[i], indices[i], topk, select)
+            for i in range(len(query_vectors))
+        ]
+
+
+class DatabaseFaissAnn(DatabaseFaiss):
+    """faiss database backed by an approximate index
+
+    The approximate index is trained and built once `train_threshold` vectors have
+    arrived. Before that, vectors live in the exact flat index of DatabaseFaiss.
+    """
+
+    @abstractmethod
+    def _create_ann_index(self) -> faiss.Index:
+        """create an empty approximate index, supporting add_with_ids
+
+        Returns:
+            faiss.Index: approximate index
+        """
+        raise NotImplementedError(
+            "_create_ann_index must be implemented in subclasses."
+        )
 
-        global_results = []
+    @abstractmethod
+    def _default_train_threshold(self) -> int:
+        """number of vectors needed before building the approximate index
 
-        for filename, index in self.index_map.items():
-            num = index.ntotal if index.ntotal < self.topk else self.topk
-            distances, indices = index.search(query_vector, num)
-            for i, idx in enumerate(indices[0]):
-                global_results.append((filename, idx, distances[0][i]))
+        Returns:
+            int: threshold
+        """
+        raise NotImplementedError(
+            "_default_train_threshold must be implemented in subclasses."
+        )
 
-            global_results.sort(key=lambda x: x[2])
-        return global_results[: min(self.topk, len(global_results))]
+    def _create_trained_index(self) -> faiss.Index:
+        return self._create_ann_index()
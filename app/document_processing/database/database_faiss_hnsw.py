@@ -0,0 +1,93 @@
+from typing import Any, Dict, Optional, Tuple
+
+import faiss
+import numpy as np
+from app.document_processing.database.database_faiss import (
+    SCALAR_QUANTIZER_TYPE_MAP, DatabaseFaissAnn)
+from app.engine.config import DocConfig
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# rebuild the graph once this ratio of vectors in it has been removed
+HNSW_REBUILD_RATIO = 0.2
+
+
+class DatabaseFaissHNSW(DatabaseFaissAnn):
+    def __init__(self, config: DocConfig):
+        self.hnsw_m = config.hnsw_m
+        self.ef_construction = config.ef_construction
+        self.ef_search = config.ef_search
+        # vectors removed from id table but still in the graph
+        self.num_deleted = 0
+        # (next id, num deleted, bitmap, selector) of alive ids, rebuilt on change
+        self._alive_selector: Optional[Tuple[int, int, np.ndarray, faiss.IDSelector]] = None
+        super().__init__(config)
+
+    def _default_train_threshold(self) -> int:
+        # brute force is fast enough for small collections
+        return 10000
+
+    def _create_ann_index(self) -> faiss.Index:
+        if self.vector_storage == "float32":
+            index = faiss.IndexHNSWFlat(self.dimension, self.hnsw_m, self.faiss_metric)
+        else:
+            # sq8 ranges are trained with the vectors when the graph is built
+            index = faiss.IndexHNSWSQ(
+                self.dimension,
+                SCALAR_QUANTIZER_TYPE_MAP[self.vector_storage],
+                self.hnsw_m,
+                self.faiss_metric,
+            )
+        index.hnsw.efConstruction = self.ef_construction
+        index.hnsw.efSearch = self.ef_search
+        return faiss.IndexIDMap2(index)
+
+    def _remove_ids(self, ids: np.array):
+        if not self.trained:
+            super()._remove_ids(ids)
+            return
+        # hnsw does not support remove_ids, removed ids are skipped while searching
+        self.num_deleted += len(ids)
+        if self.num_deleted > HNSW_REBUILD_RATIO * self.index.ntotal:
+            self._rebuild()
+
+    def _rebuild(self):
+        """rebuild the graph without removed vectors"""
+        vectors, ids = self._get_all_vectors()
+        alive = self.id_file[ids] >= 0
+        logger.info(f"Rebuild hnsw index, drop {len(ids) - alive.sum()} vectors")
+        index = self._create_ann_index()
+        index.train(vectors[alive])
+        index.add_with_ids(vectors[alive], ids[alive])
+        self.index = index
+        self.num_deleted = 0
+
+    def _get_state(self) -> Dict[str, Any]:
+        return {**super()._get_state(), "num_deleted": self.num_deleted}
+
+    def _set_state(self, state: Dict[str, Any]):
+        super()._set_state(state)
+        self.num_deleted = state.get("num_deleted", 0)
+        self._alive_selector = None
+        if self.trained:
+            faiss.downcast_index(self.index.index).hnsw.efSearch = self.ef_search
+
+    def _make_search_params(self, selector: faiss.IDSelector) -> faiss.SearchParameters:
+        if not self.trained:
+            return super()._make_search_params(selector)
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=self.ef_search)
+
+    def _default_search_params(self) -> Optional[faiss.SearchParameters]:
+        if not self.trained or not self.num_deleted:
+            return None
+        # removed vectors are skipped in graph traversal, instead of requesting
+        # num_deleted more neighbours and dropping them afterwards
+        cached = self._alive_selector
+        if cached is None or cached[:2] != (self.next_id, self.num_deleted):
+            bitmap = np.packbits(self.id_file[: self.next_id] >= 0, bitorder="little")
+            selector = faiss.IDSelectorBitmap(self.next_id, faiss.swig_ptr(bitmap))
+            # bitmap is kept referenced as long as the selector
+            cached = (self.next_id, self.num_deleted, bitmap, selector)
+            self._alive_selector = cached
+        return self._make_search_params(cached[3])
@@ -0,0 +1,146 @@
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from app.document_processing.database.database_faiss import DatabaseFaissAnn
+from app.engine.config import DocConfig
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+REFINE_INDEX_FILENAME = "refine.faiss"
+
+
+class DatabaseFaissIVFPQ(DatabaseFaissAnn):
+    """IVF index of product quantized vectors
+
+    Distances of pq codes are coarse, so `refine_factor` times more candidates are
+    searched and re-ranked by exact distances. The exact vectors are kept in the
+    flat index used before training, which is memory-mapped with the index after
+    loading, so only pages of candidates are read.
+    """
+
+    def __init__(self, config: DocConfig):
+        if config.dimension % config.pq_m != 0:
+            logger.error(
+                f"Dimension {config.dimension} is not divisible by pq_m {config.pq_m}"
+            )
+            raise ValueError()
+        self.nlist = config.nlist
+        self.nprobe = config.nprobe
+        self.pq_m = config.pq_m
+        self.pq_nbits = config.pq_nbits
+        self.refine_factor = config.refine_factor
+        # exact vectors of the trained index, None if candidates are not re-ranked
+        self.refine_index: Optional[faiss.Index] = None
+        self._refine_saved = False
+        super().__init__(config)
+
+    def _default_train_threshold(self) -> int:
+        # faiss warns when there are less than 39 training points per centroid
+        return 39 * max(self.nlist, 2**self.pq_nbits)
+
+    def _create_ann_index(self) -> faiss.Index:
+        index = faiss.index_factory(
+            self.dimension,
+            f"IVF{self.nlist},PQ{self.pq_m}x{self.pq_nbits}",
+            self.faiss_metric,
+        )
+        index.nprobe = self.nprobe
+        # required by remove_ids and reconstruct
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return index
+
+    def _train_if_ready(self):
+        flat = self.index
+        super()._train_if_ready()
+        if self.trained and self.index is not flat and self.refine_factor > 0:
+            self.refine_index = flat
+
+    def _add_to_index(self, vectors: List[np.array]) -> np.array:
+        ids = super()._add_to_index(vectors)
+        if self.refine_index is not None and len(ids):
+            self.refine_index.add_with_ids(
+                self._prepare_vectors(np.concatenate(vectors)), ids
+            )
+        return ids
+
+    def _remove_ids(self, ids: np.array):
+        super()._remove_ids(ids)
+        if self.refine_index is not None:
+            self.refine_index.remove_ids(ids)
+
+    def _reconstruct(self, ids: np.array) -> np.array:
+        if self.refine_index is None:
+            return super()._reconstruct(ids)
+        return self.refine_index.reconstruct_batch(ids)
+
+    def _search_index(
+        self,
+        query_vectors: np.array,
+        search_num: int,
+        params: Optional[faiss.SearchParameters],
+    ) -> Tuple[np.array, np.array]:
+        if self.refine_index is None:
+            return super()._search_index(query_vectors, search_num, params)
+        num = min(search_num * self.refine_factor, self.index.ntotal)
+        _, candidates = self.index.search(query_vectors, num, params=params)
+        distances = np.zeros((len(query_vectors), search_num), dtype=np.float32)
+        indices = np.full((len(query_vectors), search_num), -1, dtype=np.int64)
+        for i, query in enumerate(query_vectors):
+            ids = candidates[i][candidates[i] >= 0]
+            vectors = self.refine_index.reconstruct_batch(ids)
+            if self.faiss_metric == faiss.METRIC_L2:
+                exact = ((vectors - query) ** 2).sum(axis=1)
+                order = np.argsort(exact)[:search_num]
+            else:
+                exact = vectors @ query
+                order = np.argsort(-exact)[:search_num]
+            distances[i, : len(order)] = exact[order]
+            indices[i, : len(order)] = ids[order]
+        return distances, indices
+
+    def _get_state(self) -> Dict[str, Any]:
+        return {**super()._get_state(), "refine": self.refine_index is not None}
+
+    def _set_state(self, state: Dict[str, Any]):
+        super()._set_state(state)
+        self._refine_saved = state.get("refine", False)
+        if self.trained:
+            self.index.nprobe = self.nprobe
+
+    def _ensure_writable(self):
+        if self.mmap_path is not None and self.refine_index is not None:
+            self.refine_index = faiss.read_index(
+                os.path.join(os.path.dirname(self.mmap_path), REFINE_INDEX_FILENAME)
+            )
+        super()._ensure_writable()
+
+    def save(self, data_dir: str):
+        self.prepare_save()
+        refine_path = os.path.join(data_dir, REFINE_INDEX_FILENAME)
+        if self.refine_index is not None:
+            faiss.write_index(self.refine_index, refine_path + ".tmp")
+        super().save(data_dir)
+        if self.refine_index is not None:
+            os.replace(refine_path + ".tmp", refine_path)
+
+    def load(self, data_dir: str) -> bool:
+        self.refine_index = None
+        if not super().load(data_dir):
+            return False
+        if not self.trained or self.refine_factor <= 0:
+            return True
+        if not self._refine_saved:
+            logger.info("Index is saved without exact vectors, candidates are not re-ranked")
+            return True
+        self.refine_index = faiss.read_index(
+            os.path.join(data_dir, REFINE_INDEX_FILENAME), faiss.IO_FLAG_MMAP_IFC
+        )
+        return True
+
+    def _make_search_params(self, selector: faiss.IDSelector) -> faiss.SearchParameters:
+        if not self.trained:
+            return super()._make_search_params(selector)
+        return faiss.SearchParametersIVF(sel=selector, nprobe=self.nprobe)
@@ -1,33 +1,48 @@
+import asyncio
+import atexit
+import hashlib
+import importlib.util
 import os
 import re
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Tuple, Union
+from typing import (Callable, Dict, Iterable, Iterator, List, Optional, Tuple,
+                    Union)
 
 import numpy as np
-import pdfplumber  # for PDF
+from app.document_processing.chunk_store import ChunkStore
 from app.document_processing.database.database import Database
 from app.document_processing.embedder import Embedder
+from app.document_processing.sparse_index import (BM25Index,
+                                                  reciprocal_rank_fusion)
 from app.document_processing.splitter.doc_splitter import DocSplitterBase
 from app.engine.config import DocConfig
 from app.utils.logger import get_logger
+from app.utils.rwlock import ReadWriteLock
 
 logger = get_logger(__name__)
 
-try:
-    from docx import Document  # for DOCX
-
-    support_docx = True
-except:
-    logger.warning("Module docx is unavailable!")
-    support_docx = False
-
 
 def check_if_support_docx() -> bool:
+    # docx is imported when a docx file is loaded
+    support_docx = importlib.util.find_spec("docx") is not None
+    if not support_docx:
+        logger.warning("Module docx is unavailable!")
     return support_docx
 
 
-def load_document(file_path: Union[str, Path]) -> str:
-    """load and extract file
+# number of characters read at a time from text files
+TEXT_BLOCK_SIZE = 1 << 20
+
+
+def iter_document(file_path: Union[str, Path]) -> Iterator[str]:
+    """load and extract file block by block, a page for PDF, a paragraph for DOCX
+
+    Blocks after the first one start with the separator from the previous block,
+    "\n" between PDF pages and "\n\n" between DOCX paragraphs, so joining them
+    gives the whole text.
 
     Args:
         file_path: file path
@@ -36,7 +51,7 @@ def load_document(file_path: Union[str, Path]) -> str:
         FileNotFoundError: invalid path
         ValueError: invalid file format
 
-    Returns:
+    Yields:
         str: texts in the file
     """
     file_path = Path(file_path)
@@ -44,22 +59,60 @@ def load_document(file_path: Union[str, Path]) -> str:
         raise FileNotFoundError(f"Document not found: {file_path}")
 
     if file_path.suffix == ".pdf":
+        import pdfplumber  # for PDF
+
         with pdfplumber.open(file_path) as pdf:
-            text = "\n".join(page.extract_text() for page in pdf.pages)
+            for i, page in enumerate(pdf.pages):
+                text = page.extract_text() or ""
+                # release parsed objects of the page
+                page.close()
+                yield text if i == 0 else "\n" + text
     elif file_path.suffix == ".docx":
+        from docx import Document  # for DOCX
+
         doc = Document(file_path)
-        text = "\n".join(p.text for p in doc.paragraphs)
+        for i, p in enumerate(doc.paragraphs):
+            yield p.text if i == 0 else "\n\n" + p.text
     elif file_path.suffix == ".txt" or file_path.suffix == ".md":
         with open(file_path, "r", encoding="utf-8") as f:
-            text = f.read()
+            while text := f.read(TEXT_BLOCK_SIZE):
+                yield text
     else:
         raise ValueError(f"Unsupported file format: {file_path.suffix}")
 
-    return text
+
+def load_document(file_path: Union[str, Path]) -> str:
+    """load and extract file
+
+    Args:
+        file_path: file path
+
+    Raises:
+        FileNotFoundError: invalid path
+        ValueError: invalid file format
+
+    Returns:
+        str: texts in the file
+    """
+    return "".join(iter_document(file_path))
+
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+LEADING_WHITESPACE_PATTERN = re.compile(r"\s*")
+
+
+def _normalize_whitespace(whitespace: str) -> str:
+    """a run of whitespace becomes "\n\n" if it separates paragraphs, "\n" if it
+    breaks a line, or a single space"""
+    num_newlines = whitespace.count("\n")
+    if num_newlines >= 2:
+        return "\n\n"
+    return "\n" if num_newlines else " "
 
 
 def clean_text(text: str) -> str:
-    """clean text
+    """clean text, runs of whitespace are collapsed while line breaks and
+    paragraphs are kept for splitters
 
     Args:
         text: input text
@@ -67,31 +120,143 @@ def clean_text(text: str) -> str:
     Returns:
         str: cleaned text
     """
-    text = re.sub(r"\s+", " ", text).strip()
+    text = WHITESPACE_PATTERN.sub(lambda m: _normalize_whitespace(m.group()), text)
     # text = re.sub(r"[^\w\s.,!?-~]", "", text)
-    return text
+    return text.strip()
+
+
+def clean_text_stream(blocks: Iterable[str]) -> Iterator[str]:
+    """clean text block by block, joining the output gives the same result as
+    clean_text on the joined input
+
+    Args:
+        blocks (Iterable[str]): input text blocks
+
+    Yields:
+        str: cleaned text blocks
+    """
+    emitted = False
+    # whitespace pending between the last output and the next one, it may span blocks
+    pending = ""
+    for block in blocks:
+        head = LEADING_WHITESPACE_PATTERN.match(block).end()
+        if head == len(block):
+            if block:
+                pending = _normalize_whitespace(pending + block)
+            continue
+        tail = len(block.rstrip())
+        text = WHITESPACE_PATTERN.sub(
+            lambda m: _normalize_whitespace(m.group()), block[head:tail]
+        )
+        if emitted and (pending or head):
+            text = _normalize_whitespace(pending + block[:head]) + text
+        yield text
+        emitted = True
+        pending = block[tail:]
+
+
+def load_and_clean(file_path: str) -> List[str]:
+    """load and clean a file, run in worker processes while ingesting documents
+
+    Args:
+        file_path (str): file path
+
+    Returns:
+        List[str]: cleaned text blocks
+    """
+    return list(clean_text_stream(iter_document(file_path)))
+
+
+def chunk_hash(text: str) -> bytes:
+    """hash of a chunk, chunks with the same hash keep their vectors while a
+    document is updated"""
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+@dataclass
+class IngestResult:
+    """result of adding one document"""
+
+    file_path: str
+    success: bool
+    num_chunks: int = 0
+    error: Optional[str] = None
 
 
 class DocProcessor:
     """document processor"""
 
     def __init__(self, config: DocConfig):
-        # Dict[filename, Dict[chunk id, text]]
-        self.doc_chunk_map: Dict[str, Dict[int, str]] = {}
+        # (filename, chunk id) -> text, memory-mapped from data_dir when loaded
+        self.chunk_store = ChunkStore()
         self.embedder = Embedder(config)
         self.splitter = DocSplitterBase.from_config(config)
         self.vector_store = Database.from_config(config)
-
-    def _update_doc_map(self, file_path: str, chunks: List[str]):
-        """record each chunk with id and filename
-
-        Args:
-            file_path (str): filename
-            chunks (List[str]): chunks, splitted by splitter
+        # keyword index searched alongside vector_store, None if hybrid search is disabled
+        self.sparse_index = BM25Index() if config.hybrid_search else None
+        self.rrf_k = config.rrf_k
+        # increased whenever documents change
+        self.version = 0
+        self.data_dir = config.data_dir
+        # whether documents changed since they were last saved or loaded
+        self._dirty = False
+        self.ingest_workers = config.ingest_workers
+        self.ingest_insert_batch = config.ingest_insert_batch
+        # guards documents and database, which may be shared by many sessions.
+        # searches share the read lock, changes hold the write lock
+        self._lock = ReadWriteLock()
+        if self.data_dir and ChunkStore.exists(self.data_dir):
+            self._load()
+        if self.data_dir:
+            # changes made since the last save are saved on shutdown
+            atexit.register(self.save)
+
+    def _load(self):
+        """load chunks and vectors saved in data directory"""
+        logger.info(f"Load documents from {self.data_dir}")
+        self.chunk_store.load(self.data_dir)
+        self.vector_store.load(self.data_dir)
+        if self.sparse_index is not None and not self.sparse_index.load(self.data_dir):
+            logger.info("Build sparse index of saved documents")
+            self.sparse_index.add_documents(
+                [
+                    (name, self.chunk_store.get_chunks(name))
+                    for name in self.chunk_store.filenames()
+                ]
+            )
+
+    def save(self):
+        """save chunks and vectors to data directory, if it is configured and
+        documents changed since the last save
+
+        Each save writes the whole index, so documents are saved once per batch of
+        changes, by process_documents, corpus sync, explicit calls and on shutdown,
+        not after every change. In-place changes of saving are made under the write
+        lock, which is then downgraded, so that searches go on while files are
+        written and documents can not change until they are written.
         """
-        self.doc_chunk_map[file_path] = {
-            index: text for index, text in enumerate(chunks)
-        }
+        if not self.data_dir:
+            return
+        self._lock.acquire_write()
+        if not self._dirty:
+            self._lock.release_write()
+            return
+        try:
+            self.vector_store.prepare_save()
+            if self.sparse_index is not None:
+                self.sparse_index.prepare_save()
+            self.chunk_store.prepare_save()
+        finally:
+            self._lock.downgrade()
+        try:
+            os.makedirs(self.data_dir, exist_ok=True)
+            self.vector_store.save(self.data_dir)
+            if self.sparse_index is not None:
+                self.sparse_index.save(self.data_dir)
+            self.chunk_store.save(self.data_dir)
+            self._dirty = False
+        finally:
+            self._lock.release_read()
 
     def _get_chunk_by_name_and_id(self, file_name: str, id: int) -> str:
         """get a text chunk from map
@@ -100,69 +265,482 @@ class DocProcessor:
             file_name (str): file name
             id (int): chunk id
         """
-        if not file_name in self.doc_chunk_map:
-            logger.error(f"Cannot find a file named {file_name} in dict.")
+        if not file_name in self.chunk_store:
+            logger.error(f"Cannot find a file named {file_name} in chunk store.")
             raise FileNotFoundError()
-        if not id in self.doc_chunk_map[file_name]:
+        if not 0 <= id < self.chunk_store.num_chunks(file_name):
             logger.error(f"Invalid chunk id, filename: {file_name}, chunk_id: {id}")
             raise IndexError()
-        return self.doc_chunk_map[file_name][id]
+        return self.chunk_store.get(file_name, id)
 
-    def process_document(self, file_path: str):
+    def process_document(self, file_path: str, save: bool = False):
         """process document and add to database
 
         Args:
             file_path (str): file path
+            save (bool, optional): whether to save data directory. Defaults to False.
         """
-        if file_path in self.doc_chunk_map:
+        if file_path in self.chunk_store:
             logger.warning(f"Found file with the same name {file_path}")
             return
         logger.info(f"Process new file {file_path}")
-        text = load_document(file_path)
-        text = clean_text(text)
-        chunks = self.splitter.split_text(text)
-        self._update_doc_map(file_path, chunks)
-        vectors = self.embedder.embed(chunks)
-        self.vector_store.add_vector(file_path, vectors)
-
-    def remove_document(self, file_path: str):
+        blocks = clean_text_stream(iter_document(file_path))
+        chunks, vectors = self._split_and_embed(blocks)
+        self._commit_documents([(file_path, chunks, vectors)])
+        if save:
+            self.save()
+
+    def _split_and_embed(self, blocks: Iterable[str]) -> Tuple[List[str], np.ndarray]:
+        """split text into chunks and calculate their embeddings, a batch of chunks
+        is sent to embedder as soon as it is split, while later blocks are still
+        being loaded
+
+        Args:
+            blocks (Iterable[str]): cleaned text blocks
+
+        Returns:
+            Tuple[List[str], np.ndarray]: (chunks, embeddings)
+        """
+        chunks = []
+        futures = []
+        batch_size = self.embedder.batch_size
+        # requests of all documents share the request slots of embedder, so this
+        # pool only overlaps splitting with embedding
+        with ThreadPoolExecutor(self.embedder.max_workers) as executor:
+            for chunk in self.splitter.split_stream(blocks):
+                chunks.append(chunk)
+                if len(chunks) % batch_size == 0:
+                    batch = chunks[-batch_size:]
+                    futures.append(executor.submit(self.embedder.embed, batch))
+            if len(chunks) % batch_size:
+                batch = chunks[-(len(chunks) % batch_size) :]
+                futures.append(executor.submit(self.embedder.embed, batch))
+            vectors = [future.result() for future in futures]
+        if not vectors:
+            return chunks, np.empty((0, self.embedder.dimension), dtype=np.float32)
+        return chunks, np.concatenate(vectors)
+
+    def _commit_documents(self, documents: List[Tuple[str, List[str], np.ndarray]]):
+        """add chunks and vectors of documents in one insert, documents are recorded
+        in chunk store only after their vectors are added
+
+        Args:
+            documents (List[Tuple[str, List[str], np.ndarray]]): list of (filename, chunks, embeddings)
+        """
+        if not documents:
+            return
+        with self._lock.write():
+            self.vector_store.add_vectors(
+                [(file_path, vectors) for file_path, _, vectors in documents]
+            )
+            for file_path, chunks, _ in documents:
+                self.chunk_store.add(file_path, chunks)
+            if self.sparse_index is not None:
+                self.sparse_index.add_documents(
+                    [(file_path, chunks) for file_path, chunks, _ in documents]
+                )
+            self.version += 1
+            self._dirty = True
+
+    def process_documents(
+        self,
+        file_paths: List[str],
+        progress_callback: Optional[Callable[[IngestResult, int, int], None]] = None,
+        save: bool = True,
+    ) -> List[IngestResult]:
+        """process documents in parallel and add them to database
+
+        Files are loaded and cleaned in a process pool, split and embedded in a thread
+        pool, and inserted into database in batches. A failed document is not
+        added at all and does not affect the others.
+
+        Args:
+            file_paths (List[str]): file paths
+            progress_callback (Optional[Callable[[IngestResult, int, int], None]]):
+                called with (result, number of finished files, number of files)
+                each time a file finishes
+            save (bool, optional): whether to save data directory once all files
+                are added. Defaults to True.
+
+        Returns:
+            List[IngestResult]: result of each file, in input order
+        """
+        file_paths = list(dict.fromkeys(file_paths))
+        results: Dict[str, IngestResult] = {}
+
+        def finish(result: IngestResult):
+            results[result.file_path] = result
+            if result.success:
+                logger.info(f"File {result.file_path} is added, {result.num_chunks} chunks")
+            else:
+                logger.error(f"Failed to add file {result.file_path}: {result.error}")
+            if progress_callback is not None:
+                progress_callback(result, len(results), len(file_paths))
+
+        def commit(documents: List[Tuple[str, List[str], np.ndarray]]):
+            if not documents:
+                return
+            try:
+                self._commit_documents(documents)
+            except Exception as e:
+                for file_path, _, _ in documents:
+                    finish(IngestResult(file_path, False, error=repr(e)))
+                return
+            for file_path, chunks, _ in documents:
+                finish(IngestResult(file_path, True, len(chunks)))
+
+        for file_path in file_paths:
+            if file_path in self.chunk_store:
+                logger.warning(f"Found file with the same name {file_path}")
+                finish(IngestResult(file_path, True))
+        pending = [path for path in file_paths if path not in results]
+
+        ready = []
+        with ProcessPoolExecutor(self.ingest_workers) as parse_pool, ThreadPoolExecutor(
+            self.ingest_workers
+        ) as embed_pool:
+            futures = {
+                parse_pool.submit(load_and_clean, path): ("parse", path)
+                for path in pending
+            }
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, file_path = futures.pop(future)
+                    try:
+                        value = future.result()
+                    except Exception as e:
+                        finish(IngestResult(file_path, False, error=repr(e)))
+                        continue
+                    if stage == "parse":
+                        future = embed_pool.submit(self._split_and_embed, value)
+                        futures[future] = ("embed", file_path)
+                        continue
+                    ready.append((file_path, *value))
+                    num_ready = sum(len(chunks) for _, chunks, _ in ready)
+                    if num_ready >= self.ingest_insert_batch:
+                        commit(ready)
+                        ready = []
+        commit(ready)
+
+        if save:
+            self.save()
+        return [results[path] for path in file_paths]
+
+    def update_document(self, file_path: str, save: bool = False) -> int:
+        """re-index a changed file, only new or changed chunks are embedded
+
+        The file is split again and chunks are matched with the old ones by hash.
+        Vectors of matched chunks are kept, vectors of vanished chunks are removed.
+        A file not added yet is processed as a new one.
+
+        Args:
+            file_path (str): file path
+            save (bool, optional): whether to save data directory. Defaults to False.
+
+        Returns:
+            int: number of chunks embedded
+        """
+        with self._lock.read():
+            old_chunks = (
+                self.chunk_store.get_chunks(file_path)
+                if file_path in self.chunk_store
+                else None
+            )
+        if old_chunks is None:
+            self.process_document(file_path, save)
+            return self.chunk_store.num_chunks(file_path)
+        logger.info(f"Update file {file_path}")
+        blocks = clean_text_stream(iter_document(file_path))
+        chunks = list(self.splitter.split_stream(blocks))
+        if chunks == old_chunks:
+            logger.info(f"Chunks of file {file_path} are not changed")
+            return 0
+
+        # Dict[chunk hash, old chunk ids], reversed so that pop gives the first one
+        old_ids: Dict[bytes, List[int]] = {}
+        for chunk_id in reversed(range(len(old_chunks))):
+            old_ids.setdefault(chunk_hash(old_chunks[chunk_id]), []).append(chunk_id)
+        sources = np.full(len(chunks), -1, dtype=np.int64)
+        for i, chunk in enumerate(chunks):
+            ids = old_ids.get(chunk_hash(chunk))
+            if ids:
+                sources[i] = ids.pop()
+        new_chunks = [chunk for chunk, source in zip(chunks, sources) if source < 0]
+        if new_chunks:
+            vectors = self.embedder.embed(new_chunks)
+        else:
+            vectors = np.empty((0, self.embedder.dimension), dtype=np.float32)
+
+        with self._lock.write():
+            if (
+                file_path not in self.chunk_store
+                or self.chunk_store.get_chunks(file_path) != old_chunks
+            ):
+                logger.error(f"File {file_path} is changed while being updated")
+                raise ValueError()
+            self.vector_store.update_vectors(file_path, sources, vectors)
+            self.chunk_store.add(file_path, chunks)
+            if self.sparse_index is not None:
+                self.sparse_index.remove(file_path)
+                self.sparse_index.add_documents([(file_path, chunks)])
+            self.version += 1
+            self._dirty = True
+        if save:
+            self.save()
+        logger.info(
+            f"File {file_path} is updated, {len(new_chunks)} of {len(chunks)} chunks "
+            f"embedded, {len(old_chunks) - len(chunks) + len(new_chunks)} removed"
+        )
+        return len(new_chunks)
+
+    def remove_document(self, file_path: str, save: bool = False):
         """remove a file
 
         Args:
             file_path (str): filename
+            save (bool, optional): whether to save data directory. Defaults to False.
         """
-        if not file_path in self.doc_chunk_map:
-            logger.warning(f"Cannot found file with the same name {file_path}")
-            raise ValueError()
-        self.vector_store.remove_vectors(file_path)
-        self.doc_chunk_map.pop(file_path)
-        if file_path.startswith("/tmp"):
+        with self._lock.write():
+            if not file_path in self.chunk_store:
+                logger.warning(f"Cannot found file with the same name {file_path}")
+                raise ValueError()
+            self.vector_store.remove_vectors(file_path)
+            if self.sparse_index is not None:
+                self.sparse_index.remove(file_path)
+            self.chunk_store.remove(file_path)
+            self.version += 1
+            self._dirty = True
+        if save:
+            self.save()
+        if file_path.startswith("/tmp") and os.path.exists(file_path):
             os.remove(file_path)
         logger.info(f"File {file_path} is removed")
 
-    def search_ralated_chunk(self, text: str) -> List[Tuple[str, str]]:
+    def embed_query(self, text: str) -> np.ndarray:
+        """calculate embedding of a query
+
+        Args:
+            text (str): input text
+
+        Returns:
+            np.ndarray: embedding, shape like [1, dimension]
+        """
+        return self.embedder.embed([text])
+
+    async def aembed_query(self, text: str) -> np.ndarray:
+        """async version of embed_query"""
+        return await self.embedder.aembed([text])
+
+    @property
+    def topk(self) -> int:
+        """number of chunks searched for a query"""
+        return self.vector_store.topk
+
+    def _fuse_sparse(
+        self,
+        embedding: np.ndarray,
+        text: str,
+        hits: List[Tuple[str, int, float]],
+        files: Optional[List[str]],
+        topk: int,
+    ) -> List[Tuple[str, int, float]]:
+        """fuse vector search candidates with keyword search results of the text,
+        then apply min_similarity, mmr and max_chunks_per_file to the fused list
+
+        Args:
+            embedding (np.ndarray): query embedding, shape like [1, dimension]
+            text (str): query text
+            hits (List[Tuple[str, int, float]]): vector search candidates, not selected
+            files (Optional[List[str]]): only chunks of these files are searched
+            topk (int): max number of results
+
+        Returns:
+            List[Tuple[str, int, float]]: List[Tuple(filename, chunk id, similarity)]
+        """
+        num = self.vector_store.candidate_num(topk)
+        sparse_hits = self.sparse_index.search(text, num, files)
+        fused = reciprocal_rank_fusion([hits, sparse_hits], num, self.rrf_k)
+        return self.vector_store.select(embedding, fused, topk)
+
+    def search_by_embedding(
+        self,
+        embedding: np.ndarray,
+        scope: Optional[str] = None,
+        text: Optional[str] = None,
+        topk: Optional[int] = None,
+    ) -> List[Tuple[str, int, float]]:
+        """search related chunks with query embedding
+
+        Args:
+            embedding (np.ndarray): query embedding, shape like [1, dimension]
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+            text (Optional[str], optional): query text, searched by keyword and fused
+                with vector search if hybrid search is enabled. Defaults to None.
+            topk (Optional[int], optional): max number of results. Defaults to None, self.topk.
+
+        Returns:
+            List[Tuple[str, int, float]]: List[Tuple(filename, chunk id, similarity)],
+                best first
+        """
+        topk = self.topk if topk is None else topk
+        with self._lock.read():
+            files = self._get_scope_files(scope)
+            if text is None or self.sparse_index is None:
+                return self.vector_store.search(embedding, files, topk)
+            hits = self.vector_store.search(
+                embedding, files, self.vector_store.candidate_num(topk), select=False
+            )
+            return self._fuse_sparse(embedding, text, hits, files, topk)
+
+    async def asearch_by_embedding(
+        self,
+        embedding: np.ndarray,
+        scope: Optional[str] = None,
+        text: Optional[str] = None,
+        topk: Optional[int] = None,
+    ) -> List[Tuple[str, int, float]]:
+        """async version of search_by_embedding, search runs in a worker thread so
+        that it does not block event loop"""
+        return await asyncio.to_thread(
+            self.search_by_embedding, embedding, scope, text, topk
+        )
+
+    def get_chunks(self, res: List[Tuple[str, int, float]]) -> List[Tuple[str, str]]:
+        """get texts of search results
+
+        Args:
+            res (List[Tuple[str, int, float]]): List[Tuple(filename, chunk id, similarity)]
+
+        Returns:
+            List[Tuple[str, str]]: List[Tuple(filename, chunk)]
+        """
+        with self._lock.read():
+            return [
+                (filename, self._get_chunk_by_name_and_id(filename, chunk_id))
+                for filename, chunk_id, _ in res
+            ]
+
+    def search_ralated_chunk(
+        self, text: str, scope: Optional[str] = None
+    ) -> List[Tuple[str, str]]:
         """search related chunks with input text
 
         Args:
             text (str): input text
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
 
         Returns:
             List[Tuple[str, str]]: List[Tuple(filename, chunk)]
         """
-        embedding = self.embedder.embed([text])
-        res = self.vector_store.search(embedding)  # (filename, chunk id, similarity)
-        ret = []
-        for filename, chunk_id, _ in res:
-            ret.append((filename, self._get_chunk_by_name_and_id(filename, chunk_id)))
-        return ret
+        return self.get_chunks(
+            self.search_by_embedding(self.embed_query(text), scope, text)
+        )
 
-    def get_doc_list(self) -> List[str]:
-        """get all documents stored in database
+    def search_batch_by_text(
+        self, texts: List[str], scope: Optional[str] = None, topk: Optional[int] = None
+    ) -> List[List[Tuple[str, int, float]]]:
+        """search related chunks of many texts, texts are embedded in batches and
+        searched with one multi-query search
+
+        Args:
+            texts (List[str]): input texts
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+            topk (Optional[int], optional): max number of results. Defaults to None, self.topk.
+
+        Returns:
+            List[List[Tuple[str, int, float]]]: List[Tuple(filename, chunk id, similarity)]
+                of each text, in input order
+        """
+        if not texts:
+            return []
+        topk = self.topk if topk is None else topk
+        embeddings = self.embedder.embed(texts)
+        with self._lock.read():
+            files = self._get_scope_files(scope)
+            if self.sparse_index is None:
+                return self.vector_store.search_batch(embeddings, files, topk)
+            results = self.vector_store.search_batch(
+                embeddings, files, self.vector_store.candidate_num(topk), select=False
+            )
+            return [
+                self._fuse_sparse(embeddings[i : i + 1], text, hits, files, topk)
+                for i, (text, hits) in enumerate(zip(texts, results))
+            ]
+
+    def search_batch(
+        self, texts: List[str], scope: Optional[str] = None
+    ) -> List[List[Tuple[str, str]]]:
+        """batch version of search_ralated_chunk, see search_batch_by_text
+
+        Args:
+            texts (List[str]): input texts
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+
+        Returns:
+            List[List[Tuple[str, str]]]: List[Tuple(filename, chunk)] of each text, in input order
+        """
+        return [self.get_chunks(res) for res in self.search_batch_by_text(texts, scope)]
+
+    async def asearch_ralated_chunk(
+        self, text: str, scope: Optional[str] = None
+    ) -> List[Tuple[str, str]]:
+        """async version of search_ralated_chunk, vector search runs in a worker
+        thread so that it does not block event loop
+
+        Args:
+            text (str): input text
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+
+        Returns:
+            List[Tuple[str, str]]: List[Tuple(filename, chunk)]
+        """
+        embedding = await self.aembed_query(text)
+        return self.get_chunks(await self.asearch_by_embedding(embedding, scope, text))
+
+    def get_doc_list(self, scope: Optional[str] = None) -> List[str]:
+        """get documents stored in database
+
+        Args:
+            scope (Optional[str], optional): only documents under this directory are
+                listed. Defaults to None, all documents.
 
         Returns:
             List[str]: list of document name
         """
-        return list(self.doc_chunk_map.keys())
+        with self._lock.read():
+            if scope is None:
+                return self.chunk_store.filenames()
+            return self._get_scope_files(scope)
+
+    def _get_scope_files(self, scope: Optional[str]) -> Optional[List[str]]:
+        """documents under scope, called with the lock held"""
+        if scope is None:
+            return None
+        scope = os.path.join(os.path.abspath(scope), "")
+        return [name for name in self.chunk_store.filenames() if name.startswith(scope)]
+
+    def get_chunk_store_stats(self) -> Dict[str, int]:
+        """get memory footprint of chunk store
+
+        Returns:
+            Dict[str, int]: sizes in bytes and counters
+        """
+        with self._lock.read():
+            return self.chunk_store.get_memory_usage()
+
+    def get_embedding_cache_stats(self) -> Dict[str, int]:
+        """get embedding cache counters
+
+        Returns:
+            Dict[str, int]: counters, empty if cache is disabled
+        """
+        return self.embedder.get_cache_stats()
 
     def update_topk(self, topk: int):
         """update topk param while retrieval
@@ -1,38 +1,314 @@
+import asyncio
 import os
-from typing import List
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 
+from app.document_processing.embedding_cache import EmbeddingCache
 from app.engine.config import DocConfig
 from app.utils.logger import get_logger
-from openai import OpenAI
 
 logger = get_logger(__name__)
 
 RAG_EMBEDDING_API_KEY_ENVIRON = "RAG_EMBEDDING_API_KEY"
 
 
+class RequestSlots:
+    """counting semaphore shared by threads and event loops, waiting threads and
+    coroutines get slots in arrival order
+
+    Threads wait on an event, coroutines on a future of their own loop, so that
+    no event loop is blocked or woken before its slot is free.
+    """
+
+    def __init__(self, size: int):
+        self._free = size
+        self._lock = threading.Lock()
+        self._waiters: Deque[Union[threading.Event, asyncio.Future]] = deque()
+
+    def acquire(self):
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        # the slot is handed over by release
+        event.wait()
+
+    async def aacquire(self):
+        """async version of acquire"""
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if future in self._waiters:
+                    self._waiters.remove(future)
+                    raise
+            # the slot was handed over, a cancelled future passes it on in _wake
+            if not future.cancelled():
+                self.release()
+            raise
+
+    def _wake(self, future: asyncio.Future):
+        """hand a slot over to a waiting coroutine, runs in its event loop"""
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                try:
+                    waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+                    return
+                except RuntimeError:
+                    # event loop of the waiter is closed
+                    continue
+            self._free += 1
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
 class Embedder:
     def __init__(self, config: DocConfig):
         self.model_name = config.embedding_model
         self.model_path = config.embedding_model_path
+        self.dimension = config.dimension
+        self.batch_size = config.emb_batch_size
+        self.max_workers = config.emb_max_workers
+        self.max_retries = config.emb_max_retries
+        self.retry_backoff = config.emb_retry_backoff
+        # shared by all threads and coroutines, so that at most `max_workers`
+        # requests are in flight however many documents are embedded at once
+        self._request_slots = RequestSlots(self.max_workers)
+
+        self.api_url = config.emb_api_url
+        self.api_key = os.environ.get(RAG_EMBEDDING_API_KEY_ENVIRON, None)
+        if self.api_key is None:
+            self.api_key = "api_key" if config.emb_api_key == "" else config.emb_api_key
+        # clients are created on first use, importing openai is slow
+        self._client = None
+        self._async_client = None
+
+        self.cache = None
+        if config.emb_cache_size > 0:
+            self.cache = EmbeddingCache(
+                self.model_name or self.model_path,
+                config.emb_cache_size,
+                config.emb_cache_path,
+            )
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+
+            # retries are done per batch in _embed_batch
+            self._client = OpenAI(
+                base_url=self.api_url, api_key=self.api_key, max_retries=0
+            )
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+
+            self._async_client = AsyncOpenAI(
+                base_url=self.api_url, api_key=self.api_key, max_retries=0
+            )
+        return self._async_client
+
+    def _embed_batch(self, text: List[str]) -> np.ndarray:
+        """calculate embedding of one batch, retry with exponential backoff
+
+        Args:
+            text (List[str]): list of input text, no longer than batch size
+
+        Returns:
+            np.ndarray: embeddings, shape like [len(text), dimension]
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._request_slots:
+                    response = self.client.embeddings.create(
+                        model="model",
+                        input=text,
+                    )
+                return self._parse_response(response)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_backoff * 2**attempt
+                logger.warning(
+                    f"Failed to embed a batch of {len(text)} texts: {e}, retry in {delay}s"
+                )
+                time.sleep(delay)
+
+    async def _aembed_batch(self, text: List[str]) -> np.ndarray:
+        """async version of _embed_batch"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._request_slots.aacquire()
+                try:
+                    response = await self.async_client.embeddings.create(
+                        model="model",
+                        input=text,
+                    )
+                finally:
+                    self._request_slots.release()
+                return self._parse_response(response)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_backoff * 2**attempt
+                logger.warning(
+                    f"Failed to embed a batch of {len(text)} texts: {e}, retry in {delay}s"
+                )
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _parse_response(response) -> np.ndarray:
+        data = sorted(response.data, key=lambda item: item.index)
+        return np.array([item.embedding for item in data], dtype=np.float32)
+
+    def _lookup_cache(
+        self, text: List[str]
+    ) -> Tuple[List[bytes], List[Optional[np.ndarray]], Dict[bytes, int]]:
+        """look up input text in cache
 
-        api_key = os.environ.get(RAG_EMBEDDING_API_KEY_ENVIRON, None)
-        if api_key is None:
-            api_key = "api_key" if config.emb_api_key == "" else config.emb_api_key
-        self.client = OpenAI(base_url=config.emb_api_url, api_key=api_key)
+        Args:
+            text (List[str]): list of input text
 
-    def embed(self, text: List[str]) -> List[List[float]]:
-        """calculate embedding of input text
+        Returns:
+            Tuple[List[bytes], List[Optional[np.ndarray]], Dict[bytes, int]]:
+                (cache keys, cached embeddings, Dict[missing key, index of its first text])
+        """
+        keys = [self.cache.make_key(t) for t in text]
+        cached = self.cache.get_many(keys)
+        # texts repeated in the input are embedded once
+        missing: Dict[bytes, int] = {}
+        for i, (key, vector) in enumerate(zip(keys, cached)):
+            if vector is None and key not in missing:
+                missing[key] = i
+        return keys, cached, missing
+
+    def _merge_cache(
+        self,
+        keys: List[bytes],
+        cached: List[Optional[np.ndarray]],
+        missing: Dict[bytes, int],
+        missing_vectors: Optional[np.ndarray],
+    ) -> np.ndarray:
+        """store embeddings of missing texts and merge them with cached ones
+
+        Returns:
+            np.ndarray: float32 embeddings in input order
+        """
+        if missing:
+            self.cache.put_many(list(missing.keys()), missing_vectors)
+            missing = {key: row for row, key in enumerate(missing)}
+
+        vectors = np.empty((len(keys), self.dimension), dtype=np.float32)
+        for i, (key, vector) in enumerate(zip(keys, cached)):
+            vectors[i] = missing_vectors[missing[key]] if vector is None else vector
+        return vectors
+
+    def embed(self, text: List[str]) -> np.ndarray:
+        """calculate embedding of input text, only texts missing in cache are
+        sent to the embedding api
 
         Args:
             text (List[str]): list of input text
 
         Returns:
-            List: list of embeddings
+            np.ndarray: float32 embeddings in input order, shape like [len(text), dimension]
         """
-        response = self.client.embeddings.create(
-            model="model",
-            input=text,
+        if self.cache is None:
+            return self._embed(text)
+        keys, cached, missing = self._lookup_cache(text)
+        missing_vectors = None
+        if missing:
+            missing_vectors = self._embed([text[i] for i in missing.values()])
+        return self._merge_cache(keys, cached, missing, missing_vectors)
+
+    async def aembed(self, text: List[str]) -> np.ndarray:
+        """async version of embed"""
+        if self.cache is None:
+            return await self._aembed(text)
+        keys, cached, missing = self._lookup_cache(text)
+        missing_vectors = None
+        if missing:
+            missing_vectors = await self._aembed([text[i] for i in missing.values()])
+        return self._merge_cache(keys, cached, missing, missing_vectors)
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        """get embedding cache counters
+
+        Returns:
+            Dict[str, int]: counters, empty if cache is disabled
+        """
+        return {} if self.cache is None else self.cache.get_stats()
+
+    def _embed(self, text: List[str]) -> np.ndarray:
+        """calculate embedding of input text with embedding api
+
+        Input is split into batches of at most `batch_size` texts, and at most
+        `max_workers` batches are requested concurrently, counting requests of all
+        other calls.
+
+        Args:
+            text (List[str]): list of input text
+
+        Returns:
+            np.ndarray: float32 embeddings in input order, shape like [len(text), dimension]
+        """
+        starts = range(0, len(text), self.batch_size)
+        batches = [text[start : start + self.batch_size] for start in starts]
+        if not batches:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        if len(batches) == 1:
+            return self._embed_batch(text)
+
+        vectors = np.empty((len(text), self.dimension), dtype=np.float32)
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(batches))
+        ) as executor:
+            for start, batch_vectors in zip(
+                starts, executor.map(self._embed_batch, batches)
+            ):
+                vectors[start : start + len(batch_vectors)] = batch_vectors
+        return vectors
+
+    async def _aembed(self, text: List[str]) -> np.ndarray:
+        """async version of _embed, at most `max_workers` batches are in flight"""
+        starts = range(0, len(text), self.batch_size)
+        if not starts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        results = await asyncio.gather(
+            *[
+                self._aembed_batch(text[start : start + self.batch_size])
+                for start in starts
+            ]
         )
-        return np.array([item.embedding for item in response.data], dtype=np.float32)
+        return np.concatenate(results)
@@ -0,0 +1,152 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# max number of parameters in one sqlite query
+SQLITE_BATCH_SIZE = 500
+
+
+def normalize_text(text: str) -> str:
+    """normalize text before hashing, so that texts only differing in unicode form
+    or whitespace share the same embedding
+
+    Args:
+        text (str): input text
+
+    Returns:
+        str: normalized text
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    """embedding cache keyed by (model, hash of normalized text)
+
+    Recently used embeddings are kept in an in-memory LRU of at most `max_size`
+    entries. If `path` is given, all embeddings are also stored in a sqlite file,
+    which is looked up on memory misses and survives restarts.
+    """
+
+    def __init__(self, model: str, max_size: int, path: Optional[str] = None):
+        self.model = model
+        self.max_size = max_size
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB)"
+            )
+            logger.info(f"Embedding cache is stored in {path}")
+
+    def make_key(self, text: str) -> bytes:
+        """make cache key of a text
+
+        Args:
+            text (str): input text
+
+        Returns:
+            bytes: cache key
+        """
+        data = f"{self.model}\0{normalize_text(text)}".encode("utf-8")
+        return hashlib.sha256(data).digest()
+
+    def _put_memory(self, key: bytes, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _get_disk(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found = {}
+        for start in range(0, len(keys), SQLITE_BATCH_SIZE):
+            batch = keys[start : start + SQLITE_BATCH_SIZE]
+            rows = self._db.execute(
+                "SELECT key, vector FROM embeddings WHERE key IN "
+                f"({','.join('?' * len(batch))})",
+                batch,
+            )
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[np.ndarray]]:
+        """look up embeddings
+
+        Args:
+            keys (List[bytes]): cache keys
+
+        Returns:
+            List[Optional[np.ndarray]]: embedding of each key, None if missing
+        """
+        with self._lock:
+            results = []
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                results.append(vector)
+
+            missing = [key for key, vector in zip(keys, results) if vector is None]
+            if missing and self._db is not None:
+                found = self._get_disk(missing)
+                for key, vector in found.items():
+                    self._put_memory(key, vector)
+                self.disk_hits += sum(1 for key in missing if key in found)
+                results = [
+                    found.get(key) if vector is None else vector
+                    for key, vector in zip(keys, results)
+                ]
+
+            num_misses = sum(1 for vector in results if vector is None)
+            self.misses += num_misses
+            self.hits += len(keys) - num_misses
+            return results
+
+    def put_many(self, keys: List[bytes], vectors: np.ndarray):
+        """store embeddings
+
+        Args:
+            keys (List[bytes]): cache keys
+            vectors (np.ndarray): embeddings, shape like [len(keys), dimension]
+        """
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._put_memory(key, vector.copy())
+            if self._db is not None:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, vector.tobytes()) for key, vector in zip(keys, vectors)],
+                )
+                self._db.commit()
+
+    def get_stats(self) -> Dict[str, int]:
+        """get cache counters
+
+        Returns:
+            Dict[str, int]: hits (including disk hits), disk hits, misses and
+                number of embeddings in memory
+        """
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self._memory),
+        }
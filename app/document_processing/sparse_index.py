@@ -0,0 +1,356 @@
+import importlib.util
+import json
+import math
+import os
+import re
+import unicodedata
+from array import array
+from collections import Counter
+from typing import Collection, Dict, List, Optional, Tuple
+
+import numpy as np
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+SPARSE_POSTINGS_FILENAME = "sparse_postings.npz"
+SPARSE_META_FILENAME = "sparse_index.json"
+
+# identifiers, numbers, dates and product codes are kept as whole tokens,
+# runs of CJK characters are segmented by jieba or split into bigrams
+TOKEN_PATTERN = re.compile(
+    r"(?P<word>[a-z0-9](?:[a-z0-9_.\-/:]*[a-z0-9])?)|(?P<cjk>[㐀-䶿一-鿿]+)"
+)
+
+# buffered postings are merged into the arrays once they exceed this ratio of them
+MERGE_RATIO = 0.25
+MIN_MERGE_SIZE = 1 << 16
+
+
+def tokenize(text: str, use_jieba: bool = False) -> List[str]:
+    """split text into terms for sparse retrieval
+
+    Args:
+        text (str): input text
+        use_jieba (bool, optional): segment chinese with jieba. Defaults to False,
+            character bigrams.
+
+    Returns:
+        List[str]: terms
+    """
+    if use_jieba:
+        import jieba
+
+    terms = []
+    text = unicodedata.normalize("NFKC", text).lower()
+    for match in TOKEN_PATTERN.finditer(text):
+        if match.group("word"):
+            terms.append(match.group("word"))
+            continue
+        run = match.group("cjk")
+        if use_jieba:
+            terms.extend(jieba.lcut_for_search(run))
+        elif len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[Tuple[str, int, float]]], topk: int, k: int = 60
+) -> List[Tuple[str, int, float]]:
+    """fuse ranked results by reciprocal rank fusion, score of a chunk is
+    sum of 1 / (k + rank) over the rankings containing it
+
+    Args:
+        rankings (List[List[Tuple[str, int, float]]]): List[Tuple(filename, chunk id, score)] of each retriever, best first
+        topk (int): number of results
+        k (int, optional): rank constant. Defaults to 60.
+
+    Returns:
+        List[Tuple[str, int, float]]: List[Tuple(filename, chunk id, fused score)], best first
+    """
+    scores: Dict[Tuple[str, int], float] = {}
+    for ranking in rankings:
+        for rank, (filename, chunk_id, _) in enumerate(ranking, start=1):
+            key = (filename, chunk_id)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:topk]
+    return [(filename, chunk_id, score) for (filename, chunk_id), score in fused]
+
+
+class BM25Index:
+    """in-process BM25 index over chunks
+
+    Postings live in CSR arrays sorted by term id: documents and term frequencies
+    of term t are post_docs[offsets[t] : offsets[t + 1]] and the same slice of
+    post_tfs. Postings of new chunks are appended to a per-term buffer, which is
+    merged into the arrays once it grows beyond MERGE_RATIO of them. Removed chunks are masked
+    at once and their postings are dropped on the next merge.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.use_jieba = importlib.util.find_spec("jieba") is not None
+        self.terms: Dict[str, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.post_docs = np.empty(0, dtype=np.int32)
+        self.post_tfs = np.empty(0, dtype=np.int32)
+        # postings not merged yet, Dict[term id, (doc ids, term frequencies)]
+        self._buffer: Dict[int, Tuple[array, array]] = {}
+        self._buf_size = 0
+        # doc table, indexed by doc id: position of filename in self.files,
+        # chunk id and number of terms, removed docs are marked with file position -1
+        self.doc_file = np.empty(0, dtype=np.int32)
+        self.doc_chunk = np.empty(0, dtype=np.int32)
+        self.doc_len = np.empty(0, dtype=np.int32)
+        self.num_docs = 0
+        self.files: List[str] = []
+        self.file_pos: Dict[str, int] = {}
+        # Dict[filename, (first doc id, number of docs)]
+        self.file_docs: Dict[str, Tuple[int, int]] = {}
+        self.num_alive = 0
+        self.total_len = 0
+        self._num_removed = 0
+
+    def _reserve_docs(self, size: int):
+        capacity = len(self.doc_file)
+        if size <= capacity:
+            return
+        grow = max(size, 2 * capacity, 1024) - capacity
+        self.doc_file = np.concatenate([self.doc_file, np.full(grow, -1, dtype=np.int32)])
+        self.doc_chunk = np.concatenate([self.doc_chunk, np.zeros(grow, dtype=np.int32)])
+        self.doc_len = np.concatenate([self.doc_len, np.zeros(grow, dtype=np.int32)])
+
+    def _get_file_pos(self, filename: str) -> int:
+        if filename not in self.file_pos:
+            self.file_pos[filename] = len(self.files)
+            self.files.append(filename)
+        return self.file_pos[filename]
+
+    def add_documents(self, items: List[Tuple[str, List[str]]]):
+        """index chunks of several files
+
+        Args:
+            items (List[Tuple[str, List[str]]]): list of (filename, chunks)
+        """
+        for filename, chunks in items:
+            start = self.num_docs
+            self._reserve_docs(start + len(chunks))
+            file_pos = self._get_file_pos(filename)
+            for chunk_id, chunk in enumerate(chunks):
+                doc = self.num_docs
+                counts = Counter(tokenize(chunk, self.use_jieba))
+                for term, tf in counts.items():
+                    term_id = self.terms.setdefault(term, len(self.terms))
+                    if term_id not in self._buffer:
+                        self._buffer[term_id] = (array("i"), array("i"))
+                    buf_docs, buf_tfs = self._buffer[term_id]
+                    buf_docs.append(doc)
+                    buf_tfs.append(tf)
+                self._buf_size += len(counts)
+                length = sum(counts.values())
+                self.doc_file[doc] = file_pos
+                self.doc_chunk[doc] = chunk_id
+                self.doc_len[doc] = length
+                self.total_len += length
+                self.num_docs += 1
+            self.file_docs[filename] = (start, len(chunks))
+            self.num_alive += len(chunks)
+        if self._buf_size > max(MIN_MERGE_SIZE, MERGE_RATIO * len(self.post_docs)):
+            self._merge()
+
+    def remove(self, filename: str):
+        """remove chunks of a file
+
+        Args:
+            filename (str): filename
+        """
+        if filename not in self.file_docs:
+            return
+        start, count = self.file_docs.pop(filename)
+        self.doc_file[start : start + count] = -1
+        self.total_len -= int(self.doc_len[start : start + count].sum())
+        self.num_alive -= count
+        self._num_removed += count
+        if self._num_removed > MERGE_RATIO * self.num_alive:
+            self._merge()
+
+    def _merge(self):
+        """merge buffered postings into the arrays and drop postings of removed docs"""
+        terms = [
+            np.repeat(
+                np.arange(len(self.offsets) - 1, dtype=np.int32), np.diff(self.offsets)
+            )
+        ]
+        docs, tfs = [self.post_docs], [self.post_tfs]
+        for term_id, (buf_docs, buf_tfs) in self._buffer.items():
+            terms.append(np.full(len(buf_docs), term_id, dtype=np.int32))
+            docs.append(np.array(buf_docs, dtype=np.int32))
+            tfs.append(np.array(buf_tfs, dtype=np.int32))
+        terms, docs, tfs = np.concatenate(terms), np.concatenate(docs), np.concatenate(tfs)
+        alive = self.doc_file[docs] >= 0
+        terms, docs, tfs = terms[alive], docs[alive], tfs[alive]
+
+        order = np.argsort(terms, kind="stable")
+        self.post_docs, self.post_tfs = docs[order], tfs[order]
+        counts = np.bincount(terms, minlength=len(self.terms))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self._buffer = {}
+        self._buf_size = 0
+        self._num_removed = 0
+
+    def _get_postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """get alive postings of a term
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (doc ids, term frequencies)
+        """
+        docs, tfs = [], []
+        if term_id < len(self.offsets) - 1:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs.append(self.post_docs[start:end])
+            tfs.append(self.post_tfs[start:end])
+        if term_id in self._buffer:
+            buf_docs, buf_tfs = self._buffer[term_id]
+            docs.append(np.array(buf_docs, dtype=np.int32))
+            tfs.append(np.array(buf_tfs, dtype=np.int32))
+        docs, tfs = np.concatenate(docs), np.concatenate(tfs)
+        alive = self.doc_file[docs] >= 0
+        return docs[alive], tfs[alive]
+
+    def search(
+        self, query: str, topk: int, files: Optional[Collection[str]] = None
+    ) -> List[Tuple[str, int, float]]:
+        """search chunks by BM25 score
+
+        Args:
+            query (str): query text
+            topk (int): number of results
+            files (Optional[Collection[str]], optional): only chunks of these files
+                are searched. Defaults to None, all files.
+
+        Returns:
+            List[Tuple[str, int, float]]: List[Tuple(filename, chunk id, score)], best first
+        """
+        term_ids = {
+            self.terms[term]
+            for term in tokenize(query, self.use_jieba)
+            if term in self.terms
+        }
+        if not term_ids or self.num_alive == 0:
+            return []
+        allowed = None
+        if files is not None:
+            allowed = np.array(
+                [self.file_pos[f] for f in files if f in self.file_docs], dtype=np.int32
+            )
+
+        avg_len = self.total_len / self.num_alive
+        all_docs, all_scores = [], []
+        for term_id in term_ids:
+            docs, tfs = self._get_postings(term_id)
+            if not len(docs):
+                continue
+            idf = math.log(1 + (self.num_alive - len(docs) + 0.5) / (len(docs) + 0.5))
+            if allowed is not None:
+                selected = np.isin(self.doc_file[docs], allowed)
+                docs, tfs = docs[selected], tfs[selected]
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / avg_len)
+            all_docs.append(docs)
+            all_scores.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+        if not all_docs:
+            return []
+
+        docs, inverse = np.unique(np.concatenate(all_docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        if not len(docs):
+            return []
+        if len(docs) > topk:
+            top = np.argpartition(-scores, topk - 1)[:topk]
+        else:
+            top = np.arange(len(docs))
+        top = top[np.argsort(-scores[top])]
+        return [
+            (
+                self.files[self.doc_file[docs[i]]],
+                int(self.doc_chunk[docs[i]]),
+                float(scores[i]),
+            )
+            for i in top
+        ]
+
+    def prepare_save(self):
+        """merge buffered postings, so that save only reads the index"""
+        if self._buffer or self._num_removed:
+            self._merge()
+
+    def save(self, data_dir: str):
+        """save index to data directory
+
+        Args:
+            data_dir (str): data directory
+        """
+        self.prepare_save()
+        postings_path = os.path.join(data_dir, SPARSE_POSTINGS_FILENAME)
+        meta_path = os.path.join(data_dir, SPARSE_META_FILENAME)
+        with open(postings_path + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                offsets=self.offsets,
+                post_docs=self.post_docs,
+                post_tfs=self.post_tfs,
+                doc_file=self.doc_file[: self.num_docs],
+                doc_chunk=self.doc_chunk[: self.num_docs],
+                doc_len=self.doc_len[: self.num_docs],
+            )
+        state = {
+            "use_jieba": self.use_jieba,
+            "terms": list(self.terms),
+            "files": self.files,
+            "file_docs": self.file_docs,
+            "total_len": self.total_len,
+        }
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        for path in [postings_path, meta_path]:
+            os.replace(path + ".tmp", path)
+
+    def load(self, data_dir: str) -> bool:
+        """load index saved in data directory
+
+        Args:
+            data_dir (str): data directory
+
+        Returns:
+            bool: False if nothing usable is saved in data_dir, such as an index
+                tokenized differently
+        """
+        meta_path = os.path.join(data_dir, SPARSE_META_FILENAME)
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state["use_jieba"] != self.use_jieba:
+            logger.info("Tokenizer of saved sparse index is changed")
+            return False
+        with np.load(os.path.join(data_dir, SPARSE_POSTINGS_FILENAME)) as arrays:
+            self.offsets = arrays["offsets"]
+            self.post_docs = arrays["post_docs"]
+            self.post_tfs = arrays["post_tfs"]
+            self.doc_file = arrays["doc_file"]
+            self.doc_chunk = arrays["doc_chunk"]
+            self.doc_len = arrays["doc_len"]
+        self.num_docs = len(self.doc_file)
+        self.terms = {term: i for i, term in enumerate(state["terms"])}
+        self.files = state["files"]
+        self.file_pos = {filename: pos for pos, filename in enumerate(self.files)}
+        self.file_docs = {
+            filename: tuple(docs) for filename, docs in state["file_docs"].items()
+        }
+        self.num_alive = sum(count for _, count in self.file_docs.values())
+        self.total_len = state["total_len"]
+        logger.info(f"Load sparse index of {self.num_alive} chunks from {data_dir}")
+        return True
@@ -2,7 +2,7 @@ import importlib
 import os
 import sys
 from abc import ABC, abstractmethod
-from typing import Dict, List, Type
+from typing import Dict, Iterable, Iterator, List, Type
 
 from app.engine.config import DocConfig
 from app.utils.logger import get_logger
@@ -11,7 +11,9 @@ DOCSPLITTER_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(DOCSPLITTER_DIR)
 
 DOCSPLITTER_CONFIG_MODULENAME_CLASSNAME_MAP = {
-    "fixedlength": ("fixed_len_splitter", "FixedLengthSplitter")
+    "fixedlength": ("fixed_len_splitter", "FixedLengthSplitter"),
+    "recursive": ("recursive_splitter", "RecursiveSplitter"),
+    "token": ("token_splitter", "TokenSplitter"),
 }
 
 logger = get_logger(__name__)
@@ -34,6 +36,18 @@ class DocSplitterBase(ABC):
     def split_text(self, text: str) -> List[str]:
         raise NotImplementedError("split_text must be implemented in subclasses.")
 
+    def split_stream(self, blocks: Iterable[str]) -> Iterator[str]:
+        """split text given block by block, yields the same chunks as split_text on
+        the joined text. Subclasses override it to split without joining all blocks.
+
+        Args:
+            blocks (Iterable[str]): input text blocks
+
+        Yields:
+            str: chunks after splitting
+        """
+        yield from self.split_text("".join(blocks))
+
     @classmethod
     def from_config(cls, config: DocConfig):
         """create subclass instance from config
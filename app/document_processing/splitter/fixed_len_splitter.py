@@ -1,4 +1,4 @@
-from typing import List
+from typing import Iterable, Iterator, List
 
 from app.document_processing.splitter.doc_splitter import DocSplitterBase
 from app.utils.logger import get_logger
@@ -28,3 +28,27 @@ class FixedLengthSplitter(DocSplitterBase):
             chunks.append(text[start:end])
             start = end - self.overlap
         return chunks
+
+    def split_stream(self, blocks: Iterable[str]) -> Iterator[str]:
+        """split text given block by block into chunks with fixed length, only the
+        unfinished tail of the text is buffered
+
+        Args:
+            blocks (Iterable[str]): input text blocks
+
+        Yields:
+            str: chunks after splitting
+        """
+        step = self.chunk_length - self.overlap
+        buffer = ""
+        for block in blocks:
+            buffer += block
+            start = 0
+            while len(buffer) - start >= self.chunk_length:
+                yield buffer[start : start + self.chunk_length]
+                start += step
+            buffer = buffer[start:]
+        start = 0
+        while start < len(buffer):
+            yield buffer[start : start + self.chunk_length]
+            start += step
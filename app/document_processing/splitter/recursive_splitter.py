@@ -0,0 +1,183 @@
+import re
+from bisect import bisect_left, bisect_right
+from typing import Any, Iterable, Iterator, List, Tuple
+
+from app.document_processing.splitter.doc_splitter import DocSplitterBase
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+SENTENCE_END = "。！？!?；;…"
+CLOSING = "”’\"'）)】」』》"
+
+# positions where a chunk may end, from the most preferred level to the least.
+# All patterns are zero-width and look at most 2 characters around the position,
+# so boundaries do not depend on where the search starts. Line breaks rank below
+# sentence ends because lines of PDF text wrap in the middle of sentences.
+BOUNDARY_PATTERNS = [
+    # paragraph
+    re.compile(r"(?<=\n\n)"),
+    # sentence, with its closing quotes or brackets
+    re.compile(
+        rf"(?<=[{SENTENCE_END}])(?![{SENTENCE_END}{CLOSING}])"
+        rf"|(?<=[{SENTENCE_END}][{CLOSING}])(?![{CLOSING}])"
+        r"|(?<=\.)(?=\s)"
+    ),
+    # line
+    re.compile(r"(?<=\n)"),
+    # clause or word
+    re.compile(r"(?<=[，,、：:])|(?<= )"),
+]
+
+# characters before the start of a chunk kept in stream buffer for lookbehind
+LOOKBEHIND = 2
+# characters after the end of a chunk required in stream buffer before it is split,
+# so that boundaries and tokens near the end are not changed by later text
+LOOKAHEAD = 64
+
+
+class RecursiveSplitter(DocSplitterBase):
+    """split text at the most preferred boundary within chunk length
+
+    A chunk ends at the last paragraph end within `chunk_length` characters, or the
+    last sentence end if there is no paragraph end, then line breaks, clauses and
+    words. Boundaries in the first quarter of a chunk are ignored to avoid tiny
+    fragments, and the text is cut at `chunk_length` if there is no boundary. The
+    next chunk starts at the first boundary in the last `overlap` characters.
+
+    Boundaries are found once with regular expressions and looked up by binary
+    search, so splitting takes linear time.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.chunk_length = config.chunk_length
+        self.overlap = config.overlap
+
+    def _measure(self, text: str) -> Any:
+        """prepare the measure of length, used by _advance and _retreat"""
+        return None
+
+    def _advance(self, measure: Any, text: str, pos: int) -> int:
+        """position chunk_length after pos"""
+        return pos + self.chunk_length
+
+    def _retreat(self, measure: Any, text: str, pos: int) -> int:
+        """position overlap before pos"""
+        return pos - self.overlap
+
+    def _keep_from(self, text: str, start: int) -> int:
+        """position from which stream buffer is kept for the chunk starting at start"""
+        return max(start - LOOKBEHIND, 0)
+
+    @staticmethod
+    def _find_boundaries(text: str, start: int) -> List[List[int]]:
+        return [
+            [m.start() for m in pattern.finditer(text, start)]
+            for pattern in BOUNDARY_PATTERNS
+        ]
+
+    def _find_end(self, boundaries: List[List[int]], start: int, limit: int) -> int:
+        """end of the chunk starting at start"""
+        low = start + (limit - start) // 4
+        for positions in boundaries:
+            i = bisect_right(positions, limit) - 1
+            if i >= 0 and positions[i] > low:
+                return positions[i]
+        return limit
+
+    def _find_next_start(
+        self,
+        boundaries: List[List[int]],
+        measure: Any,
+        text: str,
+        start: int,
+        end: int,
+    ) -> int:
+        """start of the chunk after the one from start to end"""
+        # overlap is at most half of the chunk, so that splitting always moves on
+        low = max(self._retreat(measure, text, end), end - (end - start) // 2)
+        if low >= end:
+            return end
+        first = end
+        for positions in boundaries:
+            i = bisect_left(positions, low)
+            if i < len(positions):
+                first = min(first, positions[i])
+        return first if first < end else low
+
+    def _split(self, text: str, start: int, final: bool) -> Tuple[List[str], int]:
+        """split text from start
+
+        Args:
+            text (str): input text
+            start (int): start of the first chunk
+            final (bool): whether text is complete, otherwise chunks near the end
+                of text are left for later
+
+        Returns:
+            Tuple[List[str], int]: (chunks, start of the chunk not split yet)
+        """
+        chunks = []
+        boundaries = self._find_boundaries(text, start)
+        measure = self._measure(text)
+        while start < len(text):
+            limit = self._advance(measure, text, start)
+            if limit >= len(text):
+                if not final:
+                    break
+                chunk = text[start:].strip()
+                if chunk:
+                    chunks.append(chunk)
+                start = len(text)
+                break
+            if not final and limit + LOOKAHEAD > len(text):
+                break
+            end = self._find_end(boundaries, start, limit)
+            chunk = text[start:end].strip()
+            if chunk:
+                chunks.append(chunk)
+            start = self._find_next_start(boundaries, measure, text, start, end)
+        return chunks, start
+
+    def split_text(self, text: str) -> List[str]:
+        """split text into chunks at sentence boundaries
+
+        Args:
+            text (str): input text
+
+        Returns:
+            List[str]: list of chunks after splitting
+        """
+        return self._split(text, 0, True)[0]
+
+    def split_stream(self, blocks: Iterable[str]) -> Iterator[str]:
+        """split text given block by block, blocks are buffered until there is
+        more new text than unfinished text, so that each character is searched for
+        boundaries a bounded number of times
+
+        Args:
+            blocks (Iterable[str]): input text blocks
+
+        Yields:
+            str: chunks after splitting
+        """
+        buffer = ""
+        start = 0
+        pending = []
+        pending_length = 0
+        for block in blocks:
+            pending.append(block)
+            pending_length += len(block)
+            unfinished = len(buffer) - start
+            if pending_length < max(self.chunk_length, unfinished) + LOOKAHEAD:
+                continue
+            keep = self._keep_from(buffer, start)
+            buffer = buffer[keep:] + "".join(pending)
+            pending = []
+            pending_length = 0
+            chunks, start = self._split(buffer, start - keep, False)
+            yield from chunks
+        keep = self._keep_from(buffer, start)
+        buffer = buffer[keep:] + "".join(pending)
+        yield from self._split(buffer, start - keep, True)[0]
@@ -0,0 +1,46 @@
+from bisect import bisect_left
+from typing import List
+
+from app.document_processing.splitter.recursive_splitter import (
+    LOOKAHEAD, RecursiveSplitter)
+from app.utils.logger import get_logger
+from app.utils.tokens import TokenCounter
+
+logger = get_logger(__name__)
+
+
+class TokenSplitter(RecursiveSplitter):
+    """split text at the most preferred boundary like RecursiveSplitter, while
+    `chunk_length` and `overlap` are numbers of tokens instead of characters
+
+    Tokens are counted by the tokenizer at `split_tokenizer_path`, or estimated
+    like `estimate_tokens` if it is not set.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        # tokenizer is loaded on first split
+        self.token_counter = TokenCounter(config.split_tokenizer_path)
+
+    def _keep_from(self, text: str, start: int) -> int:
+        keep = super()._keep_from(text, start)
+        # tokens of a word are counted from its first character
+        while (
+            keep > 0
+            and start - keep < LOOKAHEAD
+            and text[keep - 1].isascii()
+            and text[keep - 1].isalnum()
+        ):
+            keep -= 1
+        return keep
+
+    def _measure(self, text: str) -> List[int]:
+        return self.token_counter.token_starts(text)
+
+    def _advance(self, measure: List[int], text: str, pos: int) -> int:
+        i = bisect_left(measure, pos) + self.chunk_length
+        return measure[i] if i < len(measure) else len(text)
+
+    def _retreat(self, measure: List[int], text: str, pos: int) -> int:
+        i = bisect_left(measure, pos) - self.overlap
+        return measure[max(i, 0)] if measure else pos
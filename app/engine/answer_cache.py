@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Optional
+
+import numpy as np
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class _Entry:
+    embedding: np.ndarray
+    context_key: Hashable
+    answer: str
+    created: float
+
+
+class AnswerCache:
+    """answer cache keyed by question embedding similarity
+
+    An answer is reused when a new question has exactly the same retrieved context
+    and cosine similarity of question embeddings is at least `threshold`. Entries
+    expire after `ttl` seconds and at most `max_size` entries are kept, least
+    recently used first out. All entries are dropped when documents change.
+    """
+
+    def __init__(self, max_size: int, threshold: float, ttl: float):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        # Dict[context key, entry ids]
+        self._by_context: Dict[Hashable, List[int]] = {}
+        self._next_id = 0
+        self._doc_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        ids = self._by_context[entry.context_key]
+        ids.remove(entry_id)
+        if not ids:
+            self._by_context.pop(entry.context_key)
+
+    def _check_version(self, doc_version: int):
+        if doc_version != self._doc_version:
+            if self._entries:
+                logger.info("Documents changed, answer cache is cleared")
+            self._entries.clear()
+            self._by_context.clear()
+            self._doc_version = doc_version
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        return embedding / max(np.linalg.norm(embedding), 1e-12)
+
+    def get(
+        self, embedding: np.ndarray, context_key: Hashable, doc_version: int
+    ) -> Optional[str]:
+        """look up answer of a question
+
+        Args:
+            embedding (np.ndarray): question embedding
+            context_key (Hashable): identifies retrieved context, such as chunk ids
+            doc_version (int): version of documents
+
+        Returns:
+            Optional[str]: cached answer, None if missing
+        """
+        with self._lock:
+            self._check_version(doc_version)
+            now = time.monotonic()
+            for entry_id in list(self._by_context.get(context_key, [])):
+                if now - self._entries[entry_id].created > self.ttl:
+                    self._remove(entry_id)
+            entry_ids = self._by_context.get(context_key)
+            if not entry_ids:
+                self.misses += 1
+                return None
+
+            candidates = np.stack([self._entries[i].embedding for i in entry_ids])
+            similarities = candidates @ self._normalize(embedding)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(entry_ids[best])
+            return self._entries[entry_ids[best]].answer
+
+    def put(
+        self, embedding: np.ndarray, context_key: Hashable, doc_version: int, answer: str
+    ):
+        """store answer of a question
+
+        Args:
+            embedding (np.ndarray): question embedding
+            context_key (Hashable): identifies retrieved context, such as chunk ids
+            doc_version (int): version of documents the answer is based on
+            answer (str): answer
+        """
+        with self._lock:
+            self._check_version(doc_version)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _Entry(
+                self._normalize(embedding), context_key, answer, time.monotonic()
+            )
+            self._by_context.setdefault(context_key, []).append(entry_id)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def get_stats(self) -> Dict[str, int]:
+        """get cache counters
+
+        Returns:
+            Dict[str, int]: hits, misses and number of entries
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
@@ -0,0 +1,117 @@
+import threading
+from concurrent.futures import Executor
+from typing import Callable, List, Tuple
+
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def format_turn(question: str, answer: str) -> str:
+    return f"Q:{question}\nA:{answer}\n"
+
+
+class ChatHistory:
+    """chat history of one session, fitted into a token budget
+
+    The most recent turns are kept verbatim. Once the budget is exceeded, older
+    turns are folded into a rolling summary, which is generated in background by
+    `summarize(old summary, turns)`. Turns being folded are still used verbatim
+    until their summary is ready.
+    """
+
+    def __init__(
+        self,
+        token_budget: int,
+        recent_turns: int,
+        count_tokens: Callable[[str], int],
+        summarize: Callable[[str, List[Tuple[str, str]]], str],
+        executor: Executor,
+    ):
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.executor = executor
+        # List[Tuple(question, answer, number of tokens)]
+        self.turns: List[Tuple[str, str, int]] = []
+        self.summary = ""
+        self.summary_tokens = 0
+        # turns waiting to be folded into summary
+        self._folding: List[Tuple[str, str, int]] = []
+        # turns being folded into summary
+        self._summarizing: List[Tuple[str, str, int]] = []
+        # bumped by clear, so that summary of cleared turns is dropped
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def append(self, question: str, answer: str):
+        """add a turn
+
+        Args:
+            question (str): user question
+            answer (str): answer
+        """
+        with self._lock:
+            num_tokens = self.count_tokens(format_turn(question, answer))
+            self.turns.append((question, answer, num_tokens))
+            total = self.summary_tokens + sum(turn[2] for turn in self.turns)
+            while total > self.token_budget and len(self.turns) > self.recent_turns:
+                turn = self.turns.pop(0)
+                self._folding.append(turn)
+                total -= turn[2]
+            self._submit()
+
+    def _submit(self):
+        """start summarizing folded turns, at most one summary is generated at a time"""
+        if not self._folding or self._summarizing:
+            return
+        self._summarizing, self._folding = self._folding, []
+        turns = [(question, answer) for question, answer, _ in self._summarizing]
+        self.executor.submit(self._summarize, self._generation, self.summary, turns)
+
+    def _summarize(self, generation: int, summary: str, turns: List[Tuple[str, str]]):
+        try:
+            summary = self.summarize(summary, turns)
+        except Exception as e:
+            logger.error(f"Failed to summarize chat history: {e}")
+            with self._lock:
+                if generation == self._generation:
+                    # retried when next turn is appended
+                    self._folding = self._summarizing + self._folding
+                    self._summarizing = []
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self.summary = summary
+            self.summary_tokens = self.count_tokens(summary)
+            self._summarizing = []
+            self._submit()
+
+    def get_context(self) -> Tuple[str, List[Tuple[str, str]]]:
+        """get summary and the most recent turns fitting into the token budget
+
+        Returns:
+            Tuple[str, List[Tuple[str, str]]]: (summary, List[Tuple(question, answer)])
+        """
+        with self._lock:
+            budget = self.token_budget - self.summary_tokens
+            turns = []
+            unsummarized = self._summarizing + self._folding + self.turns
+            for question, answer, num_tokens in reversed(unsummarized):
+                if num_tokens > budget:
+                    break
+                turns.append((question, answer))
+                budget -= num_tokens
+            return self.summary, turns[::-1]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.turns = []
+            self._folding = []
+            self._summarizing = []
+            self.summary = ""
+            self.summary_tokens = 0
+
@@ -1,5 +1,5 @@
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional
 
@@ -11,6 +11,12 @@ class GeneratorConfig:
     path: Optional[str] = None
     api_url: Optional[str] = None
     api_key: Optional[str] = None
+    # reuse kv cache of common prompt prefix in local backends
+    prefix_cache: bool = True
+    # dynamic batching of concurrent requests in local transformers backend,
+    # 1 disables batching
+    max_batch_size: int = 8
+    max_wait_ms: float = 10.0
 
 
 @dataclass
@@ -26,12 +32,99 @@ class DocConfig:
     embedding_model: Optional[str] = None
     emb_api_url: Optional[str] = None
     emb_api_key: Optional[str] = None
+    emb_batch_size: int = 32
+    emb_max_workers: int = 4
+    emb_max_retries: int = 3
+    emb_retry_backoff: float = 1.0
+    # 0 disables embedding cache
+    emb_cache_size: int = 10000
+    emb_cache_path: Optional[str] = None
+    # tokenizer used by token splitter, estimated from characters if None
+    split_tokenizer_path: Optional[str] = None
+    # number of worker processes and threads used by DocProcessor.process_documents
+    ingest_workers: int = 4
+    # number of vectors added to database in one insert while ingesting documents
+    ingest_insert_batch: int = 4096
+    # directory where chunks and vectors are saved, nothing is saved if None
+    data_dir: Optional[str] = None
+    # seconds between scans of a watched corpus directory if watchdog is unavailable
+    sync_poll_interval: float = 5.0
+    # fuse vector search with BM25 keyword search by reciprocal rank fusion
+    hybrid_search: bool = True
+    rrf_k: int = 60
+    # "l2", "ip" or "cosine", vectors are normalised when added and searched for cosine
+    metric: str = "l2"
+    # "float32", "float16" or "sq8", precision of vectors stored in faiss index
+    vector_storage: str = "float32"
+    # vector search results less similar than this are dropped, None keeps all
+    min_similarity: Optional[float] = None
+    # maximal marginal relevance, 1 ranks by relevance only and 0 by diversity only,
+    # None disables it
+    mmr_lambda: Optional[float] = None
+    # at most this many vector search results from one file, 0 for no limit
+    max_chunks_per_file: int = 0
+    # number of candidates searched, of which mmr and max_chunks_per_file keep topk
+    search_candidates: int = 20
+    # approximate search, used by faiss_ivfpq and faiss_hnsw
+    train_threshold: Optional[int] = None
+    nlist: int = 1024
+    nprobe: int = 16
+    pq_m: int = 128
+    pq_nbits: int = 8
+    # faiss_ivfpq searches refine_factor times more candidates and re-ranks them by
+    # exact distances, 0 ranks by pq distances only
+    refine_factor: int = 40
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+
+
+@dataclass
+class RerankerConfig:
+    model: str
+    backend_type: str
+    path: Optional[str] = None
+    api_url: Optional[str] = None
+    api_key: Optional[str] = None
+    # number of candidates searched and reranked, the best topk of them are kept
+    candidates: int = 20
+    # number of (query, chunk) pairs scored in one forward pass or request
+    batch_size: int = 16
+    max_length: int = 512
+    # candidates not scored within this time keep their retrieval order
+    latency_budget_ms: float = 500
+
+
+@dataclass
+class EngineConfig:
+    # 0 disables answer cache
+    answer_cache_size: int = 0
+    answer_cache_threshold: float = 0.95
+    answer_cache_ttl: float = 3600
+    # chat history of each session is fitted into this many tokens
+    history_token_budget: int = 2048
+    # number of most recent turns never folded into summary
+    history_recent_turns: int = 2
+    history_summary_max_chars: int = 300
+    max_sessions: int = 1000
+    # retrieved chunks are packed into this many tokens
+    context_token_budget: int = 2048
+    # a chunk is dropped when this ratio of its character 3-grams is in a better ranked chunk
+    context_dedup_threshold: float = 0.8
+    # tokenizer used to count tokens, estimated from characters if None
+    tokenizer_path: Optional[str] = None
+    # create backends in a background thread as soon as engine is created,
+    # otherwise they are created on first use
+    warm_up: bool = True
 
 
 @dataclass
 class RAGConfig:
     llm_config: GeneratorConfig
     doc_config: DocConfig
+    engine_config: EngineConfig = field(default_factory=EngineConfig)
+    # rerank search results if set
+    rerank_config: Optional[RerankerConfig] = None
 
     @classmethod
     def from_json(cls, config_path: str) -> "RAGConfig":
@@ -50,4 +143,8 @@ class RAGConfig:
         return cls(
             llm_config=GeneratorConfig(**config_data["llm_config"]),
             doc_config=DocConfig(**config_data["doc_config"]),
+            engine_config=EngineConfig(**config_data.get("engine_config", {})),
+            rerank_config=RerankerConfig(**config_data["rerank_config"])
+            if config_data.get("rerank_config")
+            else None,
         )
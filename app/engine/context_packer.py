@@ -0,0 +1,116 @@
+from typing import Callable, Dict, List, Set, Tuple
+
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# length of character n-grams compared while removing near-duplicate chunks
+SHINGLE_SIZE = 3
+
+
+def _shingles(text: str) -> Set[str]:
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i : i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def _overlap_length(left: str, right: str, max_overlap: int) -> int:
+    """length of the longest suffix of left which is also a prefix of right
+
+    Args:
+        left (str): left text
+        right (str): right text
+        max_overlap (int): max length checked
+
+    Returns:
+        int: overlap length
+    """
+    for length in range(min(max_overlap, len(left), len(right)), 0, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+
+class ContextPacker:
+    """pack retrieved chunks into prompt context
+
+    Adjacent chunks of the same file are merged without their overlap, chunks
+    mostly contained in a better ranked one are dropped, and the rest are packed
+    in rank order until the token budget is used up.
+    """
+
+    def __init__(
+        self,
+        token_budget: int,
+        max_overlap: int,
+        dedup_threshold: float,
+        count_tokens: Callable[[str], int],
+    ):
+        self.token_budget = token_budget
+        self.max_overlap = max_overlap
+        self.dedup_threshold = dedup_threshold
+        self.count_tokens = count_tokens
+
+    def _merge_adjacent(
+        self, hits: List[Tuple[str, int, float, str]]
+    ) -> List[Tuple[int, str, str]]:
+        """merge chunks with consecutive chunk ids of the same file
+
+        Args:
+            hits (List[Tuple[str, int, float, str]]): (filename, chunk id, score, text), best first
+
+        Returns:
+            List[Tuple[int, str, str]]: (best rank, filename, text)
+        """
+        # Dict[filename, List[Tuple(chunk id, rank, text)]]
+        files: Dict[str, List[Tuple[int, int, str]]] = {}
+        for rank, (filename, chunk_id, _, text) in enumerate(hits):
+            files.setdefault(filename, []).append((chunk_id, rank, text))
+
+        segments = []
+        for filename, chunks in files.items():
+            chunks.sort()
+            last_id, best_rank, text = chunks[0]
+            for chunk_id, rank, chunk in chunks[1:]:
+                if chunk_id == last_id:
+                    continue
+                if chunk_id == last_id + 1:
+                    text += chunk[_overlap_length(text, chunk, self.max_overlap) :]
+                    best_rank = min(best_rank, rank)
+                else:
+                    segments.append((best_rank, filename, text))
+                    best_rank, text = rank, chunk
+                last_id = chunk_id
+            segments.append((best_rank, filename, text))
+        segments.sort()
+        return segments
+
+    def pack(self, hits: List[Tuple[str, int, float, str]]) -> List[Tuple[str, str]]:
+        """pack retrieved chunks
+
+        Args:
+            hits (List[Tuple[str, int, float, str]]): (filename, chunk id, score, text), best first
+
+        Returns:
+            List[Tuple[str, str]]: List[Tuple(filename, text)], best first
+        """
+        packed = []
+        kept_shingles = []
+        budget = self.token_budget
+        for _, filename, text in self._merge_adjacent(hits):
+            shingles = _shingles(text)
+            if any(
+                len(shingles & kept) >= self.dedup_threshold * len(shingles)
+                for kept in kept_shingles
+            ):
+                continue
+            num_tokens = self.count_tokens(text)
+            if num_tokens > budget:
+                if not packed:
+                    # keep the head of the best segment rather than nothing
+                    packed.append((filename, text[: len(text) * budget // num_tokens]))
+                break
+            packed.append((filename, text))
+            kept_shingles.append(shingles)
+            budget -= num_tokens
+        return packed
@@ -1,21 +1,132 @@
+import asyncio
 import os
-from typing import Dict, List, Union, Optional, Tuple
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Union, Optional, Tuple
 
-from app.document_processing.doc_processor import (DocProcessor,
+import numpy as np
+from app.document_processing.corpus_sync import CorpusSync, SyncResult
+from app.document_processing.doc_processor import (DocProcessor, IngestResult,
                                                    check_if_support_docx)
+from app.engine.answer_cache import AnswerCache
+from app.engine.chat_history import ChatHistory, format_turn
 from app.engine.config import RAGConfig
+from app.engine.context_packer import ContextPacker
 from app.models.generator.generator import Generator
+from app.models.reranker.reranker import Reranker
 from app.utils.logger import get_logger
+from app.utils.tokens import TokenCounter
 
 logger = get_logger(__name__)
 
+DEFAULT_SESSION_ID = "default"
+
+# stable head of every prompt, kept first so that backends can reuse its kv cache
+PROMPT_INSTRUCTION = (
+    "请根据你的知识和检索结果回答最后的问题。"
+    "参考文本之后可能有历史对话，其中'Q:'后面的是问题，'A:'后面的是答案\n"
+)
+
+SUMMARY_PROMPT = (
+    "以下是之前历史对话的摘要和新的历史对话，其中'Q:'后面的是问题，'A:'后面的是答案。\n"
+    "摘要：{summary}\n"
+    "新的历史对话：\n{turns}"
+    "请将它们合并为一段新的摘要，保留问题和答案中的关键信息，不超过{max_chars}字，只输出摘要"
+)
+
 
 class RAGEngine:
     def __init__(self, config: RAGConfig):
-        self.generator = Generator.from_config(config.llm_config)
-        self.doc_processor = DocProcessor(config.doc_config)
+        self.config = config
+        # backends are created on first use or by warm_up, see generator and doc_processor
+        self._generator = None
+        self._doc_processor = None
+        self._reranker = None
+        self._generator_lock = threading.Lock()
+        self._doc_processor_lock = threading.Lock()
+        self._reranker_lock = threading.Lock()
+        # Dict[corpus directory, corpus sync]
+        self._corpus_syncs: Dict[str, CorpusSync] = {}
+        self._corpus_syncs_lock = threading.Lock()
+        # ready is set once warm_up succeeds, warm_up_done once it finishes, with
+        # the error in warm_up_error if it failed
+        self.ready = threading.Event()
+        self.warm_up_done = threading.Event()
+        self.warm_up_error: Optional[str] = None
         logger.info(f"RAGEngine is initialized with config {config}")
-        self.chat_history = []
+        engine_config = config.engine_config
+        self.engine_config = engine_config
+        self.count_tokens = TokenCounter(engine_config.tokenizer_path)
+        # Dict[session id, chat history]
+        self.sessions: "OrderedDict[str, ChatHistory]" = OrderedDict()
+        self._sessions_lock = threading.Lock()
+        self._summary_executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="summary"
+        )
+        self.context_packer = ContextPacker(
+            engine_config.context_token_budget,
+            config.doc_config.overlap,
+            engine_config.context_dedup_threshold,
+            self.count_tokens,
+        )
+        self.answer_cache = None
+        if engine_config.answer_cache_size > 0:
+            self.answer_cache = AnswerCache(
+                engine_config.answer_cache_size,
+                engine_config.answer_cache_threshold,
+                engine_config.answer_cache_ttl,
+            )
+        if engine_config.warm_up:
+            threading.Thread(target=self.warm_up, name="warm_up", daemon=True).start()
+
+    @property
+    def generator(self) -> Generator:
+        """llm backend, created on first use"""
+        if self._generator is None:
+            with self._generator_lock:
+                if self._generator is None:
+                    self._generator = Generator.from_config(self.config.llm_config)
+        return self._generator
+
+    @property
+    def doc_processor(self) -> DocProcessor:
+        """document processor, created on first use"""
+        if self._doc_processor is None:
+            with self._doc_processor_lock:
+                if self._doc_processor is None:
+                    self._doc_processor = DocProcessor(self.config.doc_config)
+        return self._doc_processor
+
+    @property
+    def reranker(self) -> Optional[Reranker]:
+        """reranker of search results, created on first use, None if not configured"""
+        if self.config.rerank_config is None:
+            return None
+        if self._reranker is None:
+            with self._reranker_lock:
+                if self._reranker is None:
+                    self._reranker = Reranker.from_config(self.config.rerank_config)
+        return self._reranker
+
+    def warm_up(self):
+        """create backends and api clients ahead of the first request, ready is set
+        if they are created, otherwise the error is kept in warm_up_error and they are
+        created again on first use"""
+        start = time.perf_counter()
+        try:
+            self.doc_processor.embedder.client
+            self.generator
+            self.reranker
+            self.warm_up_error = None
+            self.ready.set()
+            logger.info(f"RAGEngine is ready in {time.perf_counter() - start:.3f}s")
+        except Exception as e:
+            self.warm_up_error = repr(e)
+            logger.error(f"Failed to warm up RAGEngine: {e}")
+        finally:
+            self.warm_up_done.set()
 
     def _add_single_file(self, file_path: str) -> bool:
         """add a document to rag system
@@ -47,12 +158,104 @@ class RAGEngine:
         """
         if isinstance(file_path, str):
             return self._add_single_file(file_path)
-        elif isinstance(file_path, List[str]):
-            for file in file_path:
-                ret = self._add_single_file(file)
-                if not ret:
-                    return False
+        return all(result.success for result in self.add_docs(file_path))
+
+    def add_docs(
+        self,
+        file_paths: List[str],
+        progress_callback: Optional[Callable[[IngestResult, int, int], None]] = None,
+    ) -> List[IngestResult]:
+        """add a list of documents to rag system in parallel
+
+        Args:
+            file_paths (List[str]): file paths
+            progress_callback (Optional[Callable[[IngestResult, int, int], None]]):
+                called with (result, number of finished files, number of files)
+                each time a file finishes
+
+        Returns:
+            List[IngestResult]: result of each file, in input order
+        """
+        real_paths = [os.path.abspath(file_path) for file_path in file_paths]
+        logger.info(f"Add {len(real_paths)} documents")
+        try:
+            return self.doc_processor.process_documents(real_paths, progress_callback)
+        except Exception as e:
+            logger.error(f"Failed to add documents: {e}")
+            return [IngestResult(path, False, error=repr(e)) for path in real_paths]
+
+    async def aadd_doc(self, file_path: Union[str, List[str]]) -> bool:
+        """async version of add_doc, documents are processed in a worker thread
+
+        Args:
+            file_path (Union[str, List[str]]): file path(s)
+
+        Returns:
+            whether is successfully added
+        """
+        return await asyncio.to_thread(self.add_doc, file_path)
+
+    def update_doc(self, file_path: str) -> bool:
+        """re-index a changed document, only new or changed chunks are embedded
+
+        Args:
+            file_path (str): file path
+
+        Returns:
+            bool: whether is successfully updated
+        """
+        real_path = os.path.abspath(file_path)
+        logger.info(f"Update document: {real_path}")
+        try:
+            self.doc_processor.update_document(real_path)
+            logger.info(f"Document updated successfully: {real_path}")
             return True
+        except Exception as e:
+            logger.error(f"Failed to update document: {real_path}, {e}")
+            return False
+
+    def save(self):
+        """save documents changed since the last save to data directory, documents
+        are also saved after add_docs, after each corpus sync and on shutdown"""
+        if self._doc_processor is not None:
+            self._doc_processor.save()
+
+    def _get_corpus_sync(self, root: str) -> CorpusSync:
+        root = os.path.abspath(root)
+        with self._corpus_syncs_lock:
+            if root not in self._corpus_syncs:
+                self._corpus_syncs[root] = CorpusSync(
+                    self.doc_processor,
+                    root,
+                    self.config.doc_config.ingest_workers,
+                    self.config.doc_config.sync_poll_interval,
+                )
+            return self._corpus_syncs[root]
+
+    def sync_corpus(self, root: str) -> SyncResult:
+        """add, update or remove documents under a directory so that the index
+        matches the files in it, only changed files are processed
+
+        Args:
+            root (str): corpus directory
+
+        Returns:
+            SyncResult: changes made
+        """
+        return self._get_corpus_sync(root).sync()
+
+    def watch_corpus(self, root: str) -> CorpusSync:
+        """sync a directory and keep syncing it on changes in a background thread
+
+        Args:
+            root (str): corpus directory
+
+        Returns:
+            CorpusSync: corpus sync, call its stop to stop watching
+        """
+        corpus_sync = self._get_corpus_sync(root)
+        corpus_sync.start()
+        return corpus_sync
 
     def remove_doc(self, file_path: str) -> bool:
         """remove a document from rag system
@@ -73,24 +276,289 @@ class RAGEngine:
             logger.error(f"Failed to remove document: {real_path}")
             return False
 
-    def query(self, question: str, history: Optional[List[Tuple[str, str]]] = None) -> Dict:
+    def _get_cached_answer(
+        self,
+        embedding: np.ndarray,
+        hits: List[Tuple[str, int, float]],
+        history: Optional[List[Tuple[str, str]]],
+        summary: Optional[str],
+    ) -> Optional[str]:
+        """look up answer cache, answers depending on chat history are not cached
+
+        Args:
+            embedding (np.ndarray): question embedding
+            hits (List[Tuple[str, int, float]]): List[Tuple(filename, chunk id, similarity)]
+            history (Optional[List[Tuple[str, str]]]): chat history
+            summary (Optional[str]): summary of earlier chat history
+
+        Returns:
+            Optional[str]: cached answer, None if missing
+        """
+        if self.answer_cache is None or history or summary:
+            return None
+        context_key = tuple((filename, chunk_id) for filename, chunk_id, _ in hits)
+        return self.answer_cache.get(embedding, context_key, self.doc_processor.version)
+
+    def _cache_answer(
+        self,
+        embedding: np.ndarray,
+        hits: List[Tuple[str, int, float]],
+        history: Optional[List[Tuple[str, str]]],
+        summary: Optional[str],
+        doc_version: int,
+        answer: str,
+    ):
+        """store answer in answer cache, see _get_cached_answer"""
+        if self.answer_cache is None or history or summary or not answer:
+            return
+        context_key = tuple((filename, chunk_id) for filename, chunk_id, _ in hits)
+        self.answer_cache.put(embedding, context_key, doc_version, answer)
+
+    def _get_topk(self, topk: Optional[int]) -> int:
+        """number of chunks referenced by an answer, topk of doc config if None"""
+        return self.doc_processor.topk if topk is None else topk
+
+    def _search_num(self, topk: int) -> int:
+        """number of chunks searched for a question, more than topk when the
+        results are reranked"""
+        if self.config.rerank_config is None:
+            return topk
+        return max(topk, self.config.rerank_config.candidates)
+
+    def _rerank(
+        self, question: str, hits: List[Tuple[str, int, float]], topk: int
+    ) -> List[Tuple[str, int, float]]:
+        """rerank search results and keep the best topk, search results are kept
+        if there is no reranker or reranking fails
+
+        Args:
+            question (str): user question
+            hits (List[Tuple[str, int, float]]): List[Tuple(filename, chunk id, similarity)]
+            topk (int): number of results
+
+        Returns:
+            List[Tuple[str, int, float]]: List[Tuple(filename, chunk id, rerank score)]
+        """
+        if self.reranker is None or len(hits) <= 1:
+            return hits[:topk]
+        try:
+            texts = [text for _, text in self.doc_processor.get_chunks(hits)]
+            ranked = self.reranker.rerank(question, texts, topk)
+        except Exception as e:
+            logger.error(f"Failed to rerank search results: {e}")
+            return hits[:topk]
+        return [(hits[i][0], hits[i][1], score) for i, score in ranked]
+
+    def _search(
+        self,
+        question: str,
+        embedding: np.ndarray,
+        scope: Optional[str],
+        topk: Optional[int],
+    ) -> List[Tuple[str, int, float]]:
+        """search related chunks of the question, then rerank them"""
+        topk = self._get_topk(topk)
+        hits = self.doc_processor.search_by_embedding(
+            embedding, scope, question, self._search_num(topk)
+        )
+        return self._rerank(question, hits, topk)
+
+    async def _asearch(
+        self,
+        question: str,
+        embedding: np.ndarray,
+        scope: Optional[str],
+        topk: Optional[int],
+    ) -> List[Tuple[str, int, float]]:
+        """async version of _search"""
+        topk = self._get_topk(topk)
+        hits = await self.doc_processor.asearch_by_embedding(
+            embedding, scope, question, self._search_num(topk)
+        )
+        if self.reranker is None:
+            return hits[:topk]
+        return await asyncio.to_thread(self._rerank, question, hits, topk)
+
+    def _pack_context(self, hits: List[Tuple[str, int, float]]) -> List[Tuple[str, str]]:
+        """get texts of search results and pack them within the context token budget
+
+        Args:
+            hits (List[Tuple[str, int, float]]): List[Tuple(filename, chunk id, similarity)]
+
+        Returns:
+            List[Tuple[str, str]]: List[Tuple(filename, text)]
+        """
+        chunks = self.doc_processor.get_chunks(hits)
+        return self.context_packer.pack(
+            [(*hit, text) for hit, (_, text) in zip(hits, chunks)]
+        )
+
+    def query(
+        self,
+        question: str,
+        history: Optional[List[Tuple[str, str]]] = None,
+        summary: Optional[str] = None,
+        scope: Optional[str] = None,
+        topk: Optional[int] = None,
+    ) -> Dict:
         """generate answer to the question from user
 
         Args:
             question (str): user question
+            history (Optional[List[Tuple[str, str]]], optional): chat history. Defaults to None.
+            summary (Optional[str], optional): summary of earlier chat history. Defaults to None.
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+            topk (Optional[int], optional): number of referenced chunks. Defaults
+                to None, topk of doc config.
         """
         try:
-            results = self.doc_processor.search_ralated_chunk(question)
-            prompt = self._make_prompt(question, results, history)
-            # 这个接口是不是做成generate(context, question) ?
-            # 还有对话历史
-            answer = self.generator.generate(prompt)
-            self.chat_history.append((question, answer))
+            doc_version = self.doc_processor.version
+            embedding = self.doc_processor.embed_query(question)
+            hits = self._search(question, embedding, scope, topk)
+            results = self._pack_context(hits)
+            answer = self._get_cached_answer(embedding, hits, history, summary)
+            if answer is None:
+                prompt = self._make_prompt(question, results, history, summary)
+                # 这个接口是不是做成generate(context, question) ?
+                # 还有对话历史
+                answer = self.generator.generate(prompt)
+                self._cache_answer(
+                    embedding, hits, history, summary, doc_version, answer
+                )
             return {"answer": answer, "reference": results}
         except Exception as e:
             logger.error(f"Failed to generate answer: {e}")
             return {"answer": None, "reference": None}
 
+    def query_batch(
+        self,
+        questions: List[str],
+        max_workers: int = 4,
+        scope: Optional[str] = None,
+        topk: Optional[int] = None,
+    ) -> List[Dict]:
+        """generate answers to many questions, questions are embedded and searched in
+        one pass and answers are generated concurrently. Answers are not added to
+        chat history.
+
+        Args:
+            questions (List[str]): user questions
+            max_workers (int, optional): max number of concurrent generations. Defaults to 4.
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+            topk (Optional[int], optional): number of referenced chunks. Defaults
+                to None, topk of doc config.
+
+        Returns:
+            List[Dict]: result of each question, in input order
+        """
+        topk = self._get_topk(topk)
+        try:
+            searched = self.doc_processor.search_batch_by_text(
+                questions, scope, self._search_num(topk)
+            )
+            results = [
+                self._pack_context(self._rerank(question, hits, topk))
+                for question, hits in zip(questions, searched)
+            ]
+        except Exception as e:
+            logger.error(f"Failed to search related chunks: {e}")
+            return [{"answer": None, "reference": None} for _ in questions]
+
+        def generate(question: str, result: List[Tuple[str, str]]) -> Dict:
+            try:
+                answer = self.generator.generate(self._make_prompt(question, result))
+                return {"answer": answer, "reference": result}
+            except Exception as e:
+                logger.error(f"Failed to generate answer: {e}")
+                return {"answer": None, "reference": None}
+
+        if max_workers <= 1:
+            return [generate(q, r) for q, r in zip(questions, results)]
+        with ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(generate, questions, results))
+
+    async def aquery(
+        self,
+        question: str,
+        history: Optional[List[Tuple[str, str]]] = None,
+        summary: Optional[str] = None,
+        scope: Optional[str] = None,
+        topk: Optional[int] = None,
+    ) -> Dict:
+        """async version of query, many questions can be answered concurrently
+        in one event loop
+
+        Args:
+            question (str): user question
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+            topk (Optional[int], optional): number of referenced chunks. Defaults
+                to None, topk of doc config.
+        """
+        try:
+            doc_version = self.doc_processor.version
+            embedding = await self.doc_processor.aembed_query(question)
+            hits = await self._asearch(question, embedding, scope, topk)
+            results = self._pack_context(hits)
+            answer = self._get_cached_answer(embedding, hits, history, summary)
+            if answer is None:
+                prompt = self._make_prompt(question, results, history, summary)
+                answer = await self.generator.agenerate(prompt)
+                self._cache_answer(
+                    embedding, hits, history, summary, doc_version, answer
+                )
+            return {"answer": answer, "reference": results}
+        except Exception as e:
+            logger.error(f"Failed to generate answer: {e}")
+            return {"answer": None, "reference": None}
+
+    async def aquery_stream(
+        self,
+        question: str,
+        history: Optional[List[Tuple[str, str]]] = None,
+        summary: Optional[str] = None,
+        scope: Optional[str] = None,
+        topk: Optional[int] = None,
+    ):
+        """async version of query_stream
+
+        Args:
+            question (str): user question
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+            topk (Optional[int], optional): number of referenced chunks. Defaults
+                to None, topk of doc config.
+        """
+        try:
+            doc_version = self.doc_processor.version
+            embedding = await self.doc_processor.aembed_query(question)
+            hits = await self._asearch(question, embedding, scope, topk)
+            results = self._pack_context(hits)
+            complete_answer = self._get_cached_answer(
+                embedding, hits, history, summary
+            )
+            if complete_answer is not None:
+                yield {"answer": complete_answer, "reference": results}
+            else:
+                prompt = self._make_prompt(question, results, history, summary)
+                stream = await self.generator.agenerate_stream(prompt)
+                complete_answer = ""
+                async for chunk in stream:
+                    if len(chunk.choices) == 0:
+                        continue
+                    partial_answer = chunk.choices[0].delta.content
+                    if partial_answer is not None:
+                        complete_answer += partial_answer
+                        yield {"answer": partial_answer, "reference": results}
+                self._cache_answer(
+                    embedding, hits, history, summary, doc_version, complete_answer
+                )
+        except Exception as e:
+            logger.error(f"Failed to generate answer: {e}")
+            yield {"answer": None, "reference": None}
+
     def check_query_stream_support(self) -> bool:
         """check if llm backend supports generate stream
 
@@ -99,79 +567,215 @@ class RAGEngine:
         """
         return self.generator.check_query_stream_support()
     
-    def _make_prompt(self, question: str, search_results: List[Tuple[str, str]], history: Optional[List[Tuple[str, str]]]=None):
+    def _make_prompt(
+        self,
+        question: str,
+        search_results: List[Tuple[str, str]],
+        history: Optional[List[Tuple[str, str]]] = None,
+        summary: Optional[str] = None,
+    ):
         """prompt maker
 
         Args:
             question (str): user input
             search_results (List[Tuple[str, str]]): related chunks in uploaded files
             history (Optional[List[Tuple[str, str]]], optional): chat history. Defaults to None.
+            summary (Optional[str], optional): summary of earlier chat history. Defaults to None.
 
         Returns:
             _type_: prompt for llm input
         """
         context = [tup[1] for tup in search_results]
         context = "\n".join(context)
-        prompt = context + "\n以上是检索到的参考文本\n"
+        prompt = PROMPT_INSTRUCTION + context + "\n以上是检索到的参考文本\n"
+        if summary:
+            prompt += summary + "\n以上是更早的历史对话的摘要\n"
         if history:
-            prompt += "\n".join(f"Q:{q}\nA:{a}\n" for q, a in history)
-            prompt += "除了参考文本外，以上是历史对话。其中'Q:'后面的是问题，'A:'后面的是答案\n"
-        prompt += f"请根据你的知识和检索结果回答以下问题\nQ:{question}"
+            prompt += "\n".join(format_turn(q, a) for q, a in history)
+            prompt += "以上是历史对话\n"
+        prompt += f"Q:{question}"
         return prompt
 
-    def query_stream(self, question: str, history: Optional[List[Tuple[str, str]]] = None):
+    def query_stream(
+        self,
+        question: str,
+        history: Optional[List[Tuple[str, str]]] = None,
+        summary: Optional[str] = None,
+        scope: Optional[str] = None,
+        topk: Optional[int] = None,
+    ):
         """generate answer to question from user, in stream mode
 
         Args:
             question (str): user question
+            history (Optional[List[Tuple[str, str]]], optional): chat history. Defaults to None.
+            summary (Optional[str], optional): summary of earlier chat history. Defaults to None.
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+            topk (Optional[int], optional): number of referenced chunks. Defaults
+                to None, topk of doc config.
         """
         try:
-            results = self.doc_processor.search_ralated_chunk(question)
-            prompt = self._make_prompt(question, results, history)
-            stream = self.generator.generate_stream(prompt)
-            complete_answer = ""
-            for chunk in stream:
-                if len(chunk.choices) == 0:
-                    continue
-                partial_answer = chunk.choices[0].delta.content
-                if partial_answer is not None:
-                    complete_answer += partial_answer
-                    yield {"answer": partial_answer, "reference": results}
-            self.chat_history.append((question, complete_answer))
+            doc_version = self.doc_processor.version
+            embedding = self.doc_processor.embed_query(question)
+            hits = self._search(question, embedding, scope, topk)
+            results = self._pack_context(hits)
+            complete_answer = self._get_cached_answer(
+                embedding, hits, history, summary
+            )
+            if complete_answer is not None:
+                yield {"answer": complete_answer, "reference": results}
+            else:
+                prompt = self._make_prompt(question, results, history, summary)
+                stream = self.generator.generate_stream(prompt)
+                complete_answer = ""
+                for chunk in stream:
+                    if len(chunk.choices) == 0:
+                        continue
+                    partial_answer = chunk.choices[0].delta.content
+                    if partial_answer is not None:
+                        complete_answer += partial_answer
+                        yield {"answer": partial_answer, "reference": results}
+                self._cache_answer(
+                    embedding, hits, history, summary, doc_version, complete_answer
+                )
         except Exception as e:
             logger.error(f"Failed to generate answer: {e}")
             yield {"answer": None, "reference": None}
 
-    def _get_history(self):
-        """get chat history
+    def _get_history(self, session_id: str) -> ChatHistory:
+        """get chat history of a session, least recently used sessions are dropped
+        once there are more than max_sessions
+
+        Args:
+            session_id (str): session id
+
+        Returns:
+            ChatHistory: chat history
         """
-        # TODO: 考虑最大长度？
-        return self.chat_history
+        with self._sessions_lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = ChatHistory(
+                    self.engine_config.history_token_budget,
+                    self.engine_config.history_recent_turns,
+                    self.count_tokens,
+                    self._summarize_history,
+                    self._summary_executor,
+                )
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.engine_config.max_sessions:
+                self.sessions.popitem(last=False)
+            return self.sessions[session_id]
 
-    def query_chat(self, question: str):
-        history = self._get_history()
-        return self.query(question, history)
-    
-    def query_chat_stream(self, question: str):
-        history = self._get_history()
-        return self.query_stream(question, history)
+    def _summarize_history(self, summary: str, turns: List[Tuple[str, str]]) -> str:
+        """fold chat turns into summary of earlier chat history
+
+        Args:
+            summary (str): current summary
+            turns (List[Tuple[str, str]]): turns to be folded
+
+        Returns:
+            str: new summary
+        """
+        prompt = SUMMARY_PROMPT.format(
+            max_chars=self.engine_config.history_summary_max_chars,
+            summary=summary or "无",
+            turns="".join(format_turn(q, a) for q, a in turns),
+        )
+        return self.generator.generate(prompt)
 
-    def get_status(self) -> str:
+    def clear_history(self, session_id: str = DEFAULT_SESSION_ID):
+        """clear chat history of a session
+
+        Args:
+            session_id (str, optional): session id. Defaults to DEFAULT_SESSION_ID.
+        """
+        self._get_history(session_id).clear()
+
+    def query_chat(
+        self,
+        question: str,
+        session_id: str = DEFAULT_SESSION_ID,
+        scope: Optional[str] = None,
+        topk: Optional[int] = None,
+    ) -> Dict:
+        """generate answer to the question with chat history of the session
+
+        Args:
+            question (str): user question
+            session_id (str, optional): session id. Defaults to DEFAULT_SESSION_ID.
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+            topk (Optional[int], optional): number of referenced chunks. Defaults
+                to None, topk of doc config.
+        """
+        chat_history = self._get_history(session_id)
+        summary, history = chat_history.get_context()
+        result = self.query(question, history, summary, scope, topk)
+        if result["answer"]:
+            chat_history.append(question, result["answer"])
+        return result
+
+    def query_chat_stream(
+        self,
+        question: str,
+        session_id: str = DEFAULT_SESSION_ID,
+        scope: Optional[str] = None,
+        topk: Optional[int] = None,
+    ):
+        """generate answer to the question with chat history of the session, in
+        stream mode
+
+        Args:
+            question (str): user question
+            session_id (str, optional): session id. Defaults to DEFAULT_SESSION_ID.
+            scope (Optional[str], optional): only documents under this directory are
+                searched. Defaults to None, all documents.
+            topk (Optional[int], optional): number of referenced chunks. Defaults
+                to None, topk of doc config.
+        """
+        chat_history = self._get_history(session_id)
+        summary, history = chat_history.get_context()
+        complete_answer = ""
+        for partial_result in self.query_stream(
+            question, history, summary, scope, topk
+        ):
+            if partial_result["answer"] is not None:
+                complete_answer += partial_result["answer"]
+            yield partial_result
+        if complete_answer:
+            chat_history.append(question, complete_answer)
+
+    def get_status(self) -> Dict[str, Any]:
         """get status of service
 
         Returns:
-            bool: True if alive, else False
+            Dict[str, Any]: liveness, readiness, error of a failed warm up and cache
+                stats
         """
 
-        return {"status": "alive"}
+        return {
+            "status": "alive",
+            "ready": self.ready.is_set(),
+            "warm_up_error": self.warm_up_error,
+            "embedding_cache": self.doc_processor.get_embedding_cache_stats(),
+            "chunk_store": self.doc_processor.get_chunk_store_stats(),
+            "answer_cache": {}
+            if self.answer_cache is None
+            else self.answer_cache.get_stats(),
+        }
 
-    def get_doc_list(self) -> List[str]:
-        """get all documents stored in database
+    def get_doc_list(self, scope: Optional[str] = None) -> List[str]:
+        """get documents stored in database
+
+        Args:
+            scope (Optional[str], optional): only documents under this directory are
+                listed. Defaults to None, all documents.
 
         Returns:
             List[str]: list of document name
         """
-        return self.doc_processor.get_doc_list()
+        return self.doc_processor.get_doc_list(scope)
 
     def update_topk(self, topk: int):
         """update topk param while retrieval
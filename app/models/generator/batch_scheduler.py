@@ -0,0 +1,88 @@
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable, List
+
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class _Request:
+    item: Any
+    key: Hashable
+    future: Future = field(default_factory=Future)
+    created: float = field(default_factory=time.monotonic)
+
+
+class BatchScheduler:
+    """collect concurrent requests into dynamic batches
+
+    Requests are grouped by `key`, only requests with the same key are batched
+    together, e.g. prompts of similar length and the same sampling params. A batch
+    is run by `run_batch` in a worker thread as soon as it is full, or when its
+    oldest request has waited `max_wait_ms`.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int,
+        max_wait_ms: float,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._pending: List[_Request] = []
+        self._cond = threading.Condition()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, item: Any, key: Hashable) -> Future:
+        """add a request
+
+        Args:
+            item (Any): request passed to run_batch
+            key (Hashable): batching key
+
+        Returns:
+            Future: result of the request
+        """
+        request = _Request(item, key)
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify()
+        return request.future
+
+    def _next_batch(self) -> List[_Request]:
+        """wait for the batch of the oldest request"""
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            oldest = self._pending[0]
+            deadline = oldest.created + self.max_wait
+            while True:
+                batch = [r for r in self._pending if r.key == oldest.key]
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = batch[: self.max_batch_size]
+            batch_ids = {id(r) for r in batch}
+            self._pending = [r for r in self._pending if id(r) not in batch_ids]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.run_batch([r.item for r in batch])
+            except Exception as e:
+                logger.error(f"Failed to run a batch of {len(batch)} requests: {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
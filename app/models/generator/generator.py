@@ -1,8 +1,10 @@
+import asyncio
 import importlib
 import os
 import sys
+from types import SimpleNamespace
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Optional, Type
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Type
 
 from app.engine.config import GeneratorConfig
 from app.utils.logger import get_logger
@@ -17,6 +19,39 @@ GENERATOR_CONFIG_MODULENAME_CLASSNAME_MAP = {
 
 logger = get_logger(__name__)
 
+SYSTEM_PROMPT = "你是LLM智能助手"
+
+
+async def iterate_in_thread(iterable: Iterable) -> AsyncIterator:
+    """iterate a blocking iterable in worker threads without blocking event loop
+
+    Args:
+        iterable (Iterable): blocking iterable, such as a sync stream
+
+    Yields:
+        items of iterable
+    """
+    iterator = iter(iterable)
+    end = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, end)
+        if item is end:
+            return
+        yield item
+
+
+def make_stream_chunk(content: str) -> SimpleNamespace:
+    """wrap a piece of text like a chunk of openai chat completion stream, so
+    that all backends stream in the same shape
+
+    Args:
+        content (str): generated text
+
+    Returns:
+        SimpleNamespace: chunk with `choices[0].delta.content`
+    """
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
 
 class Generator(ABC):
 
@@ -45,6 +80,22 @@ class Generator(ABC):
         if "max_tokens" in config and config["max_tokens"] <= 0:
             raise ValueError("Max tokens must be a positive integer")
 
+    @staticmethod
+    def make_messages(prompt: str) -> List[Dict[str, str]]:
+        """make chat messages, the system prompt is always first so that the
+        prompt prefix stays the same across requests
+
+        Args:
+            prompt: input prompt
+
+        Returns:
+            return: chat messages
+        """
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ]
+
     @abstractmethod
     def generate(self, prompt: str, **kwargs) -> str:
         """Call llm for generation
@@ -79,6 +130,33 @@ class Generator(ABC):
         """
         raise NotImplementedError("generate stream must be implemented in subclasses.")
 
+    async def agenerate(self, prompt: str, **kwargs) -> str:
+        """async version of generate, runs generate in a worker thread unless
+        subclasses provide a native implementation
+
+        Args:
+            prompt: input prompt
+            kwargs: other params, such as temperature and max_tokens
+
+        Returns:
+            return: output text
+        """
+        return await asyncio.to_thread(self.generate, prompt, **kwargs)
+
+    async def agenerate_stream(self, prompt: str, **kwargs) -> AsyncIterator:
+        """async version of generate_stream, iterates generate_stream in worker
+        threads unless subclasses provide a native implementation
+
+        Args:
+            prompt: input prompt
+            kwargs: other params, such as temperature and max_tokens
+
+        Returns:
+            return: output async iterator
+        """
+        stream = await asyncio.to_thread(self.generate_stream, prompt, **kwargs)
+        return iterate_in_thread(stream)
+
     def __call__(self, prompt: str, **kwargs) -> str:
         return self.generate(prompt, **kwargs)
 
@@ -16,6 +16,7 @@ class GeneratorApi(Generator):
         if api_key is None:
             api_key = "api_key" if config.api_key == "" else config.api_key
         self.client = openai.OpenAI(api_key=api_key, base_url=config.api_url)
+        self.async_client = openai.AsyncOpenAI(api_key=api_key, base_url=config.api_url)
         logger.info(f"GeneratorAPI initialized, api_url: {config.api_url}")
         self._stream_support = True
 
@@ -23,10 +24,7 @@ class GeneratorApi(Generator):
         # generation_config = {**self.config, **kwargs}
         response = self.client.chat.completions.create(
             model=self.model_name,
-            messages=[
-                {"role": "system", "content": "你是LLM智能助手"},
-                {"role": "user", "content": prompt},
-            ],
+            messages=self.make_messages(prompt),
             max_tokens=1024,
         )
 
@@ -35,10 +33,26 @@ class GeneratorApi(Generator):
     def generate_stream(self, prompt: str, **kwargs) -> str:
         stream = self.client.chat.completions.create(
             model=self.model_name,
-            messages=[
-                {"role": "system", "content": "你是LLM智能助手"},
-                {"role": "user", "content": prompt},
-            ],
+            messages=self.make_messages(prompt),
+            stream=True,
+            max_tokens=1024,
+        )
+
+        return stream
+
+    async def agenerate(self, prompt: str, **kwargs) -> str:
+        response = await self.async_client.chat.completions.create(
+            model=self.model_name,
+            messages=self.make_messages(prompt),
+            max_tokens=1024,
+        )
+
+        return response.choices[0].message.content
+
+    async def agenerate_stream(self, prompt: str, **kwargs):
+        stream = await self.async_client.chat.completions.create(
+            model=self.model_name,
+            messages=self.make_messages(prompt),
             stream=True,
             max_tokens=1024,
         )
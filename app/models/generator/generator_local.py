@@ -1,25 +1,62 @@
+import asyncio
+import copy
 import importlib
-from typing import Any, Dict
+import importlib.util
+import inspect
+import threading
+from dataclasses import astuple
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
 
 import torch
-from app.models.generator.generator import Generator, GeneratorConfig
-from utils.logger import get_logger
+from app.models.generator.batch_scheduler import BatchScheduler
+from app.models.generator.generator import (Generator, GeneratorConfig,
+                                            make_stream_chunk)
+from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+# shortest common prompt prefix, in tokens, worth keeping a kv cache for
+MIN_PREFIX_CACHE_TOKENS = 16
+NO_BACKEND_MESSAGE = "No available local generation framework, please use GeneratorApi"
+
 
 def is_module_available(module_name: str):
-    try:
-        module = importlib.import_module(module_name, None)
-        logger.info(f"{module_name} is available.")
-        return True
-    except ModuleNotFoundError:
+    # find_spec does not import the module, which is slow for vllm
+    if importlib.util.find_spec(module_name) is None:
         return False
+    logger.info(f"{module_name} is available.")
+    return True
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
 
 
 class GeneratorLocal(Generator):
+    # Dict[config, generator state], generators of the same config share one
+    # loaded model, its prefix cache and batch scheduler
+    _shared_states: Dict[tuple, Dict[str, Any]] = {}
+    _shared_states_lock = threading.Lock()
+
     def __init__(self, config: GeneratorConfig = None):
+        with self._shared_states_lock:
+            key = astuple(config)
+            if key in self._shared_states:
+                self.__dict__ = self._shared_states[key]
+                logger.info(f"Reuse loaded local model {self.model_path}")
+                return
+            self._init(config)
+            self._shared_states[key] = self.__dict__
+
+    def _init(self, config: GeneratorConfig):
         super().__init__(config)
+        self.backend = None
         if is_module_available("vllm"):
             self.backend = "vllm"
             self._init_vllm()
@@ -27,22 +64,39 @@ class GeneratorLocal(Generator):
             self.backend = "transformers"
             self._init_transformers()
         else:
-            logger.info(
-                "No available local generation framework, please use GeneratorApi"
-            )
-        self._stream_support = False
+            logger.info(NO_BACKEND_MESSAGE)
+        self._stream_support = self.backend is not None
 
     def _init_vllm(self):
         """init vllm backend if vllm is available
 
+        The async engine runs on an event loop in a daemon thread, concurrent
+        requests are continuously batched by vllm and streamed token by token. Kv cache of common prompt
+        prefixes is reused by vllm automatic prefix caching.
+
         Args:
             config (GeneratorConfig): generator config
         """
         logger.info("Using vllm as local generation backend")
-        from vllm import LLM, SamplingParams
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
 
-        self.vllm_sampling_params = SamplingParams(temperature=0.8, top_p=0.95)
-        self.model = LLM(model=self.model_path)
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+        engine_args = AsyncEngineArgs(
+            model=self.model_path, enable_prefix_caching=self.config.prefix_cache
+        )
+
+        async def create_engine():
+            model = AsyncLLMEngine.from_engine_args(engine_args)
+            tokenizer = model.get_tokenizer()
+            if inspect.isawaitable(tokenizer):
+                tokenizer = await tokenizer
+            return model, tokenizer
+
+        self.model, self.tokenizer = asyncio.run_coroutine_threadsafe(
+            create_engine(), self._loop
+        ).result()
 
     def _init_transformers(self):
         """init transformers if transformers is available
@@ -64,24 +118,238 @@ class GeneratorLocal(Generator):
             self.device
         )
 
-    def _generate_vllm(self, prompt: str, **kwargs) -> str:
-        outputs = self.model.generate(prompt, self.vllm_sampling_params)
-        return outputs.output[0].text
+        # kv cache of the last reused prompt prefix, see _get_prefix_cache
+        self._prefix_ids: List[int] = []
+        self._prefix_kv = None
+        self._last_input_ids: List[int] = []
+        self._prefix_lock = threading.Lock()
+
+        self.scheduler = None
+        if self.config.max_batch_size > 1:
+            self.scheduler = BatchScheduler(
+                self._generate_transformers_batch,
+                self.config.max_batch_size,
+                self.config.max_wait_ms,
+            )
+
+    def _raise_no_backend(self):
+        logger.error(NO_BACKEND_MESSAGE)
+        raise ValueError(NO_BACKEND_MESSAGE)
+
+    def _make_text(self, prompt: str) -> str:
+        """format prompt with chat template of the model if it has one"""
+        messages = self.make_messages(prompt)
+        if getattr(self.tokenizer, "chat_template", None):
+            return self.tokenizer.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+        return "\n".join(message["content"] for message in messages) + "\n"
+
+    def _tokenize(self, prompt: str) -> List[int]:
+        # special tokens are already added by chat template
+        add_special_tokens = not getattr(self.tokenizer, "chat_template", None)
+        return self.tokenizer(
+            self._make_text(prompt), add_special_tokens=add_special_tokens
+        )["input_ids"]
+
+    def _get_prefix_cache(self, input_ids: List[int]) -> Optional[Any]:
+        """get kv cache of the cached prompt prefix if input starts with it
+
+        On a miss, the prefix shared with the previous input, such as system
+        prompt and instructions, is computed and cached for later inputs.
+
+        Args:
+            input_ids (List[int]): input token ids
+
+        Returns:
+            Optional[Any]: a copy of the prefix kv cache which generate may extend,
+                None if no cached prefix matches
+        """
+        from transformers import DynamicCache
+
+        with self._prefix_lock:
+            last_ids, self._last_input_ids = self._last_input_ids, input_ids
+            num_cached = len(self._prefix_ids)
+            if (
+                num_cached
+                and num_cached < len(input_ids)
+                and input_ids[:num_cached] == self._prefix_ids
+            ):
+                return copy.deepcopy(self._prefix_kv)
+
+            # at least the last input token is left for generate
+            length = min(common_prefix_length(last_ids, input_ids), len(input_ids) - 1)
+            if length < MIN_PREFIX_CACHE_TOKENS:
+                return None
+            prefix = torch.tensor([input_ids[:length]], device=self.device)
+            with torch.no_grad():
+                self._prefix_kv = self.model(
+                    prefix, past_key_values=DynamicCache(), use_cache=True
+                ).past_key_values
+            self._prefix_ids = input_ids[:length]
+            logger.info(f"Kv cache of {length} prompt prefix tokens is kept")
+            return copy.deepcopy(self._prefix_kv)
+
+    def _make_sampling_params(self, **kwargs):
+        from vllm import SamplingParams
 
-    def _generate_transformers(self, prompt: str, **kwargs) -> str:
         generation_config = self.make_generation_config(**kwargs)
+        return SamplingParams(
+            temperature=generation_config["temperature"],
+            top_p=generation_config["top_p"],
+            top_k=generation_config["top_k"],
+            max_tokens=generation_config["max_tokens"],
+        )
+
+    async def _stream_vllm(self, prompt: str, **kwargs) -> AsyncIterator[str]:
+        """generate with vllm async engine, runs on self._loop
+
+        Yields:
+            str: newly generated text
+        """
+        sampling_params = self._make_sampling_params(**kwargs)
+        num_chars = 0
+        async for output in self.model.generate(
+            self._make_text(prompt), sampling_params, uuid4().hex
+        ):
+            # outputs hold the text generated so far
+            text = output.outputs[0].text
+            if len(text) > num_chars:
+                yield text[num_chars:]
+                num_chars = len(text)
+
+    def _iterate_vllm(self, stream: AsyncIterator[str]) -> Iterator[str]:
+        """iterate an async iterator of self._loop from other threads"""
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(
+                    stream.__anext__(), self._loop
+                ).result()
+            except StopAsyncIteration:
+                return
 
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+    async def _aiterate_vllm(self, stream: AsyncIterator[str]) -> AsyncIterator:
+        """iterate an async iterator of self._loop from other event loops"""
+        while True:
+            try:
+                text = await asyncio.wrap_future(
+                    asyncio.run_coroutine_threadsafe(stream.__anext__(), self._loop)
+                )
+            except StopAsyncIteration:
+                return
+            yield make_stream_chunk(text)
+
+    @staticmethod
+    def _make_sampling_kwargs(generation_config: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "max_new_tokens": generation_config["max_tokens"],
+            "temperature": generation_config["temperature"],
+            "top_p": generation_config["top_p"],
+            "top_k": generation_config["top_k"],
+            "do_sample": True,
+        }
+
+    def _make_transformers_inputs(
+        self, input_ids: List[int], generation_config: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """make arguments of model.generate for one input
+
+        Returns:
+            Dict[str, Any]: generate arguments
+        """
+        past_key_values = None
+        if self.config.prefix_cache:
+            past_key_values = self._get_prefix_cache(input_ids)
+        inputs = torch.tensor([input_ids], device=self.device)
+        return {
+            "inputs": inputs,
+            "attention_mask": torch.ones_like(inputs),
+            "past_key_values": past_key_values,
+            **self._make_sampling_kwargs(generation_config),
+        }
+
+    def _generate_transformers(
+        self, input_ids: List[int], generation_config: Dict[str, Any]
+    ) -> str:
+        generate_kwargs = self._make_transformers_inputs(input_ids, generation_config)
+
+        with torch.no_grad():
+            outputs = self.model.generate(**generate_kwargs)
+
+        return self.tokenizer.decode(
+            outputs[0][len(input_ids) :], skip_special_tokens=True
+        )
+
+    def _generate_transformers_batch(
+        self, requests: List[Tuple[List[int], Dict[str, Any]]]
+    ) -> List[str]:
+        """generate a batch of left padded inputs sharing the same generation config,
+        run by the batch scheduler
+
+        Args:
+            requests (List[Tuple[List[int], Dict[str, Any]]]): (input ids, generation config)
+
+        Returns:
+            List[str]: answers
+        """
+        if len(requests) == 1:
+            # single inputs can reuse prefix kv cache
+            return [self._generate_transformers(*requests[0])]
+
+        pad_id = self.tokenizer.pad_token_id
+        if pad_id is None:
+            pad_id = self.tokenizer.eos_token_id
+        num_inputs = max(len(input_ids) for input_ids, _ in requests)
+        inputs, attention_mask = [], []
+        for input_ids, _ in requests:
+            num_pads = num_inputs - len(input_ids)
+            inputs.append([pad_id] * num_pads + input_ids)
+            attention_mask.append([0] * num_pads + [1] * len(input_ids))
 
         with torch.no_grad():
             outputs = self.model.generate(
-                inputs.input_ids,
-                max_length=generation_config.get("max_tokens", 512),
-                temperature=generation_config.get("temperature", 1.0),
-                **generation_config,
+                torch.tensor(inputs, device=self.device),
+                attention_mask=torch.tensor(attention_mask, device=self.device),
+                pad_token_id=pad_id,
+                **self._make_sampling_kwargs(requests[0][1]),
             )
 
-        return self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+        return self.tokenizer.batch_decode(
+            outputs[:, num_inputs:], skip_special_tokens=True
+        )
+
+    def _stream_transformers(self, prompt: str, **kwargs) -> Iterator[str]:
+        """generate in a worker thread and yield text pieces from a streamer
+
+        Yields:
+            str: newly generated text
+        """
+        from transformers import TextIteratorStreamer
+
+        generate_kwargs = self._make_transformers_inputs(
+            self._tokenize(prompt), self.make_generation_config(**kwargs)
+        )
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        errors = []
+
+        def generate():
+            try:
+                with torch.no_grad():
+                    self.model.generate(streamer=streamer, **generate_kwargs)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        for text in streamer:
+            if text:
+                yield text
+        thread.join()
+        if errors:
+            raise errors[0]
 
     def make_generation_config(self, **kwargs) -> Dict[str, Any]:
         """merge default params and user inputs
@@ -99,8 +367,8 @@ class GeneratorLocal(Generator):
             "top_k": 50,
         }
 
-        # priority: kwargs > self.config > default_config
-        generation_config = {**default_config, **self.config, **kwargs}
+        # priority: kwargs > default_config
+        generation_config = {**default_config, **kwargs}
 
         self._validate_config(generation_config)
 
@@ -116,24 +384,40 @@ class GeneratorLocal(Generator):
             str: answer
         """
         if self.backend == "vllm":
-            return self._generate_vllm(prompt, kwargs)
+            return "".join(self._iterate_vllm(self._stream_vllm(prompt, **kwargs)))
         elif self.backend == "transformers":
-            return self._generate_transformers(prompt, kwargs)
+            input_ids = self._tokenize(prompt)
+            generation_config = self.make_generation_config(**kwargs)
+            if self.scheduler is None:
+                return self._generate_transformers(input_ids, generation_config)
+            # only inputs of similar length and the same generation config are batched
+            key = (
+                (len(input_ids) - 1).bit_length(),
+                tuple(sorted(generation_config.items())),
+            )
+            return self.scheduler.submit((input_ids, generation_config), key).result()
+        else:
+            self._raise_no_backend()
 
-    def generate_stream(self, prompt: str, **kwargs):
+    def generate_stream(self, prompt: str, **kwargs) -> Iterator:
         """generate answer with prompt and kwargs in stream
 
         Args:
             prompt (str): input question
 
         Returns:
-            generator
+            Iterator: chunks shaped like openai stream chunks, text is in
+                `chunk.choices[0].delta.content`
         """
-        # if self.backend == "vllm":
-        #     return self._generate_vllm(prompt, kwargs)
-        # elif self.backend == "transformers":
-        #     return self._generate_transformers(prompt, kwargs)
-        pass
-
+        if self.backend == "vllm":
+            stream = self._iterate_vllm(self._stream_vllm(prompt, **kwargs))
+        elif self.backend == "transformers":
+            stream = self._stream_transformers(prompt, **kwargs)
+        else:
+            self._raise_no_backend()
+        return (make_stream_chunk(text) for text in stream)
 
-Generator.register_subclass("LOCAL", GeneratorLocal)
+    async def agenerate_stream(self, prompt: str, **kwargs) -> AsyncIterator:
+        if self.backend == "vllm":
+            return self._aiterate_vllm(self._stream_vllm(prompt, **kwargs))
+        return await super().agenerate_stream(prompt, **kwargs)
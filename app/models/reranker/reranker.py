@@ -0,0 +1,107 @@
+import importlib
+import os
+import sys
+import time
+from abc import ABC, abstractmethod
+from typing import List, Tuple
+
+from app.engine.config import RerankerConfig
+from app.utils.logger import get_logger
+
+RERANKER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(RERANKER_DIR)
+
+RERANKER_CONFIG_MODULENAME_CLASSNAME_MAP = {
+    "api": ("reranker_api", "RerankerApi"),
+    "local": ("reranker_local", "RerankerLocal"),
+}
+
+logger = get_logger(__name__)
+
+
+class Reranker(ABC):
+    """score (query, text) pairs with a cross-encoder and keep the best texts"""
+
+    def __init__(self, config: RerankerConfig):
+        self.model_name = config.model
+        self.config = config
+        self.batch_size = config.batch_size
+        self.latency_budget = config.latency_budget_ms / 1000
+        if self.config.backend_type.lower() == "local":
+            self.model_path = os.path.join(self.config.path or "", self.config.model)
+            if not os.path.exists(self.model_path):
+                logger.info(
+                    f"Model path {self.model_path} does not exist, "
+                    f"model {self.model_name} will be downloaded from cloud."
+                )
+                self.model_path = self.model_name
+
+    @abstractmethod
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        """score relevance of each text to the query
+
+        Args:
+            query (str): query
+            texts (List[str]): texts, no more than batch size
+
+        Returns:
+            List[float]: relevance scores, higher is more relevant
+        """
+        raise NotImplementedError("score must be implemented in subclasses.")
+
+    def rerank(self, query: str, texts: List[str], topk: int) -> List[Tuple[int, float]]:
+        """rerank texts retrieved for the query
+
+        Texts are scored batch by batch in retrieval order. Once the latency budget
+        is used up, the remaining texts are not scored and are ranked after the
+        scored ones, in retrieval order.
+
+        Args:
+            query (str): query
+            texts (List[str]): candidate texts, best first
+            topk (int): number of results
+
+        Returns:
+            List[Tuple[int, float]]: List[Tuple(index in texts, score)], best first.
+                Texts not scored get score -inf.
+        """
+        deadline = time.perf_counter() + self.latency_budget
+        scores = []
+        for start in range(0, len(texts), self.batch_size):
+            if start and time.perf_counter() > deadline:
+                logger.warning(
+                    f"Rerank latency budget is used up, {len(texts) - start} of "
+                    f"{len(texts)} candidates are not scored"
+                )
+                break
+            scores.extend(self.score(query, texts[start : start + self.batch_size]))
+        ranked = sorted(enumerate(scores), key=lambda x: x[1], reverse=True)
+        ranked.extend((i, float("-inf")) for i in range(len(scores), len(texts)))
+        return ranked[:topk]
+
+    @classmethod
+    def from_config(cls, config: RerankerConfig):
+        """create subclass instance from config
+
+        Args:
+            config (RerankerConfig): config
+
+        Raises:
+            ValueError: if invalid subclass name
+
+        Returns:
+            _type_: subclass instance
+        """
+        reranker_type = config.backend_type.lower()
+        if reranker_type not in RERANKER_CONFIG_MODULENAME_CLASSNAME_MAP:
+            raise ValueError(f"Invalid reranker backend type: {reranker_type}")
+        module_name, class_name = RERANKER_CONFIG_MODULENAME_CLASSNAME_MAP[
+            reranker_type
+        ]
+        module = importlib.import_module(module_name)
+        derived_class = getattr(module, class_name, None)
+        if not derived_class or not issubclass(derived_class, cls):
+            raise ValueError(
+                f"Class {class_name} not found or is not subclass of {cls}"
+            )
+        return derived_class(config)
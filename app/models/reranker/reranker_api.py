@@ -0,0 +1,38 @@
+import os
+from typing import List
+
+from app.models.reranker.reranker import Reranker, RerankerConfig
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+RAG_RERANKER_API_KEY_ENVIRON = "RAG_RERANKER_API_KEY"
+
+
+class RerankerApi(Reranker):
+    """rerank by an openai compatible `/rerank` endpoint, such as the ones served by
+    vllm, TEI, xinference, jina or cohere"""
+
+    def __init__(self, config: RerankerConfig):
+        super().__init__(config)
+        from openai import OpenAI
+
+        api_key = os.environ.get(RAG_RERANKER_API_KEY_ENVIRON, None)
+        if api_key is None:
+            api_key = "api_key" if not config.api_key else config.api_key
+        self.client = OpenAI(api_key=api_key, base_url=config.api_url)
+        logger.info(f"RerankerApi initialized, api_url: {config.api_url}")
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        response = self.client.post(
+            "/rerank",
+            body={"model": self.model_name, "query": query, "documents": texts},
+            cast_to=object,
+        )
+        # jina and cohere style {"results": [...]}, TEI returns the list directly
+        results = response["results"] if isinstance(response, dict) else response
+        scores = [float("-inf")] * len(texts)
+        for result in results:
+            score = result.get("relevance_score", result.get("score"))
+            scores[result["index"]] = float(score)
+        return scores
@@ -0,0 +1,44 @@
+from typing import List
+
+import torch
+from app.models.reranker.reranker import Reranker, RerankerConfig
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class RerankerLocal(Reranker):
+    """rerank by a local cross-encoder such as bge-reranker, loaded by transformers"""
+
+    def __init__(self, config: RerankerConfig):
+        super().__init__(config)
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        self.max_length = config.max_length
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForSequenceClassification.from_pretrained(
+            self.model_path,
+            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+        )
+        if self.model.config.pad_token_id is None:
+            self.model.config.pad_token_id = self.tokenizer.pad_token_id
+        self.model.to(self.device)
+        self.model.eval()
+        logger.info(f"RerankerLocal initialized, model path: {self.model_path}")
+
+    @torch.no_grad()
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        inputs = self.tokenizer(
+            [query] * len(texts),
+            texts,
+            padding=True,
+            truncation="only_second",
+            max_length=self.max_length,
+            return_tensors="pt",
+        ).to(self.device)
+        logits = self.model(**inputs).logits
+        # bge-reranker outputs a single relevance logit for each pair
+        return logits[:, -1].float().cpu().tolist()
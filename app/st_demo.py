@@ -1,5 +1,6 @@
 import os
 import sys
+import uuid
 
 import streamlit as st
 from utils.logger import setup_logging
@@ -16,11 +17,25 @@ from app.engine.config import RAGConfig
 from app.engine.rag_engine import RAGEngine
 
 
+@st.cache_resource
+def get_rag_engine() -> RAGEngine:
+    """one engine per process, shared by all browser sessions. Documents of each
+    session are stored in its own directory, which scopes retrieval"""
+    return RAGEngine(RAGConfig.from_json(RAG_ENGINE_CONFIG_PATH))
+
+
 def query(prompt: str):
     if st.session_state.selected_mode == "问答":
-        result = st.session_state.rag_engine.query(prompt)
+        result = st.session_state.rag_engine.query(
+            prompt, scope=st.session_state.prefix, topk=st.session_state.topk
+        )
     elif st.session_state.selected_mode == "对话":
-        result = st.session_state.rag_engine.query_chat(prompt)
+        result = st.session_state.rag_engine.query_chat(
+            prompt,
+            st.session_state.session_id,
+            st.session_state.prefix,
+            st.session_state.topk,
+        )
 
     if result["answer"]:
         st.write(result["answer"])
@@ -29,7 +44,7 @@ def query(prompt: str):
                 for ref in result["reference"]:
                     st.info(
                         f"参考文件名: {ref[0][st.session_state.prefix_len:]}"
-                    )  # remove /tmp/
+                    )  # remove upload directory
                     st.write(f"相关内容: {ref[1]}")
         st.session_state.messages.append(
             {"role": "assistant", "content": result["answer"]}
@@ -39,9 +54,16 @@ def query(prompt: str):
 
 def query_stream(prompt: str):
     if st.session_state.selected_mode == "问答":
-        result_stream = st.session_state.rag_engine.query_stream(prompt)
+        result_stream = st.session_state.rag_engine.query_stream(
+            prompt, scope=st.session_state.prefix, topk=st.session_state.topk
+        )
     elif st.session_state.selected_mode == "对话":
-        result_stream = st.session_state.rag_engine.query_chat_stream(prompt)
+        result_stream = st.session_state.rag_engine.query_chat_stream(
+            prompt,
+            st.session_state.session_id,
+            st.session_state.prefix,
+            st.session_state.topk,
+        )
 
     answer_placeholder = st.empty()
     full_answer = ""
@@ -59,7 +81,7 @@ def query_stream(prompt: str):
                 for ref in partial_result["reference"]:
                     st.info(
                         f"参考文件名: {ref[0][st.session_state.prefix_len:]}"
-                    )  # remove /tmp/
+                    )  # remove upload directory
                     st.write(f"相关内容: {ref[1]}")
         st.session_state.messages.append({"role": "assistant", "content": full_answer})
     except Exception as e:
@@ -71,8 +93,11 @@ if __name__ == "__main__":
     st.title("RAG Demo")
 
     if "rag_engine" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
         st.session_state.rag_config = RAGConfig.from_json(RAG_ENGINE_CONFIG_PATH)
-        st.session_state.rag_engine = RAGEngine(st.session_state.rag_config)
+        # engine is shared, so topk of each session is passed with its queries
+        st.session_state.topk = st.session_state.rag_config.doc_config.topk
+        st.session_state.rag_engine = get_rag_engine()
         st.session_state.support_docx = (
             st.session_state.rag_engine.check_if_support_docx()
         )
@@ -90,9 +115,10 @@ if __name__ == "__main__":
             else query
         )
         if os.name == "nt":
-            st.session_state.prefix = "D:/"
+            st.session_state.prefix = f"D:/{st.session_state.session_id}/"
         elif os.name == "posix":
-            st.session_state.prefix = "/tmp/"
+            st.session_state.prefix = f"/tmp/{st.session_state.session_id}/"
+        os.makedirs(st.session_state.prefix, exist_ok=True)
 
         st.session_state.prefix_len = len(st.session_state.prefix)
 
@@ -104,12 +130,35 @@ if __name__ == "__main__":
     )
     submitted = st.button("上传")
     if uploaded_file is not None and submitted:
+        file_paths = []
         for file in uploaded_file:
             file_path = f"{st.session_state.prefix}{file.name}"
             with open(file_path, "wb") as f:
                 f.write(file.getbuffer())
+            file_paths.append(file_path)
 
-            if st.session_state.rag_engine.add_doc(file_path):
+        progress_bar = st.progress(0.0)
+
+        def show_progress(result, done, total):
+            progress_bar.progress(done / total, f"{done}/{total}")
+
+        # documents uploaded again are re-indexed, only changed chunks are embedded
+        added = set(
+            st.session_state.rag_engine.get_doc_list(st.session_state.prefix)
+        )
+        new_files = []
+        for file, file_path in zip(uploaded_file, file_paths):
+            if os.path.abspath(file_path) not in added:
+                new_files.append((file, file_path))
+            elif st.session_state.rag_engine.update_doc(file_path):
+                st.success(f"文档 '{file.name}' 更新成功！")
+            else:
+                st.error(f"文档 '{file.name}' 更新失败！")
+        results = st.session_state.rag_engine.add_docs(
+            [file_path for _, file_path in new_files], show_progress
+        )
+        for (file, _), result in zip(new_files, results):
+            if result.success:
                 st.success(f"文档 '{file.name}' 添加成功！")
             else:
                 st.error(f"文档 '{file.name}' 添加失败！")
@@ -139,11 +188,13 @@ if __name__ == "__main__":
         
 
         st.header("删除文档")
-        document_list = st.session_state.rag_engine.get_doc_list()
+        document_list = st.session_state.rag_engine.get_doc_list(
+            st.session_state.prefix
+        )
         if document_list:
             doc_list_remove_prefix = [
                 doc[st.session_state.prefix_len :] for doc in document_list
-            ]  # remove /tmp/
+            ]  # remove upload directory
             selected_document = st.selectbox("选择要删除的文档", doc_list_remove_prefix)
             if st.button("删除"):
                 if st.session_state.rag_engine.remove_doc(
@@ -156,12 +207,10 @@ if __name__ == "__main__":
             st.info("当前没有加载的文档。")
 
         st.header("参数配置")
-        topk = st.number_input(
+        st.number_input(
             "设置最大参考数量",
             min_value=1,
             max_value=128,
-            value=st.session_state.rag_config.doc_config.topk,
             step=1,
+            key="topk",
         )
-        if topk:
-            st.session_state.rag_engine.update_topk(topk)
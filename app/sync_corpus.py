@@ -0,0 +1,56 @@
+import argparse
+import os
+import sys
+import time
+
+from utils.logger import setup_logging
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JSON_DIR = os.path.join(BASE_DIR, "app/config")
+RAG_ENGINE_CONFIG_PATH = os.path.join(JSON_DIR, "config.json")
+RAG_LOGGER_CONFIG_PATH = os.path.join(JSON_DIR, "logging.json")
+
+sys.path.append(BASE_DIR)
+setup_logging(RAG_LOGGER_CONFIG_PATH)
+
+from app.document_processing.corpus_sync import CorpusSync
+from app.document_processing.doc_processor import DocProcessor
+from app.engine.config import RAGConfig
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="sync documents of a directory into the index in data_dir"
+    )
+    parser.add_argument("root", help="corpus directory")
+    parser.add_argument("--config", default=RAG_ENGINE_CONFIG_PATH, help="config file")
+    parser.add_argument(
+        "--watch", action="store_true", help="keep syncing on changes until interrupted"
+    )
+    args = parser.parse_args()
+
+    doc_config = RAGConfig.from_json(args.config).doc_config
+    if not doc_config.data_dir:
+        logger.warning("data_dir is not set, the index is lost once sync finishes")
+    corpus_sync = CorpusSync(
+        DocProcessor(doc_config),
+        args.root,
+        doc_config.ingest_workers,
+        doc_config.sync_poll_interval,
+    )
+    if not args.watch:
+        result = corpus_sync.sync()
+        sys.exit(1 if result.failed else 0)
+    corpus_sync.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        corpus_sync.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import re
+import threading
+from typing import List, Optional
+
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# CJK characters, each of them is counted as one token
+CJK_PATTERN = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+# other words, numbers and punctuations
+WORD_PATTERN = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+TOKEN_PATTERN = re.compile(rf"{CJK_PATTERN.pattern}|{WORD_PATTERN.pattern}")
+
+
+def estimate_tokens(text: str) -> int:
+    """estimate number of tokens without a tokenizer
+
+    Args:
+        text (str): input text
+
+    Returns:
+        int: estimated number of tokens
+    """
+    num_cjk = len(CJK_PATTERN.findall(text))
+    text = CJK_PATTERN.sub(" ", text)
+    # long english words and numbers are split into pieces of about 4 characters
+    return num_cjk + sum((len(word) + 3) // 4 for word in WORD_PATTERN.findall(text))
+
+
+def estimate_token_starts(text: str) -> List[int]:
+    """estimate start positions of tokens without a tokenizer, consistent with
+    estimate_tokens
+
+    Args:
+        text (str): input text
+
+    Returns:
+        List[int]: start positions of tokens in text
+    """
+    starts = []
+    for m in TOKEN_PATTERN.finditer(text):
+        starts.extend(range(m.start(), m.end(), 4))
+    return starts
+
+
+class TokenCounter:
+    """count tokens with the tokenizer of the llm if it is available, otherwise
+    fall back to estimate_tokens"""
+
+    def __init__(self, tokenizer_path: Optional[str] = None):
+        self.tokenizer_path = tokenizer_path
+        # loaded on first call
+        self.tokenizer = None
+        self._loaded = not tokenizer_path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                from transformers import AutoTokenizer
+
+                self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_path)
+            except Exception as e:
+                logger.warning(f"Failed to load tokenizer {self.tokenizer_path}: {e}")
+            self._loaded = True
+
+    def __call__(self, text: str) -> int:
+        if not self._loaded:
+            self._load()
+        if self.tokenizer is None:
+            return estimate_tokens(text)
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def token_starts(self, text: str) -> List[int]:
+        """start positions of tokens in text, estimated if the tokenizer is not a
+        fast tokenizer with offset mapping
+
+        Args:
+            text (str): input text
+
+        Returns:
+            List[int]: start positions of tokens, ascending
+        """
+        if not self._loaded:
+            self._load()
+        if self.tokenizer is None or not self.tokenizer.is_fast:
+            return estimate_token_starts(text)
+        offsets = self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+        return [start for start, end in offsets if end > start]
@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+from dataclasses import replace
+
+import faiss
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JSON_DIR = os.path.join(BASE_DIR, "app/config")
+RAG_ENGINE_CONFIG_PATH = os.path.join(JSON_DIR, "config.json")
+RAG_LOGGER_CONFIG_PATH = os.path.join(JSON_DIR, "logging.json")
+
+sys.path.append(BASE_DIR)
+from app.utils.logger import get_logger, setup_logging
+
+setup_logging(RAG_LOGGER_CONFIG_PATH)
+
+logger = get_logger(__name__)
+
+from app.document_processing.database.database import Database
+from app.engine.config import RAGConfig
+
+NUM_VECTORS = 100000
+NUM_QUERIES = 200
+NUM_FILES = 100
+TOPK = 10
+
+
+def build(config, vectors):
+    database = Database.from_config(config)
+    for i, part in enumerate(np.array_split(vectors, NUM_FILES)):
+        database.add_vector(f"file_{i}", np.ascontiguousarray(part))
+    return database
+
+
+def index_bytes_per_vector(database):
+    return len(faiss.serialize_index(database.index)) / database.index.ntotal
+
+
+def run(database, queries):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        results.append(
+            {(name, chunk_id) for name, chunk_id, _ in database.search(query[None, :])}
+        )
+    latency = (time.perf_counter() - start) / len(queries) * 1000
+    return results, latency
+
+
+if __name__ == "__main__":
+
+    doc_config = RAGConfig.from_json(RAG_ENGINE_CONFIG_PATH).doc_config
+    doc_config = replace(doc_config, topk=TOPK, nlist=256)
+
+    rng = np.random.default_rng(0)
+    # clustered data, closer to real embeddings than uniform noise
+    centers = rng.standard_normal((64, doc_config.dimension), dtype=np.float32)
+    vectors = centers[rng.integers(0, 64, NUM_VECTORS)] + 0.3 * rng.standard_normal(
+        (NUM_VECTORS, doc_config.dimension), dtype=np.float32
+    )
+    queries = vectors[rng.integers(0, NUM_VECTORS, NUM_QUERIES)] + 0.1 * (
+        rng.standard_normal((NUM_QUERIES, doc_config.dimension), dtype=np.float32)
+    )
+
+    flat = build(replace(doc_config, database_method="faiss"), vectors)
+    truth, flat_latency = run(flat, queries)
+    print(f"{'method':<12}{'recall@' + str(TOPK):<12}{'latency(ms)':<12}")
+    print(f"{'faiss':<12}{1.0:<12.3f}{flat_latency:<12.3f}")
+
+    # ivfpq without re-ranking shows the loss of pq distances alone
+    for name, method, refine_factor in [
+        ("faiss_ivfpq", "faiss_ivfpq", doc_config.refine_factor),
+        ("ivfpq_raw", "faiss_ivfpq", 0),
+        ("faiss_hnsw", "faiss_hnsw", doc_config.refine_factor),
+    ]:
+        database = build(
+            replace(doc_config, database_method=method, refine_factor=refine_factor),
+            vectors,
+        )
+        results, latency = run(database, queries)
+        recall = np.mean([len(r & t) / len(t) for r, t in zip(results, truth)])
+        print(f"{name:<12}{recall:<12.3f}{latency:<12.3f}")
+
+    # storage precision, compared with exact float32 search of normalised vectors
+    cosine_config = replace(doc_config, database_method="faiss", metric="cosine")
+    flat = build(cosine_config, vectors)
+    truth, _ = run(flat, queries)
+    print(f"{'storage':<12}{'recall@' + str(TOPK):<12}{'latency(ms)':<12}{'MB/1M vectors':<12}")
+    for storage in ["float32", "float16", "sq8"]:
+        database = build(replace(cosine_config, vector_storage=storage), vectors)
+        results, latency = run(database, queries)
+        recall = np.mean([len(r & t) / len(t) for r, t in zip(results, truth)])
+        size = index_bytes_per_vector(database)
+        print(f"{storage:<12}{recall:<12.3f}{latency:<12.3f}{size:<12.0f}")
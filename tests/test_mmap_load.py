@@ -0,0 +1,88 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NUM_VECTORS = 300000
+DIMENSION = 256
+NUM_FILES = 300
+# resident memory gained by loading, as a ratio of the saved index size
+RSS_BUDGET_RATIO = 0.25
+
+CONFIG_SCRIPT = f"""
+import sys
+sys.path.append({BASE_DIR!r})
+from app.engine.config import DocConfig
+config = DocConfig(
+    backend_type="local",
+    embedding_model_path="",
+    split_method="fixedlength",
+    chunk_length=256,
+    overlap=0,
+    database_method="faiss",
+    dimension={DIMENSION},
+    topk=5,
+)
+"""
+
+BUILD_SCRIPT = (
+    CONFIG_SCRIPT
+    + f"""
+import numpy as np
+from app.document_processing.database.database import Database
+database = Database.from_config(config)
+vectors = np.random.default_rng(0).random(({NUM_VECTORS}, {DIMENSION}), dtype=np.float32)
+database.add_vectors(
+    [(f"file_{{i}}", part) for i, part in enumerate(np.array_split(vectors, {NUM_FILES}))]
+)
+database.save(sys.argv[1])
+"""
+)
+
+MEASURE_SCRIPT = (
+    CONFIG_SCRIPT
+    + """
+import os
+import numpy as np
+from app.document_processing.database.database import Database
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+database = Database.from_config(config)
+before = rss()
+database.load(sys.argv[1])
+after = rss()
+database.search(np.zeros((1, config.dimension), dtype=np.float32))
+print(after - before)
+"""
+)
+
+
+if __name__ == "__main__":
+
+    if not os.path.exists("/proc/self/statm"):
+        print("Resident memory can only be measured on linux")
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run([sys.executable, "-c", BUILD_SCRIPT, data_dir], check=True)
+        index_size = os.path.getsize(os.path.join(data_dir, "index.faiss"))
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE_SCRIPT, data_dir],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split("\n")[-2]
+    loaded = int(output)
+
+    print(f"{'index(MB)':<12}{'load RSS(MB)':<14}{'budget(MB)':<12}")
+    budget = RSS_BUDGET_RATIO * index_size
+    print(f"{index_size / 2**20:<12.0f}{loaded / 2**20:<14.0f}{budget / 2**20:<12.0f}")
+    if loaded > budget:
+        print("Saved index is read into memory instead of memory-mapped")
+        sys.exit(1)
+    sys.exit(0)
@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JSON_DIR = os.path.join(BASE_DIR, "app/config")
+RAG_ENGINE_CONFIG_PATH = os.path.join(JSON_DIR, "config.json")
+
+# budgets in seconds, measured in a fresh interpreter
+IMPORT_BUDGET = 1.0
+INIT_BUDGET = 0.2
+# modules which should only be imported on first use, numpy is allowed at import
+# time since chunk store, sparse index and embedding cache are built on it
+HEAVY_MODULES = ["openai", "pdfplumber", "docx", "faiss", "torch", "transformers", "vllm"]
+
+MEASURE_SCRIPT = f"""
+import sys, time
+sys.path.append({BASE_DIR!r})
+start = time.perf_counter()
+from app.engine.config import RAGConfig
+from app.engine.rag_engine import RAGEngine
+imported = time.perf_counter()
+heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+config = RAGConfig.from_json({RAG_ENGINE_CONFIG_PATH!r})
+engine = RAGEngine(config)
+initialized = time.perf_counter()
+engine.warm_up_done.wait()
+ready = time.perf_counter()
+print(imported - start, initialized - imported, ready - imported, ",".join(heavy), int(engine.ready.is_set()))
+"""
+
+
+if __name__ == "__main__":
+
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE_SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split("\n")[-2]
+    import_time, init_time, ready_time, heavy, warmed_up = output.split(" ")
+    import_time, init_time, ready_time = map(
+        float, (import_time, init_time, ready_time)
+    )
+
+    print(f"{'stage':<16}{'time(s)':<12}{'budget(s)':<12}")
+    print(f"{'import':<16}{import_time:<12.3f}{IMPORT_BUDGET:<12.3f}")
+    print(f"{'init':<16}{init_time:<12.3f}{INIT_BUDGET:<12.3f}")
+    print(f"{'ready':<16}{ready_time:<12.3f}{'-':<12}")
+
+    failed = False
+    if warmed_up != "1":
+        print("Warm up failed, see warm_up_error of RAGEngine.get_status")
+        failed = True
+    if heavy:
+        print(f"Heavy modules imported at import time: {heavy}")
+        failed = True
+    if import_time > IMPORT_BUDGET or init_time > INIT_BUDGET:
+        print("Startup time is over budget")
+        failed = True
+    sys.exit(1 if failed else 0)